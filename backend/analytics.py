@@ -0,0 +1,137 @@
+"""
+Аналитика истории операций (таблица operations в backups.db).
+
+Тренды длительности и пропускной способности считаются оконными
+агрегатами SQLite по последним window успешным операциям того же типа;
+операция помечается медленной, если ее пропускная способность (или
+длительность, когда объем неизвестен) хуже средней по предыдущему окну
+в SLOW_FACTOR раз. У каждой операции в трендах отдаются настройки
+запуска (ограничение скорости троттлингом, восстановленные партиции).
+Прогноз длительности следующего запуска - ожидаемый объем (последний
+объем плюс средний прирост) на пропускную способность последних
+запусков без ограничения скорости.
+"""
+import json
+from typing import Any, Dict, List, Optional
+
+from worker import BackupManager
+
+OPERATION_KINDS = ("backup", "restore")
+SUCCESS_STATUSES = ("BACKUP_CREATED", "RESTORED")
+SLOW_FACTOR = 2.0
+
+_SUCCESS_FILTER = f"status IN ({', '.join(repr(status) for status in SUCCESS_STATUSES)}) AND duration_sec > 0"
+
+
+def operation_trends(manager: BackupManager, database: str, kind: str = "backup",
+                     window: int = 5, limit: int = 100) -> List[Dict[str, Any]]:
+    """Успешные операции базы (новые первыми) со скользящими средними по типу операции"""
+    window = max(1, int(window))
+    conn = manager.pool.get_connection()
+    try:
+        rows = conn.execute(f'''
+            SELECT id, type, started_at, finished_at, duration_sec, bytes, files, settings,
+                   CAST(bytes AS REAL) / duration_sec AS throughput,
+                   AVG(duration_sec) OVER recent AS avg_duration,
+                   CAST(SUM(bytes) OVER recent AS REAL) / SUM(duration_sec) OVER recent AS avg_throughput,
+                   AVG(duration_sec) OVER previous AS prev_avg_duration,
+                   CAST(SUM(bytes) OVER previous AS REAL) / SUM(duration_sec) OVER previous AS prev_throughput
+            FROM operations
+            WHERE database = ? AND kind = ? AND {_SUCCESS_FILTER}
+            WINDOW recent AS (PARTITION BY type ORDER BY started_at ROWS BETWEEN {window - 1} PRECEDING AND CURRENT ROW),
+                   previous AS (PARTITION BY type ORDER BY started_at ROWS BETWEEN {window} PRECEDING AND 1 PRECEDING)
+            ORDER BY started_at DESC
+            LIMIT ?
+        ''', (database, kind, limit)).fetchall()
+    finally:
+        manager.pool.return_connection(conn)
+
+    trends = []
+    for row in rows:
+        trend = dict(row)
+        trend["settings"] = json.loads(trend["settings"]) if trend["settings"] else {}
+        if trend["bytes"] and trend["prev_throughput"]:
+            trend["slow"] = trend["throughput"] * SLOW_FACTOR < trend["prev_throughput"]
+        elif trend["prev_avg_duration"]:
+            trend["slow"] = trend["duration_sec"] > trend["prev_avg_duration"] * SLOW_FACTOR
+        else:
+            trend["slow"] = False
+        trends.append(trend)
+    return trends
+
+
+def operation_summary(manager: BackupManager, database: str, kind: str = "backup") -> List[Dict[str, Any]]:
+    """Итоги по типам операций: число запусков, неудач, средняя длительность и пропускная способность"""
+    conn = manager.pool.get_connection()
+    try:
+        rows = conn.execute(f'''
+            SELECT type,
+                   COUNT(*) AS runs,
+                   SUM(status IN ('BACKUP_FAILED', 'RESTORE_FAILED')) AS failed,
+                   AVG(CASE WHEN {_SUCCESS_FILTER} THEN duration_sec END) AS avg_duration,
+                   CAST(SUM(CASE WHEN {_SUCCESS_FILTER} THEN bytes END) AS REAL)
+                       / SUM(CASE WHEN {_SUCCESS_FILTER} THEN duration_sec END) AS avg_throughput,
+                   MAX(started_at) AS last_started_at
+            FROM operations
+            WHERE database = ? AND kind = ?
+            GROUP BY type
+            ORDER BY type
+        ''', (database, kind)).fetchall()
+        return [dict(row) for row in rows]
+    finally:
+        manager.pool.return_connection(conn)
+
+
+def predict_duration(manager: BackupManager, database: str, kind: str = "backup",
+                     operation_type: Optional[str] = None, window: int = 5) -> Optional[Dict[str, Any]]:
+    """Прогноз длительности следующей операции по последним window успешным; None - истории нет"""
+    conn = manager.pool.get_connection()
+    try:
+        rows = conn.execute(f'''
+            SELECT duration_sec, bytes, bytes - LAG(bytes) OVER (ORDER BY started_at) AS growth
+            FROM operations
+            WHERE database = ? AND kind = ? AND type IS ? AND {_SUCCESS_FILTER}
+              AND json_extract(settings, '$.max_backup_bandwidth') IS NULL
+            ORDER BY started_at DESC
+            LIMIT ?
+        ''', (database, kind, operation_type, max(1, int(window)))).fetchall()
+    finally:
+        manager.pool.return_connection(conn)
+    if not rows:
+        return None
+
+    total_duration = sum(row["duration_sec"] for row in rows)
+    total_bytes = sum(row["bytes"] or 0 for row in rows)
+    growth = [row["growth"] for row in rows if row["growth"] is not None]
+    expected_bytes = max(0, (rows[0]["bytes"] or 0) + (sum(growth) / len(growth) if growth else 0))
+
+    if total_bytes and expected_bytes:
+        throughput = total_bytes / total_duration
+        predicted = expected_bytes / throughput
+    else:
+        # Объем неизвестен (например, бэкап не на локальном диске): средняя длительность
+        throughput = None
+        predicted = total_duration / len(rows)
+    return {
+        "type": operation_type,
+        "samples": len(rows),
+        "expected_bytes": int(expected_bytes),
+        "throughput": throughput,
+        "predicted_duration_sec": predicted,
+    }
+
+
+def database_analytics(manager: BackupManager, database: str, kind: str = "backup",
+                       window: int = 5, limit: int = 100) -> Dict[str, Any]:
+    summary = operation_summary(manager, database, kind)
+    return {
+        "database": database,
+        "kind": kind,
+        "summary": summary,
+        "predictions": [
+            prediction for prediction in (
+                predict_duration(manager, database, kind, row["type"], window) for row in summary
+            ) if prediction is not None
+        ],
+        "trends": operation_trends(manager, database, kind, window, limit),
+    }
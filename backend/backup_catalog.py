@@ -0,0 +1,278 @@
+"""
+Экспорт, импорт и восстановление каталога бэкапов (backups.db).
+
+Если метаданные потеряны, каталог пересобирается сканированием
+BACKUP_DIR/<db>/<type>/backup_* и чтением манифестов .backup,
+которые ClickHouse пишет в каждый бэкап.
+
+Бэкапы кластера так не восстанавливаются: в корне их каталога манифеста
+нет, а каталоги shard_N с манифестами лежат на узлах кластера.
+
+Запуск из командной строки:
+    python backup_catalog.py rebuild [--db PATH] [--workers N]
+    python backup_catalog.py export [--database DB] > catalog.ndjson
+    python backup_catalog.py import < catalog.ndjson
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+from environments import BACKUP_DIR, BACKUP_META_DB
+from logger import logger
+from validation import (is_valid_backup_dir_name, is_valid_backup_identifier, is_valid_identifier,
+                        is_valid_partition_id)
+from worker import BackupManager
+
+MANIFEST_NAME = ".backup"
+BACKUP_TYPES = ("full", "incremental", "partitions")
+REQUIRED_FIELDS = ("id", "database", "type", "destination", "timestamp", "status")
+
+# Меньше этого числа бэкапов пул процессов не окупает свой запуск
+PARALLEL_SCAN_THRESHOLD = 256
+
+
+def find_backup_dirs(backup_dir: str = BACKUP_DIR) -> List[str]:
+    """Возвращает пути вида <backup_dir>/<db>/<type>/backup_*"""
+    result = []
+    if not os.path.isdir(backup_dir):
+        return result
+    for db_entry in os.scandir(backup_dir):
+        if not db_entry.is_dir() or not is_valid_identifier(db_entry.name):
+            continue
+        for backup_type in BACKUP_TYPES:
+            type_dir = os.path.join(db_entry.path, backup_type)
+            if not os.path.isdir(type_dir):
+                continue
+            for entry in os.scandir(type_dir):
+                if entry.is_dir() and is_valid_backup_dir_name(entry.name):
+                    result.append(entry.path)
+    return result
+
+
+def read_manifest(backup_path: str) -> Optional[Dict[str, Any]]:
+    """
+    Читает манифест бэкапа ClickHouse.
+    Размер считается по манифесту: для файлов из базового бэкапа
+    учитывается только дописанная часть (size - base_size).
+    """
+    manifest_path = os.path.join(backup_path, MANIFEST_NAME)
+    try:
+        root = ET.parse(manifest_path).getroot()
+    except (OSError, ET.ParseError) as e:
+        logger.debug(f"Не удалось прочитать манифест {manifest_path}: {str(e)}")
+        return None
+
+    size = os.path.getsize(manifest_path)
+    names = []
+    contents = root.find("contents")
+    if contents is not None:
+        for file_info in contents.iter("file"):
+            file_size = int(file_info.findtext("size") or 0)
+            base_size = int(file_info.findtext("base_size") or 0)
+            size += file_size - base_size
+            names.append(file_info.findtext("name") or "")
+
+    return {
+        "uuid": root.findtext("uuid"),
+        "timestamp": root.findtext("timestamp"),
+        "base_backup": root.findtext("base_backup"),
+        "base_backup_uuid": root.findtext("base_backup_uuid"),
+        "size": size,
+        "names": names,
+    }
+
+
+def manifest_partitions(database: str, names: List[str]) -> Dict[str, List[str]]:
+    """
+    Восстанавливает набор партиций по путям файлов в манифесте:
+    data/<db>/<table>/<part_name>/<file>, где имя куска начинается с partition_id.
+    """
+    partitions: Dict[str, set] = {}
+    for name in names:
+        parts = name.split("/")
+        try:
+            index = parts.index("data")
+        except ValueError:
+            continue
+        if len(parts) < index + 5 or parts[index + 1] != database:
+            continue
+        partitions.setdefault(parts[index + 2], set()).add(parts[index + 3].split("_")[0])
+    return {table: sorted(ids) for table, ids in partitions.items()}
+
+
+def scan_backup(backup_path: str) -> Optional[Dict[str, Any]]:
+    """Восстанавливает запись метаданных для каталога бэкапа"""
+    manifest = read_manifest(backup_path)
+    if not manifest or not manifest["uuid"]:
+        return None
+
+    type_dir = os.path.dirname(backup_path)
+    database = os.path.basename(os.path.dirname(type_dir))
+    backup_type = os.path.basename(type_dir)
+    try:
+        timestamp = datetime.strptime(manifest["timestamp"], "%Y-%m-%d %H:%M:%S")
+    except (TypeError, ValueError):
+        timestamp = datetime.fromtimestamp(os.path.getmtime(backup_path))
+
+    partitions = None
+    if backup_type == "partitions":
+        partitions = manifest_partitions(database, manifest["names"])
+
+    return {
+        "id": manifest["uuid"],
+        "database": database,
+        "type": backup_type,
+        "destination": f"File('{backup_path}')",
+        "base_backup": manifest["base_backup_uuid"],
+        "timestamp": timestamp.isoformat(),
+        "status": "BACKUP_CREATED",
+        "size": manifest["size"],
+        "description": None,
+        "partitions": partitions,
+        "snapshot_time": timestamp.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+
+
+def rebuild_catalog(manager: BackupManager, backup_dir: str = BACKUP_DIR,
+                    workers: Optional[int] = None) -> Dict[str, int]:
+    """
+    Сканирует хранилище и добавляет в метаданные бэкапы, которых там нет.
+    Существующие записи не изменяются.
+    """
+    paths = find_backup_dirs(backup_dir)
+    logger.debug(f"Найдено каталогов бэкапов: {len(paths)}")
+
+    if len(paths) < PARALLEL_SCAN_THRESHOLD or workers == 1:
+        rows = [scan_backup(path) for path in paths]
+    else:
+        # spawn: форк процесса с потоками uvicorn может унаследовать захваченные блокировки
+        with ProcessPoolExecutor(max_workers=workers,
+                                 mp_context=multiprocessing.get_context("spawn")) as executor:
+            chunksize = max(1, len(paths) // ((workers or os.cpu_count() or 1) * 8))
+            rows = list(executor.map(scan_backup, paths, chunksize=chunksize))
+
+    found = [row for row in rows if row is not None and has_valid_ids(row)]
+    added = manager.add_backups(found)
+    logger.debug(f"Каталог восстановлен: добавлено {added} из {len(found)} бэкапов")
+    return {"scanned": len(paths), "found": len(found), "added": added, "skipped": len(paths) - len(found)}
+
+
+def export_catalog(manager: BackupManager, database: Optional[str] = None) -> Iterator[str]:
+    """Отдает каталог в формате NDJSON, по одной записи на строку"""
+    for backup in manager.iter_backups(database):
+        yield json.dumps(backup, ensure_ascii=False) + "\n"
+
+
+def has_valid_ids(backup: Dict[str, Any]) -> bool:
+    """ID бэкапа и базового бэкапа (из манифеста или импорта) подставляются в запросы и пути"""
+    backup_id, base_backup = backup.get("id"), backup.get("base_backup")
+    return (
+        isinstance(backup_id, str) and bool(backup_id) and is_valid_backup_identifier(backup_id)
+        and (base_backup is None or (isinstance(base_backup, str) and is_valid_backup_identifier(base_backup)))
+    )
+
+
+def is_valid_destination(backup: Dict[str, Any], backup_dir: str = BACKUP_DIR) -> bool:
+    """
+    destination должен быть File('<backup_dir>/<db>/<type>/backup_*'): он попадает
+    в RESTORE ... FROM и удаляется вместе с бэкапом.
+    """
+    destination = backup["destination"]
+    if not isinstance(destination, str) or not (destination.startswith("File('") and destination.endswith("')")):
+        return False
+    path = destination[6:-2]
+    if "'" in path or "\\" in path or not is_valid_backup_dir_name(os.path.basename(path)):
+        return False
+    type_dir = os.path.join(backup_dir, backup["database"], backup["type"])
+    if os.path.normpath(os.path.dirname(path)) != os.path.normpath(type_dir):
+        return False
+    # Символические ссылки внутри хранилища не должны уводить за его пределы
+    root = os.path.realpath(backup_dir)
+    return os.path.realpath(path).startswith(root + os.sep)
+
+
+def is_valid_partitions(partitions: Any) -> bool:
+    """partitions: {таблица: [ID партиций] или None}"""
+    if partitions is None:
+        return True
+    if not isinstance(partitions, dict):
+        return False
+    for table, partition_ids in partitions.items():
+        if not is_valid_identifier(table):
+            return False
+        if partition_ids is not None and not (
+            isinstance(partition_ids, list)
+            and all(isinstance(partition_id, str) and is_valid_partition_id(partition_id)
+                    for partition_id in partition_ids)
+        ):
+            return False
+    return True
+
+
+def parse_catalog_lines(lines: Iterable[str], backup_dir: str = BACKUP_DIR) -> Iterator[Dict[str, Any]]:
+    """
+    Разбирает строки NDJSON, проверяя обязательные поля и все значения,
+    которые попадают в запросы ClickHouse и пути файловой системы.
+    """
+    for line_no, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        backup = json.loads(line)
+        if not isinstance(backup, dict):
+            raise ValueError(f"Строка {line_no}: ожидается объект JSON")
+        missing = [field for field in REQUIRED_FIELDS if not backup.get(field)]
+        if missing:
+            raise ValueError(f"Строка {line_no}: отсутствуют поля {', '.join(missing)}")
+        if (not isinstance(backup["database"], str) or not is_valid_identifier(backup["database"])
+                or backup["type"] not in BACKUP_TYPES):
+            raise ValueError(f"Строка {line_no}: некорректная база или тип бэкапа")
+        if not has_valid_ids(backup):
+            raise ValueError(f"Строка {line_no}: некорректный ID бэкапа или базового бэкапа")
+        if not is_valid_destination(backup, backup_dir):
+            raise ValueError(f"Строка {line_no}: destination должен указывать на каталог бэкапа в {backup_dir}")
+        if not is_valid_partitions(backup.get("partitions")):
+            raise ValueError(f"Строка {line_no}: некорректные таблицы или ID партиций")
+        yield backup
+
+
+def import_catalog(manager: BackupManager, lines: Iterable[str], backup_dir: str = BACKUP_DIR) -> int:
+    """Импортирует каталог из NDJSON, пропуская уже известные ID"""
+    return manager.add_backups(parse_catalog_lines(lines, backup_dir))
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Управление каталогом бэкапов ClickHouse")
+    parser.add_argument("--db", default=BACKUP_META_DB, help="Путь к backups.db")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    rebuild_parser = subparsers.add_parser("rebuild", help="Восстановить каталог по содержимому хранилища")
+    rebuild_parser.add_argument("--backup-dir", default=BACKUP_DIR)
+    rebuild_parser.add_argument("--workers", type=int, default=None)
+
+    export_parser = subparsers.add_parser("export", help="Выгрузить каталог в NDJSON (stdout)")
+    export_parser.add_argument("--database", default=None)
+
+    subparsers.add_parser("import", help="Загрузить каталог из NDJSON (stdin)")
+
+    args = parser.parse_args(argv)
+    manager = BackupManager(args.db)
+    try:
+        if args.command == "rebuild":
+            print(json.dumps(rebuild_catalog(manager, args.backup_dir, args.workers)))
+        elif args.command == "export":
+            sys.stdout.writelines(export_catalog(manager, args.database))
+        else:
+            print(json.dumps({"added": import_catalog(manager, sys.stdin)}))
+    finally:
+        manager.pool.close_all()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+import os
+import tempfile
+from datetime import datetime, timedelta
+
+# environments читает BACKUP_STORAGE при импорте, поэтому каталог
+# для метаданных задается до импорта модулей бэкенда
+os.environ.setdefault("BACKUP_STORAGE", tempfile.mkdtemp(prefix="chbm_bench_"))
+
+import pytest
+from fastapi.testclient import TestClient
+
+from tests.fake_clickhouse import FakeClickHouseClient, make_backup_tree
+from worker import BackupManager, ClickHouseBackup
+
+# Размеры синтетических данных настраиваются через окружение
+BENCH_CATALOG_ROWS = int(os.getenv("BENCH_CATALOG_ROWS", 10000))
+BENCH_TREE_FILES = int(os.getenv("BENCH_TREE_FILES", 2000))
+BENCH_TREE_FILE_SIZE = int(os.getenv("BENCH_TREE_FILE_SIZE", 4096))
+BENCH_POLLS = int(os.getenv("BENCH_POLLS", 20))
+BENCH_DB = "bench_db"
+
+_percentiles = []
+
+
+def populate_catalog(manager: BackupManager, rows: int, database: str = BENCH_DB) -> None:
+    """Заполняет метаданные синтетическими бэкапами одной транзакцией"""
+    start = datetime(2024, 1, 1)
+    conn = manager.pool.get_connection()
+    try:
+        conn.executemany('''
+            INSERT INTO backups (
+                id, database, type, destination,
+                base_backup, timestamp, status, size, description
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (
+            (
+                f"bench-{i:08d}",
+                database,
+                "full" if i % 10 == 0 else "incremental",
+                f"File('/backups/{database}/backup_{i}')",
+                None if i % 10 == 0 else f"bench-{i - i % 10:08d}",
+                (start + timedelta(hours=i)).isoformat(),
+                "BACKUP_CREATED",
+                i * 1024,
+                None,
+            )
+            for i in range(rows)
+        ))
+        conn.commit()
+    finally:
+        manager.pool.return_connection(conn)
+
+
+def _percentile(data, q):
+    ordered = sorted(data)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+@pytest.fixture(autouse=True)
+def record_percentiles(request):
+    """Добавляет p50/p99 латентности в результаты pytest-benchmark"""
+    yield
+    benchmark = request.node.funcargs.get("benchmark")
+    if benchmark is None or benchmark.stats is None:
+        return
+    data = benchmark.stats.stats.data
+    if not data:
+        return
+    benchmark.extra_info["p50_ms"] = _percentile(data, 0.50) * 1000
+    benchmark.extra_info["p99_ms"] = _percentile(data, 0.99) * 1000
+    benchmark.extra_info["ops_per_sec"] = len(data) / sum(data)
+    _percentiles.append((request.node.name, benchmark.extra_info))
+
+
+def pytest_terminal_summary(terminalreporter):
+    if not _percentiles:
+        return
+    terminalreporter.section("latency percentiles")
+    for name, info in _percentiles:
+        terminalreporter.write_line(
+            f"{name:<40} p50={info['p50_ms']:.3f}ms p99={info['p99_ms']:.3f}ms "
+            f"ops/s={info['ops_per_sec']:.1f}"
+        )
+
+
+@pytest.fixture(scope="session")
+def catalog(tmp_path_factory):
+    manager = BackupManager(str(tmp_path_factory.mktemp("catalog") / "backups.db"))
+    populate_catalog(manager, BENCH_CATALOG_ROWS)
+    yield manager
+    manager.pool.close_all()
+
+
+@pytest.fixture(scope="session")
+def backup_tree(tmp_path_factory):
+    path = tmp_path_factory.mktemp("tree") / "backup_tree"
+    make_backup_tree(str(path), BENCH_TREE_FILES, BENCH_TREE_FILE_SIZE)
+    return f"File('{path}')"
+
+
+@pytest.fixture
+def fake_client():
+    return FakeClickHouseClient(databases={BENCH_DB: ["events"], "default": [], "system": []},
+                                polls_to_complete=BENCH_POLLS)
+
+
+@pytest.fixture
+def chb(fake_client):
+    backup = ClickHouseBackup()
+    backup.client = fake_client
+    backup.throttle.enabled = False
+    return backup
+
+
+@pytest.fixture(scope="session")
+def api():
+    import main
+
+    main.chb.client = FakeClickHouseClient(databases={BENCH_DB: ["events"], "default": [], "system": []})
+    main.chb.throttle.enabled = False
+    # Фоновые потоки (отслеживание, кэш схемы, готовность) получают ту же заглушку
+    main.chb.client_factory = lambda: main.chb.client
+    populate_catalog(main.chb.meta, BENCH_CATALOG_ROWS)
+    with TestClient(main.app) as client:
+        yield client
@@ -0,0 +1,17 @@
+from .conftest import BENCH_CATALOG_ROWS, BENCH_DB
+
+
+def test_api_list_databases(benchmark, api):
+    response = benchmark(api.get, "/api/databases")
+    assert response.status_code == 200
+
+
+def test_api_list_backups(benchmark, api):
+    response = benchmark(api.get, "/api/backups", params={"database": BENCH_DB})
+    assert response.status_code == 200
+    assert len(response.json()) >= BENCH_CATALOG_ROWS
+
+
+def test_api_create_backup(benchmark, api):
+    response = benchmark(api.post, "/api/backups", json={"database": BENCH_DB, "backup_type": "full"})
+    assert response.status_code == 200
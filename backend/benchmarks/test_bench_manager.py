@@ -0,0 +1,33 @@
+import itertools
+from datetime import datetime
+
+from .conftest import BENCH_CATALOG_ROWS, BENCH_DB
+
+
+def test_list_backups(benchmark, catalog):
+    """Список бэкапов базы из метаданных"""
+    result = benchmark(catalog.list_backups, BENCH_DB)
+    assert len(result) == BENCH_CATALOG_ROWS
+
+
+def test_get_backup(benchmark, catalog):
+    """Поиск бэкапа по ID"""
+    result = benchmark(catalog.get_backup, f"bench-{BENCH_CATALOG_ROWS // 2:08d}")
+    assert result is not None
+
+
+def test_add_backup(benchmark, catalog):
+    """Регистрация нового бэкапа"""
+    ids = itertools.count()
+
+    def add():
+        catalog.add_backup({
+            "id": f"bench-add-{next(ids)}",
+            "database": "bench_add_db",
+            "type": "full",
+            "destination": "File('/backups/bench_add_db/full/backup')",
+            "timestamp": datetime.now().isoformat(),
+            "status": "BACKUP_CREATED",
+        })
+
+    benchmark(add)
@@ -0,0 +1,30 @@
+import itertools
+
+from .conftest import BENCH_TREE_FILE_SIZE, BENCH_TREE_FILES, BENCH_DB
+
+
+def test_get_backup_size(benchmark, chb, backup_tree):
+    """Подсчет размера синтетического дерева бэкапа"""
+    size = benchmark(chb._get_backup_size, backup_tree)
+    assert size >= BENCH_TREE_FILES * BENCH_TREE_FILE_SIZE
+
+
+def test_wait_for_operation(benchmark, chb, fake_client):
+    """Накладные расходы опроса system.backups без пауз между опросами"""
+    def start_operation():
+        op_id, _ = fake_client.execute(f"BACKUP DATABASE {BENCH_DB} TO File('/dev/null') ASYNC")[0]
+        return (op_id,), {"poll_sec": 0}
+
+    status = benchmark.pedantic(chb.wait_for_operation, setup=start_operation, rounds=200)
+    assert status == "BACKUP_CREATED"
+
+
+def test_backup_full_sync(benchmark, chb, tmp_path):
+    """Синхронный полный бэкап: запуск, ожидание и обновление метаданных"""
+    ids = itertools.count()
+
+    def backup():
+        destination = f"File('{tmp_path}/backup_{next(ids)}')"
+        chb.backup_full(database=BENCH_DB, destination=destination)
+
+    benchmark(backup)
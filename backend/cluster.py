@@ -0,0 +1,285 @@
+"""
+Бэкапы шардированного кластера.
+
+Топология берется из system.clusters: на каждом шарде выбирается первая
+доступная реплика, и BACKUP/RESTORE запускаются на всех шардах
+параллельно, поэтому время операции определяется самым большим шардом,
+а не суммой шардов. Каждый шард пишет в свой подкаталог
+<destination>/shard_<N> на своем узле. Логический бэкап - одна запись
+в backups (с заполненным cluster), операции шардов с их ID и статусами
+хранятся в backup_shards.
+"""
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional
+
+from logger import logger
+from worker import ClickHouseBackup
+
+
+def shard_destination(destination: str, shard_num: int) -> str:
+    """File('/path') -> File('/path/shard_N')"""
+    if destination.startswith("File('") and destination.endswith("')"):
+        return f"File('{destination[6:-2]}/shard_{shard_num}')"
+    raise ValueError(f"Бэкап кластера поддерживает только назначение File(...): {destination}")
+
+
+class ShardedBackup:
+    def __init__(self, chb: ClickHouseBackup, cluster: str,
+                 shard_factory: Optional[Callable[[str, int], ClickHouseBackup]] = None):
+        self.chb = chb
+        self.meta = chb.meta
+        self.cluster = cluster
+        # Для каждой операции создаются свои соединения: Client не потокобезопасен
+        self.shard_factory = shard_factory or chb.for_host
+
+    @staticmethod
+    def _release(nodes: List[ClickHouseBackup]) -> None:
+        """Закрывает соединения узлов, созданных shard_factory для одной операции"""
+        for node in nodes:
+            try:
+                node.client.disconnect()
+                node.throttle.close()
+            except Exception as e:
+                logger.warning(f"Ошибка закрытия соединения с узлом кластера: {str(e)}")
+
+    def discover_shards(self) -> List[Dict[str, Any]]:
+        """
+        Возвращает по одной доступной реплике на каждый шард кластера.
+        Соединения узлов (shard["node"]) закрывает вызывающий через _release.
+        """
+        rows = self.chb.client.execute(
+            """
+            SELECT shard_num, host_name, port
+            FROM system.clusters
+            WHERE cluster = %(cluster)s
+            ORDER BY shard_num, replica_num
+            """,
+            {"cluster": self.cluster}
+        )
+        if not rows:
+            raise ValueError(f"Кластер {self.cluster} не найден в system.clusters")
+
+        replicas: Dict[int, List[tuple]] = {}
+        for shard_num, host, port in rows:
+            replicas.setdefault(shard_num, []).append((host, port))
+
+        shards = []
+        for shard_num, candidates in sorted(replicas.items()):
+            for host, port in candidates:
+                node = self.shard_factory(host, port)
+                try:
+                    node.client.execute("SELECT 1")
+                except Exception as e:
+                    logger.warning(f"Реплика {host}:{port} шарда {shard_num} недоступна: {str(e)}")
+                    self._release([node])
+                    continue
+                shards.append({"shard_num": shard_num, "host": host, "port": port, "node": node})
+                break
+            else:
+                self._release([shard["node"] for shard in shards])
+                raise RuntimeError(f"Нет доступных реплик шарда {shard_num} кластера {self.cluster}")
+        return shards
+
+    @staticmethod
+    def _operation_size(node: ClickHouseBackup, op_id: str, destination: str) -> int:
+        """Размер бэкапа шарда: локально, если каталог доступен, иначе по system.backups"""
+        size = node._get_backup_size(destination)
+        if size:
+            return size
+        rows = node.client.execute("SELECT total_size FROM system.backups WHERE id = %(id)s", {"id": op_id})
+        return rows[0][0] if rows else 0
+
+    def _backup_shard(self, backup_id: str, shard: Dict[str, Any], query: str, destination: str) -> int:
+        node = shard["node"]
+        shard_num = shard["shard_num"]
+        settings = node.throttle.acquire()
+        logger.debug(f"Шард {shard_num} ({shard['host']}): {query}, настройки: {settings}")
+        op_id, status = node.client.execute(query, settings=settings)[0]
+        self.meta.update_shard(backup_id, shard_num, {"op_id": op_id, "status": status})
+        return self._track_shard(backup_id, shard_num, node, op_id, destination)
+
+    def _track_shard(self, backup_id: str, shard_num: int, node: ClickHouseBackup,
+                     op_id: str, destination: str) -> int:
+        try:
+            status = node.wait_for_operation(op_id)
+        except Exception as e:
+            self.meta.update_shard(backup_id, shard_num, {"status": "BACKUP_FAILED", "error": str(e)})
+            raise
+        size = self._operation_size(node, op_id, destination)
+        self.meta.update_shard(backup_id, shard_num, {"status": status, "size": size})
+        return size
+
+    def _finish(self, backup_id: str, futures: List[Any]) -> str:
+        """Сводит статусы шардов в статус логического бэкапа"""
+        size = 0
+        errors = []
+        for future in futures:
+            try:
+                size += future.result()
+            except Exception as e:
+                errors.append(str(e))
+        status = "BACKUP_FAILED" if errors else "BACKUP_CREATED"
+        self.meta.update_backup(backup_id, {"status": status, "size": size})
+        self.meta.finish_operation(backup_id, status, size, error="; ".join(errors) or None)
+        if errors:
+            logger.error(f"Бэкап кластера {backup_id} провален на {len(errors)} шардах: {'; '.join(errors)}")
+        else:
+            logger.debug(f"Бэкап кластера {backup_id} создан, размер {size}")
+        return status
+
+    def _run_backup(self, backup_id: str, shards: List[Dict[str, Any]], queries: Dict[int, str],
+                    destinations: Dict[int, str]) -> str:
+        try:
+            with ThreadPoolExecutor(max_workers=len(shards)) as executor:
+                futures = [
+                    executor.submit(self._backup_shard, backup_id, shard, queries[shard["shard_num"]],
+                                    destinations[shard["shard_num"]])
+                    for shard in shards
+                ]
+        finally:
+            self._release([shard["node"] for shard in shards])
+        return self._finish(backup_id, futures)
+
+    def backup(self, database: str, destination: str, base_backup_id: Optional[str] = None,
+               async_mode: bool = False, description: Optional[str] = None,
+               on_started: Optional[Callable[[str], None]] = None) -> str:
+        """
+        Запускает полный (или инкрементальный от base_backup_id) бэкап базы
+        на всех шардах и возвращает ID логического бэкапа.
+        Если задан on_started, он получает ID бэкапа сразу после регистрации.
+        """
+        base_destinations: Dict[int, str] = {}
+        if base_backup_id:
+            base_backup = self.meta.get_backup(base_backup_id)
+            if not base_backup or not base_backup.get("cluster"):
+                raise ValueError(f"Базовый бэкап кластера {base_backup_id} не найден в метаданных")
+            base_destinations = {shard["shard_num"]: shard["destination"] for shard in self.meta.list_shards(base_backup_id)}
+
+        shards = self.discover_shards()
+        try:
+            queries = {}
+            destinations = {}
+            for shard in shards:
+                shard_num = shard["shard_num"]
+                destinations[shard_num] = shard_destination(destination, shard_num)
+                query = f"BACKUP DATABASE {database} TO {destinations[shard_num]}"
+                if base_backup_id:
+                    if shard_num not in base_destinations:
+                        raise ValueError(f"В базовом бэкапе {base_backup_id} нет шарда {shard_num}")
+                    query += f" SETTINGS base_backup = {base_destinations[shard_num]}"
+                queries[shard_num] = query + " ASYNC"
+
+            backup_id = str(uuid.uuid4())
+            snapshot_time = self.chb.client.execute("SELECT now()")[0][0]
+            self.meta.add_backup({
+                "id": backup_id,
+                "database": database,
+                "type": "incremental" if base_backup_id else "full",
+                "destination": destination,
+                "base_backup": base_backup_id,
+                "timestamp": datetime.now().isoformat(),
+                "status": "CREATING_BACKUP",
+                "size": 0,
+                "description": description,
+                "snapshot_time": snapshot_time.strftime("%Y-%m-%d %H:%M:%S"),
+                "cluster": self.cluster,
+            })
+            self.meta.add_shards(backup_id, [
+                {**shard, "destination": destinations[shard["shard_num"]], "status": "PENDING"}
+                for shard in shards
+            ])
+            self.meta.start_operation({
+                "id": backup_id,
+                "kind": "backup",
+                "database": database,
+                "type": "incremental" if base_backup_id else "full",
+                "target": destination,
+                "status": "CREATING_BACKUP",
+                "settings": {"cluster": self.cluster, "shards": len(shards)},
+            })
+            logger.debug(f"Бэкап кластера {backup_id}: {len(shards)} шардов")
+
+            if on_started:
+                on_started(backup_id)
+        except Exception:
+            # Операция не запущена: соединения с шардами больше не нужны
+            self._release([shard["node"] for shard in shards])
+            raise
+
+        if async_mode and on_started is None:
+            threading.Thread(
+                target=self._run_backup, args=(backup_id, shards, queries, destinations), daemon=True
+            ).start()
+            return backup_id
+
+        status = self._run_backup(backup_id, shards, queries, destinations)
+        if status == "BACKUP_FAILED":
+            raise RuntimeError(f"Бэкап кластера {backup_id} провален")
+        return backup_id
+
+    def _resume_shard(self, backup_id: str, shard: Dict[str, Any]) -> int:
+        if shard["status"] == "BACKUP_CREATED":
+            return shard["size"] or 0
+        if shard["status"] == "BACKUP_FAILED":
+            raise RuntimeError(f"Шард {shard['shard_num']}: {shard['error']}")
+        if not shard["op_id"]:
+            error = "Операция шарда не была запущена"
+            self.meta.update_shard(backup_id, shard["shard_num"], {"status": "BACKUP_FAILED", "error": error})
+            raise RuntimeError(f"Шард {shard['shard_num']}: {error}")
+        node = self.shard_factory(shard["host"], shard["port"])
+        try:
+            return self._track_shard(backup_id, shard["shard_num"], node, shard["op_id"], shard["destination"])
+        finally:
+            self._release([node])
+
+    def resume(self, backup_id: str) -> str:
+        """Дожидается операций шардов, запущенных ранее другим процессом"""
+        shards = self.meta.list_shards(backup_id)
+        with ThreadPoolExecutor(max_workers=max(1, len(shards))) as executor:
+            futures = [executor.submit(self._resume_shard, backup_id, shard) for shard in shards]
+        return self._finish(backup_id, futures)
+
+    def restore(self, database: str, backup_id: str, async_mode: bool = False) -> None:
+        """Восстанавливает базу на каждом шарде из его части бэкапа, параллельно"""
+        shards = {shard["shard_num"]: shard for shard in self.meta.list_shards(backup_id)}
+        if not shards:
+            raise ValueError(f"Бэкап {backup_id} не содержит шардов")
+        targets = self.discover_shards()
+        missing = set(shards) - {target["shard_num"] for target in targets}
+        if missing:
+            self._release([target["node"] for target in targets])
+            raise ValueError(f"В кластере {self.cluster} нет шардов {sorted(missing)} из бэкапа")
+
+        def restore_shard(target: Dict[str, Any]) -> None:
+            source = shards[target["shard_num"]]["destination"]
+            logger.debug(f"Восстановление шарда {target['shard_num']} ({target['host']}) из {source}")
+            target["node"].restore(database=database, source=source, async_mode=False)
+
+        def run() -> None:
+            try:
+                with ThreadPoolExecutor(max_workers=len(targets)) as executor:
+                    futures = [executor.submit(restore_shard, target) for target in targets]
+            finally:
+                self._release([target["node"] for target in targets])
+            errors = []
+            for future in futures:
+                try:
+                    future.result()
+                except Exception as e:
+                    errors.append(str(e))
+            if errors:
+                raise RuntimeError(f"Восстановление провалено на {len(errors)} шардах: {'; '.join(errors)}")
+            logger.debug(f"База {database} восстановлена на {len(targets)} шардах из {backup_id}")
+
+        if async_mode:
+            def run_logged() -> None:
+                try:
+                    run()
+                except Exception as e:
+                    logger.error(str(e))
+            threading.Thread(target=run_logged, daemon=True).start()
+        else:
+            run()
@@ -0,0 +1,190 @@
+"""
+Дедупликация полных бэкапов жесткими ссылками.
+
+После создания полного бэкапа его файлы сопоставляются по контрольным
+суммам из манифеста .backup с общим хранилищем по содержимому
+(DEDUP_STORE_DIR, по умолчанию BACKUP_DIR/.store). Новое содержимое
+добавляется в хранилище жесткой ссылкой без копирования, а файл,
+содержимое которого уже есть в хранилище, заменяется ссылкой на него.
+Неизмененные куски последовательных полных бэкапов занимают место один раз.
+
+Ссылки бэкапов на объекты хранилища учитываются в таблице store_refs;
+объект удаляется из хранилища, когда удален последний ссылающийся бэкап.
+Хранилище должно находиться на той же файловой системе, что и бэкапы.
+"""
+import os
+import threading
+import xml.etree.ElementTree as ET
+from typing import Any, Dict, List, Optional
+
+from backup_catalog import MANIFEST_NAME
+from environments import DEDUP_STORE_DIR
+from logger import logger
+from transfer import parse_file_destination
+from worker import BackupManager
+
+# Размер пакета ключей в запросах IN (...) к SQLite
+KEY_BATCH_SIZE = 500
+
+
+def manifest_files(backup_path: str) -> List[Dict[str, Any]]:
+    """
+    Возвращает файлы бэкапа, записанные в его каталог: имя файла на диске,
+    размер и контрольную сумму. Файлы из базового бэкапа пропускаются.
+    """
+    root = ET.parse(os.path.join(backup_path, MANIFEST_NAME)).getroot()
+    files = []
+    seen = set()
+    contents = root.find("contents")
+    if contents is None:
+        return files
+    for file_info in contents.iter("file"):
+        size = int(file_info.findtext("size") or 0)
+        checksum = file_info.findtext("checksum")
+        if not checksum or size == 0 or (file_info.findtext("use_base") or "false") == "true":
+            continue
+        # При deduplicate_files одинаковые файлы бэкапа хранятся один раз (data_file)
+        name = file_info.findtext("data_file") or file_info.findtext("name")
+        if name in seen:
+            continue
+        seen.add(name)
+        files.append({"name": name, "size": size, "checksum": checksum})
+    return files
+
+
+class ContentStore:
+    def __init__(self, manager: BackupManager, store_dir: str = DEDUP_STORE_DIR):
+        self.pool = manager.pool
+        self.store_dir = store_dir
+        # Связывание файлов и освобождение объектов не должны пересекаться
+        self._lock = threading.Lock()
+        self._init_db()
+
+    def _init_db(self):
+        conn = self.pool.get_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS store_refs (
+                    object TEXT NOT NULL,
+                    backup_id TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    PRIMARY KEY (object, backup_id)
+                )
+            ''')
+            cursor.execute("CREATE INDEX IF NOT EXISTS store_refs_backup ON store_refs (backup_id)")
+            conn.commit()
+        finally:
+            self.pool.return_connection(conn)
+
+    def _object_path(self, key: str) -> str:
+        return os.path.join(self.store_dir, key[:2], key)
+
+    def deduplicate(self, backup_id: str, backup_path: str) -> Dict[str, int]:
+        """
+        Заменяет файлы бэкапа жесткими ссылками на объекты хранилища.
+        Ключ объекта - контрольная сумма ClickHouse и размер файла.
+        """
+        files = [
+            {**f, "path": os.path.join(backup_path, f["name"]), "key": f"{f['checksum']}_{f['size']}"}
+            for f in manifest_files(backup_path)
+        ]
+        files = [f for f in files if os.path.isfile(f["path"]) and os.path.getsize(f["path"]) == f["size"]]
+        stats = {"files": len(files), "stored": 0, "linked": 0, "saved_bytes": 0}
+
+        with self._lock:
+            conn = self.pool.get_connection()
+            try:
+                # Ссылки записываются до связывания: объект не будет освобожден, пока на него ссылаются
+                conn.executemany(
+                    "INSERT OR IGNORE INTO store_refs (object, backup_id, size) VALUES (?, ?, ?)",
+                    [(f["key"], backup_id, f["size"]) for f in files]
+                )
+                conn.commit()
+            finally:
+                self.pool.return_connection(conn)
+
+            for f in files:
+                object_path = self._object_path(f["key"])
+                if not os.path.exists(object_path):
+                    os.makedirs(os.path.dirname(object_path), exist_ok=True)
+                    os.link(f["path"], object_path)
+                    stats["stored"] += 1
+                    continue
+                if os.path.samefile(object_path, f["path"]):
+                    continue
+                temp_path = f"{f['path']}.dedup"
+                os.link(object_path, temp_path)
+                os.replace(temp_path, f["path"])
+                stats["linked"] += 1
+                stats["saved_bytes"] += f["size"]
+
+        logger.debug(f"Дедупликация бэкапа {backup_id}: {stats}")
+        return stats
+
+    def process_backup(self, backup: Dict[str, Any]) -> Optional[Dict[str, int]]:
+        """Постобработчик ClickHouseBackup: дедуплицирует локальные полные бэкапы"""
+        path = parse_file_destination(backup["destination"])
+        if backup["type"] != "full" or backup.get("cluster") or not path:
+            return None
+        if not os.path.exists(os.path.join(path, MANIFEST_NAME)):
+            logger.debug(f"Бэкап {backup['id']} недоступен локально, дедупликация пропущена")
+            return None
+        return self.deduplicate(backup["id"], path)
+
+    def release(self, backup_id: str) -> int:
+        """
+        Снимает ссылки бэкапа и удаляет объекты, на которые больше никто не ссылается.
+        Возвращает освобожденный объем в байтах.
+        """
+        freed = 0
+        with self._lock:
+            conn = self.pool.get_connection()
+            try:
+                objects = {
+                    row["object"]: row["size"]
+                    for row in conn.execute("SELECT object, size FROM store_refs WHERE backup_id = ?", (backup_id,))
+                }
+                conn.execute("DELETE FROM store_refs WHERE backup_id = ?", (backup_id,))
+                keys = list(objects)
+                for i in range(0, len(keys), KEY_BATCH_SIZE):
+                    batch = keys[i:i + KEY_BATCH_SIZE]
+                    rows = conn.execute(
+                        f"SELECT DISTINCT object FROM store_refs WHERE object IN ({', '.join('?' for _ in batch)})",
+                        batch
+                    )
+                    for row in rows:
+                        objects.pop(row["object"], None)
+                conn.commit()
+            finally:
+                self.pool.return_connection(conn)
+
+            for key, size in objects.items():
+                object_path = self._object_path(key)
+                if os.path.exists(object_path):
+                    os.remove(object_path)
+                    freed += size
+
+        if objects:
+            logger.debug(f"Освобождено объектов хранилища: {len(objects)} ({freed} байт) после удаления {backup_id}")
+        return freed
+
+    def stats(self) -> Dict[str, int]:
+        """Объем хранилища и суммарный объем ссылающихся на него файлов"""
+        conn = self.pool.get_connection()
+        try:
+            row = conn.execute('''
+                SELECT COUNT(DISTINCT object) AS objects, COUNT(*) AS refs, COALESCE(SUM(size), 0) AS referenced_bytes
+                FROM store_refs
+            ''').fetchone()
+            stored = conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM (SELECT DISTINCT object, size FROM store_refs)"
+            ).fetchone()[0]
+        finally:
+            self.pool.return_connection(conn)
+        return {
+            "objects": row["objects"],
+            "refs": row["refs"],
+            "stored_bytes": stored,
+            "referenced_bytes": row["referenced_bytes"],
+        }
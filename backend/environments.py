@@ -6,6 +6,45 @@ CLICKHOUSE_PORT = int(os.getenv('CLICKHOUSE_PORT', 9000))
 CLICKHOUSE_USER = os.getenv('CLICKHOUSE_USER', 'admin')
 CLICKHOUSE_PASSWORD = os.getenv('CLICKHOUSE_PASSWORD', 'password')
 CLICKHOUSE_DB = os.getenv('CLICKHOUSE_DB', 'mydb')
+# Имя кластера из system.clusters для бэкапов по шардам (пусто - отключено)
+CLICKHOUSE_CLUSTER = os.getenv('CLICKHOUSE_CLUSTER', '')
 BACKUP_DIR = os.getenv("BACKUP_STORAGE", "/backups")
 
 BACKUP_META_DB = os.path.join(BACKUP_DIR, "backups.db")
+UPLOAD_DIR = os.path.join(BACKUP_DIR, ".uploads")
+
+# Дедупликация полных бэкапов жесткими ссылками на общее хранилище по содержимому
+DEDUP_ENABLED = os.getenv('DEDUP_ENABLED', 'false') == 'true'
+DEDUP_STORE_DIR = os.getenv('DEDUP_STORE_DIR', os.path.join(BACKUP_DIR, ".store"))
+
+# Репликация бэкапов на второй уровень хранения (пусто - отключена)
+REPLICA_DIR = os.getenv('REPLICA_DIR', '')
+REPLICATION_WORKERS = int(os.getenv('REPLICATION_WORKERS', 4))
+REPLICATION_BANDWIDTH = int(os.getenv('REPLICATION_BANDWIDTH', 0))
+# Сколько новейших реплицированных бэкапов базы хранить на быстром уровне (0 - все)
+FAST_TIER_KEEP = int(os.getenv('FAST_TIER_KEEP', 0))
+# Сколько секунд после возврата на быстрый уровень бэкап не удаляется политикой хранения (его читают)
+READ_LEASE_SEC = float(os.getenv('READ_LEASE_SEC', 6 * 3600))
+
+# Время жизни кэша каталога баз и таблиц (устаревший снимок обновляется в фоне)
+SCHEMA_CACHE_TTL_SEC = float(os.getenv('SCHEMA_CACHE_TTL_SEC', 30))
+
+# Проверка готовности: период проверок и предельная задержка между попытками подключения к ClickHouse
+HEALTH_CHECK_SEC = float(os.getenv('HEALTH_CHECK_SEC', 10))
+CLICKHOUSE_RETRY_MAX_SEC = float(os.getenv('CLICKHOUSE_RETRY_MAX_SEC', 30))
+
+# Троттлинг бэкапов по нагрузке ClickHouse (по умолчанию выключен)
+THROTTLE_ENABLED = os.getenv('THROTTLE_ENABLED', 'false') == 'true'
+THROTTLE_SAMPLE_SEC = float(os.getenv('THROTTLE_SAMPLE_SEC', 5))
+THROTTLE_MAX_QUERY_ELAPSED_SEC = float(os.getenv('THROTTLE_MAX_QUERY_ELAPSED_SEC', 300))
+THROTTLE_MAX_RUNNING_QUERIES = int(os.getenv('THROTTLE_MAX_RUNNING_QUERIES', 50))
+THROTTLE_MAX_IO_WAIT = float(os.getenv('THROTTLE_MAX_IO_WAIT', 0.3))
+THROTTLE_MAX_CPU = float(os.getenv('THROTTLE_MAX_CPU', 0.85))
+THROTTLE_MAX_DELAY_SEC = float(os.getenv('THROTTLE_MAX_DELAY_SEC', 600))
+THROTTLE_BACKUP_BANDWIDTH = int(os.getenv('THROTTLE_BACKUP_BANDWIDTH', 50 * 1024 * 1024))
+
+# Очередь задач: API ставит задачи, выполняет их job_runner.py
+JOB_QUEUE_ENABLED = os.getenv('JOB_QUEUE_ENABLED', 'false') == 'true'
+JOB_LEASE_SEC = float(os.getenv('JOB_LEASE_SEC', 60))
+JOB_POLL_SEC = float(os.getenv('JOB_POLL_SEC', 1))
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', 3))
@@ -0,0 +1,179 @@
+"""
+Исполнитель очереди задач.
+
+Запускается отдельным процессом (в любом числе экземпляров):
+    python job_runner.py
+"""
+import os
+import signal
+import socket
+import threading
+import uuid
+from typing import Any, Dict, Optional
+
+from cluster import ShardedBackup
+from dedup import ContentStore
+from environments import (
+    CLICKHOUSE_CLUSTER,
+    CLICKHOUSE_DB,
+    CLICKHOUSE_HOST,
+    CLICKHOUSE_PASSWORD,
+    CLICKHOUSE_PORT,
+    CLICKHOUSE_USER,
+    DEDUP_ENABLED,
+    JOB_POLL_SEC,
+    REPLICA_DIR,
+)
+from jobs import JobQueue
+from logger import log_context, logger
+from replication import Replicator
+from transfer import parse_file_destination
+from worker import ClickHouseBackup
+
+
+def attempt_destination(destination: str, attempt: int) -> str:
+    """
+    Destination попытки задачи: повтор пишет в новый каталог, а не туда,
+    где остался бэкап проваленной попытки (и его запись в каталоге).
+    """
+    path = parse_file_destination(destination)
+    if attempt <= 1 or path is None:
+        return destination
+    return f"File('{path}_attempt{attempt}')"
+
+
+class JobRunner:
+    def __init__(self, chb: ClickHouseBackup, queue: JobQueue, owner: Optional[str] = None,
+                 poll_sec: float = JOB_POLL_SEC, sharded: Optional[ShardedBackup] = None):
+        self.chb = chb
+        self.sharded = sharded
+        self.queue = queue
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.poll_sec = poll_sec
+        self.stop_event = threading.Event()
+
+    def _heartbeat(self, job_id: str, done: threading.Event) -> None:
+        while not done.wait(self.queue.lease_sec / 3):
+            if not self.queue.heartbeat(job_id, self.owner):
+                logger.warning(f"Аренда задачи {job_id} потеряна исполнителем {self.owner}")
+                return
+
+    def _execute(self, job: Dict[str, Any]) -> Dict[str, Any]:
+        params = job["params"]
+
+        def on_started(op_id: str) -> None:
+            self.queue.set_op_id(job["id"], self.owner, op_id)
+
+        on_cluster = params.get("on_cluster") or params.get("cluster_backup_id")
+        if on_cluster and self.sharded is None:
+            raise ValueError("Задача для кластера, а кластер не настроен (CLICKHOUSE_CLUSTER)")
+
+        if job["op_id"]:
+            # Операция уже запущена предыдущим исполнителем: только дожидаемся ее
+            logger.debug(f"Задача {job['id']}: продолжение отслеживания операции {job['op_id']}")
+            if params.get("on_cluster"):
+                # Для бэкапа кластера op_id - ID логического бэкапа
+                return {"op_id": job["op_id"], "status": self.sharded.resume(job["op_id"])}
+            return {"op_id": job["op_id"], "status": self.chb.resume_operation(job["op_id"])}
+
+        if job["kind"] == "restore" and params.get("cluster_backup_id"):
+            self.sharded.restore(params["database"], params["cluster_backup_id"])
+            return {"status": "RESTORED"}
+
+        if job["kind"] == "restore":
+            self.chb.restore(
+                database=params["database"],
+                source=params["source"],
+                async_mode=True,
+                partitions=params.get("partitions"),
+                on_started=on_started,
+                backup_id=params.get("backup_id")
+            )
+            return {"status": "RESTORED"}
+
+        backup_type = params["backup_type"]
+        common = dict(
+            database=params["database"],
+            destination=attempt_destination(params["destination"], job["attempts"]),
+            async_mode=True,
+            description=params.get("description"),
+            on_started=on_started
+        )
+        if params.get("on_cluster"):
+            self.sharded.backup(base_backup_id=params.get("base_backup_id"), **common)
+        elif backup_type == "full":
+            self.chb.backup_full(**common)
+        elif backup_type == "incremental":
+            self.chb.backup_incremental(base_backup_id=params["base_backup_id"], **common)
+        elif backup_type == "partitions":
+            self.chb.backup_partitions(
+                partitions=params.get("partitions"),
+                tables=params.get("tables"),
+                changed_only=params.get("changed_only", False),
+                **common
+            )
+        else:
+            raise ValueError(f"Неизвестный тип бэкапа: {backup_type}")
+
+        op_id = self.queue.get_job(job["id"])["op_id"]
+        backup = self.chb.meta.get_backup(op_id) if op_id else None
+        return {"op_id": op_id, "status": backup["status"] if backup else None}
+
+    def run_once(self) -> bool:
+        """Выполняет одну задачу. False - очередь пуста"""
+        job = self.queue.claim(self.owner)
+        if job is None:
+            return False
+
+        logger.debug(f"Задача {job['id']} ({job['kind']}) захвачена исполнителем {self.owner}")
+        done = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat, args=(job["id"], done), daemon=True)
+        heartbeat.start()
+        try:
+            with log_context(database=job["params"].get("database")):
+                result = self._execute(job)
+            self.queue.complete(job["id"], self.owner, result)
+            logger.debug(f"Задача {job['id']} выполнена: {result}")
+        except Exception as e:
+            logger.error(f"Ошибка выполнения задачи {job['id']}: {str(e)}")
+            self.queue.fail(job["id"], self.owner, str(e), job["attempts"])
+        finally:
+            done.set()
+            heartbeat.join()
+        return True
+
+    def run_forever(self) -> None:
+        logger.info(f"Исполнитель задач {self.owner} запущен")
+        while not self.stop_event.is_set():
+            if not self.run_once():
+                self.stop_event.wait(self.poll_sec)
+        logger.info(f"Исполнитель задач {self.owner} остановлен")
+
+
+def main() -> None:
+    chb = ClickHouseBackup(
+        host=CLICKHOUSE_HOST,
+        port=CLICKHOUSE_PORT,
+        user=CLICKHOUSE_USER,
+        password=CLICKHOUSE_PASSWORD,
+        database=CLICKHOUSE_DB
+    )
+    content_store = ContentStore(chb.meta) if DEDUP_ENABLED else None
+    if content_store is not None:
+        chb.post_processors.append(content_store.process_backup)
+    if REPLICA_DIR:
+        replicator = Replicator(chb.meta, content_store=content_store)
+        chb.post_processors.append(replicator.process_backup)
+        chb.before_read.append(replicator.ensure_local)
+        replicator.start()
+        replicator.resume_pending()
+    sharded = ShardedBackup(chb, CLICKHOUSE_CLUSTER) if CLICKHOUSE_CLUSTER else None
+    runner = JobRunner(chb, JobQueue(chb.meta), sharded=sharded)
+    # Текущая задача дорабатывается, новые не захватываются
+    signal.signal(signal.SIGTERM, lambda *_: runner.stop_event.set())
+    signal.signal(signal.SIGINT, lambda *_: runner.stop_event.set())
+    runner.run_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+"""
+Персистентная очередь задач в backups.db.
+
+API только ставит задачи в очередь и читает их состояние, а выполняют их
+отдельные процессы job_runner.py. Исполнитель захватывает задачу арендой
+(lease) и продлевает ее heartbeat'ом; задача с истекшей арендой снова
+становится доступной другому исполнителю. ID операции ClickHouse
+сохраняется сразу после запуска, поэтому новый исполнитель продолжает
+отслеживать уже запущенную операцию, а не запускает ее повторно.
+"""
+import json
+import sqlite3
+import time
+import uuid
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from environments import JOB_LEASE_SEC, JOB_MAX_ATTEMPTS
+from logger import logger
+from worker import BackupManager
+
+JOB_KINDS = ("backup", "restore")
+JOB_STATUSES = ("queued", "running", "done", "failed")
+
+
+def _job_to_dict(row: sqlite3.Row) -> Dict[str, Any]:
+    job = dict(row)
+    for key in ("params", "result"):
+        if job.get(key) is not None:
+            job[key] = json.loads(job[key])
+    return job
+
+
+class JobQueue:
+    def __init__(self, manager: BackupManager, lease_sec: float = JOB_LEASE_SEC,
+                 max_attempts: int = JOB_MAX_ATTEMPTS):
+        self.pool = manager.pool
+        self.lease_sec = lease_sec
+        self.max_attempts = max_attempts
+        self._init_db()
+
+    def _init_db(self):
+        conn = self.pool.get_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    params TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    op_id TEXT,
+                    result TEXT,
+                    error TEXT,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    lease_owner TEXT,
+                    lease_expires REAL,
+                    created_at DATETIME NOT NULL,
+                    updated_at DATETIME NOT NULL
+                )
+            ''')
+            cursor.execute("CREATE INDEX IF NOT EXISTS jobs_status_created ON jobs (status, created_at)")
+            conn.commit()
+        finally:
+            self.pool.return_connection(conn)
+
+    def enqueue(self, kind: str, params: Dict[str, Any]) -> Dict[str, Any]:
+        if kind not in JOB_KINDS:
+            raise ValueError(f"Неизвестный тип задачи: {kind}")
+        job_id = str(uuid.uuid4())
+        now = datetime.now().isoformat()
+        conn = self.pool.get_connection()
+        try:
+            conn.execute('''
+                INSERT INTO jobs (id, kind, params, status, created_at, updated_at)
+                VALUES (?, ?, ?, 'queued', ?, ?)
+            ''', (job_id, kind, json.dumps(params), now, now))
+            conn.commit()
+        finally:
+            self.pool.return_connection(conn)
+        logger.debug(f"Задача {job_id} ({kind}) поставлена в очередь")
+        return self.get_job(job_id)
+
+    def claim(self, owner: str) -> Optional[Dict[str, Any]]:
+        """
+        Захватывает самую старую доступную задачу: в очереди или с истекшей арендой.
+        Условие повторяется в UPDATE, поэтому из нескольких процессов задачу
+        получит только один.
+        """
+        conn = self.pool.get_connection()
+        try:
+            now = time.time()
+            candidates = conn.execute('''
+                SELECT id FROM jobs
+                WHERE status = 'queued' OR (status = 'running' AND lease_expires < ?)
+                ORDER BY created_at
+                LIMIT 10
+            ''', (now,)).fetchall()
+            for row in candidates:
+                cursor = conn.execute('''
+                    UPDATE jobs
+                    SET status = 'running', lease_owner = ?, lease_expires = ?,
+                        attempts = attempts + 1, updated_at = ?
+                    WHERE id = ? AND (status = 'queued' OR (status = 'running' AND lease_expires < ?))
+                ''', (owner, now + self.lease_sec, datetime.now().isoformat(), row["id"], now))
+                conn.commit()
+                if cursor.rowcount == 1:
+                    return self.get_job(row["id"])
+            return None
+        finally:
+            self.pool.return_connection(conn)
+
+    def _update_owned(self, job_id: str, owner: str, updates: Dict[str, Any]) -> bool:
+        """Обновляет задачу, только если аренда все еще принадлежит owner"""
+        updates = {**updates, "updated_at": datetime.now().isoformat()}
+        set_clause = ", ".join(f"{key} = ?" for key in updates)
+        conn = self.pool.get_connection()
+        try:
+            cursor = conn.execute(
+                f"UPDATE jobs SET {set_clause} WHERE id = ? AND lease_owner = ? AND status = 'running'",
+                list(updates.values()) + [job_id, owner]
+            )
+            conn.commit()
+            return cursor.rowcount == 1
+        finally:
+            self.pool.return_connection(conn)
+
+    def heartbeat(self, job_id: str, owner: str) -> bool:
+        """Продлевает аренду. False - аренда потеряна (перехвачена другим исполнителем)"""
+        return self._update_owned(job_id, owner, {"lease_expires": time.time() + self.lease_sec})
+
+    def set_op_id(self, job_id: str, owner: str, op_id: str) -> bool:
+        return self._update_owned(job_id, owner, {"op_id": op_id})
+
+    def complete(self, job_id: str, owner: str, result: Dict[str, Any]) -> bool:
+        return self._update_owned(job_id, owner, {
+            "status": "done",
+            "result": json.dumps(result),
+            "lease_owner": None,
+            "lease_expires": None,
+        })
+
+    def fail(self, job_id: str, owner: str, error: str, attempts: int) -> bool:
+        """Возвращает задачу в очередь или окончательно помечает проваленной"""
+        retry = attempts < self.max_attempts
+        # Проваленная операция ClickHouse при повторе запускается заново в новый каталог (attempt_destination)
+        return self._update_owned(job_id, owner, {
+            "status": "queued" if retry else "failed",
+            "error": error,
+            "op_id": None,
+            "lease_owner": None,
+            "lease_expires": None,
+        })
+
+    def get_job(self, job_id: str) -> Optional[Dict[str, Any]]:
+        conn = self.pool.get_connection()
+        try:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            return _job_to_dict(row) if row else None
+        finally:
+            self.pool.return_connection(conn)
+
+    def list_jobs(self, status: Optional[str] = None, limit: int = 100) -> List[Dict[str, Any]]:
+        conn = self.pool.get_connection()
+        try:
+            if status:
+                rows = conn.execute(
+                    "SELECT * FROM jobs WHERE status = ? ORDER BY created_at DESC LIMIT ?", (status, limit)
+                ).fetchall()
+            else:
+                rows = conn.execute("SELECT * FROM jobs ORDER BY created_at DESC LIMIT ?", (limit,)).fetchall()
+            return [_job_to_dict(row) for row in rows]
+        finally:
+            self.pool.return_connection(conn)
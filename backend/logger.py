@@ -1,9 +1,142 @@
+"""
+Логирование backend.
+
+Записи не пишутся в stdout в потоке, который логирует: QueueHandler кладет
+их в ограниченную очередь, а вывод выполняет отдельный поток QueueListener.
+При переполнении очереди (медленный потребитель логов) записи отбрасываются,
+а не блокируют бэкапы; число отброшенных записей попадает в поле dropped
+следующей записи.
+
+По умолчанию вывод - JSON по строке на запись (LOG_FORMAT=json) с полями
+контекста операции op_id и database: они берутся из extra или из
+log_context(), действующего в текущем потоке.
+"""
+import atexit
+import contextvars
+import copy
+import json
 import logging
 import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
 from sys import stdout
+from typing import Any, Dict
 
 CONTAINER_NAME = os.environ.get('HOSTNAME') if 'HOSTNAME' in os.environ.keys() else 'usick.backend_native'
-DEBUG = os.environ.get('DEBUG') == "true" if 'DEBUG' in os.environ.keys() else True
+DEBUG = os.environ.get('DEBUG') == "true"
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json')
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+# Интервал, с которым повторяются одинаковые сообщения опроса статуса операции
+LOG_POLL_SAMPLE_SEC = float(os.environ.get('LOG_POLL_SAMPLE_SEC', 30))
+
+CONTEXT_FIELDS = ("op_id", "database")
+
+_context: contextvars.ContextVar = contextvars.ContextVar("log_context", default={})
+
+
+@contextmanager
+def log_context(**fields: Any):
+    """Добавляет поля (op_id, database) ко всем записям внутри блока"""
+    token = _context.set({**_context.get(), **{k: v for k, v in fields.items() if v is not None}})
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+class ContextFilter(logging.Filter):
+    """Переносит поля log_context() в запись (выполняется в логирующем потоке)"""
+    def filter(self, record: logging.LogRecord) -> bool:
+        for key, value in _context.get().items():
+            if not hasattr(record, key):
+                setattr(record, key, value)
+        return True
+
+
+class DroppingQueueHandler(QueueHandler):
+    """QueueHandler, который не ждет места в очереди, а отбрасывает запись"""
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self._lock_dropped = threading.Lock()
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        with self._lock_dropped:
+            if self.dropped:
+                record.dropped = self.dropped
+            try:
+                self.queue.put_nowait(record)
+            except queue.Full:
+                self.dropped += 1
+                return
+            self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """
+        Как QueueHandler.prepare, но трассировка исключения остается в exc_text,
+        а не дописывается в сообщение: форматтер выводит ее отдельным полем.
+        """
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        # Объекты трассировки не передаются в поток вывода
+        record.exc_info = None
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry: Dict[str, Any] = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "source": f"{record.filename}:{record.funcName}",
+            "message": record.getMessage(),
+        }
+        for key in CONTEXT_FIELDS + ("dropped",):
+            value = getattr(record, key, None)
+            if value is not None:
+                entry[key] = value
+        exc_text = self.formatException(record.exc_info) if record.exc_info else record.exc_text
+        if exc_text:
+            entry["exc_info"] = exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        fields = " ".join(
+            f"{key}={getattr(record, key)}" for key in CONTEXT_FIELDS + ("dropped",)
+            if getattr(record, key, None) is not None
+        )
+        return f"{line} [{fields}]" if fields else line
+
+
+class Sampler:
+    """
+    Пропускает повторяющееся сообщение не чаще раза в interval секунд
+    на ключ; изменившееся значение пропускается сразу.
+    """
+    def __init__(self, interval: float = LOG_POLL_SAMPLE_SEC):
+        self.interval = interval
+        self._last: Dict[Any, Any] = {}
+
+    def should_log(self, key: Any, value: Any = None) -> bool:
+        now = time.monotonic()
+        last = self._last.get(key)
+        if last is not None and last[1] == value and now - last[0] < self.interval:
+            return False
+        self._last[key] = (now, value)
+        return True
+
 
 # Define logger
 logger = logging.getLogger(CONTAINER_NAME)
@@ -13,10 +146,21 @@ if DEBUG:
 else:
     logger.setLevel(logging.INFO)
 
-logFormatter = logging.Formatter\
-("%(name)-12s %(asctime)s %(levelname)-8s %(filename)s:%(funcName)s %(message)s")
+if LOG_FORMAT == "json":
+    logFormatter: logging.Formatter = JsonFormatter()
+else:
+    logFormatter = TextFormatter("%(name)-12s %(asctime)s %(levelname)-8s %(filename)s:%(funcName)s %(message)s")
 
 consoleHandler = logging.StreamHandler(stdout) #set streamhandler to stdout
 consoleHandler.setFormatter(logFormatter)
 
-logger.addHandler(consoleHandler)
+logQueue: "queue.Queue[logging.LogRecord]" = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+queueHandler = DroppingQueueHandler(logQueue)
+queueHandler.addFilter(ContextFilter())
+logger.addHandler(queueHandler)
+
+listener = QueueListener(logQueue, consoleHandler, respect_handler_level=True)
+listener.start()
+# Оставшиеся в очереди записи выводятся при завершении процесса
+atexit.register(listener.stop)
+
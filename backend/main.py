@@ -1,19 +1,35 @@
+import time
+
+# Начало холодного старта: в него входит и импорт зависимостей
+STARTED_AT = time.monotonic()
+
 import shutil
-from typing import List, Optional
-from fastapi import FastAPI, HTTPException, Query
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional
+from fastapi import FastAPI, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from starlette.concurrency import run_in_threadpool
 import os
 from datetime import datetime
 
 from pydantic import BaseModel, constr
 
-from validation import validate_backup_identifier, validate_identifier
+from analytics import OPERATION_KINDS, database_analytics
+from backup_catalog import export_catalog, import_catalog, rebuild_catalog
+from cluster import ShardedBackup
+from dedup import ContentStore
+from jobs import JOB_STATUSES, JobQueue
+from readiness import Readiness
+from replication import Replicator
+from schema_cache import SchemaCache
+from transfer import BackupArchive, UploadStore, parse_file_destination, parse_range, register_uploaded_backup
+from validation import validate_backup_identifier, validate_identifier, validate_partition_id
 from worker import ClickHouseBackup
-from environments import BACKUP_DIR, CLICKHOUSE_HOST, CLICKHOUSE_PORT, CLICKHOUSE_USER, CLICKHOUSE_PASSWORD, CLICKHOUSE_DB
+from environments import BACKUP_DIR, CLICKHOUSE_HOST, CLICKHOUSE_PORT, CLICKHOUSE_USER, CLICKHOUSE_PASSWORD, CLICKHOUSE_DB, CLICKHOUSE_CLUSTER, DEDUP_ENABLED, JOB_QUEUE_ENABLED, REPLICA_DIR
 
 
-app = FastAPI(title="ClickHouse Backup Manager API")
-
+# Соединение с ClickHouse устанавливается при первом запросе: импорт не ждет ClickHouse
 chb = ClickHouseBackup(
     host=CLICKHOUSE_HOST,
     port=CLICKHOUSE_PORT,
@@ -22,6 +38,37 @@ chb = ClickHouseBackup(
     database=CLICKHOUSE_DB
 )
 
+sharded = ShardedBackup(chb, CLICKHOUSE_CLUSTER) if CLICKHOUSE_CLUSTER else None
+job_queue = JobQueue(chb.meta)
+content_store = ContentStore(chb.meta)
+if DEDUP_ENABLED:
+    chb.post_processors.append(content_store.process_backup)
+replicator = None
+if REPLICA_DIR:
+    # Репликация после дедупликации: копируется уже связанный каталог
+    replicator = Replicator(chb.meta, content_store=content_store if DEDUP_ENABLED else None)
+    chb.post_processors.append(replicator.process_backup)
+    chb.before_read.append(replicator.ensure_local)
+    replicator.start()
+    replicator.resume_pending()
+uploads = UploadStore()
+schema_cache = SchemaCache(chb.make_client, generation=chb.meta.get_schema_generation)
+chb.schema_listeners.append(schema_cache.invalidate)
+chb.post_processors.append(lambda backup: schema_cache.invalidate(backup["database"]))
+readiness = Readiness(chb, STARTED_AT, schema_cache=schema_cache, sharded=sharded,
+                      resume_operations=not JOB_QUEUE_ENABLED)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Прогрев идет в фоне: запросы обслуживаются сразу, готовность - по /readyz
+    readiness.start()
+    yield
+    readiness.stop()
+
+
+app = FastAPI(title="ClickHouse Backup Manager API", lifespan=lifespan)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -29,14 +76,33 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+def _on_own_client(method: str, **kwargs):
+    """
+    Выполняет операцию ClickHouseBackup на отдельном соединении. Вызывается
+    через run_in_threadpool: ожидание троттлинга и синхронных операций
+    не блокирует event loop, а Client не делится между потоками.
+    """
+    worker = chb.own_client()
+    try:
+        return getattr(worker, method)(**kwargs)
+    finally:
+        worker.client.disconnect()
+
 # --- Pydantic модели для запросов и ответов --- #
 
 class BackupCreateRequest(BaseModel):
     database: str
-    backup_type: str = "full"  # full или incremental
+    backup_type: str = "full"  # full, incremental или partitions
     base_backup_id: Optional[str] = None  # для incremental
     async_mode: bool = False
     description: Optional[str] = None
+    # Для partitions: таблицы, явный список партиций (null - таблица целиком)
+    # или только партиции, измененные после последнего бэкапа
+    tables: Optional[List[str]] = None
+    partitions: Optional[Dict[str, Optional[List[str]]]] = None
+    changed_only: bool = False
+    # Бэкап всех шардов кластера CLICKHOUSE_CLUSTER (full или incremental)
+    on_cluster: bool = False
 
 class BackupRestoreRequest(BaseModel):
     database: str
@@ -52,54 +118,190 @@ class BackupInfo(BaseModel):
     status: str
     size: Optional[int] = None
     description: Optional[str] = None
+    partitions: Optional[Dict[str, Optional[List[str]]]] = None
+    snapshot_time: Optional[str] = None
+    cluster: Optional[str] = None
+
+class ShardInfo(BaseModel):
+    shard_num: int
+    host: str
+    port: int
+    destination: str
+    op_id: Optional[str] = None
+    status: str
+    size: Optional[int] = None
+    error: Optional[str] = None
+
+class DatabaseInfo(BaseModel):
+    name: str
+    tables: int
+    rows: int
+    size: int
+
+class TableInfo(BaseModel):
+    name: str
+    engine: str
+    rows: int
+    size: int
+    parts: int
 
 # --- Эндпоинты --- #
 
+@app.get("/healthz")
+async def healthz():
+    """
+    Проверка жизни процесса: состояние метаданных, ClickHouse, опросчика и время холодного старта.
+    """
+    return readiness.health()
+
+@app.get("/readyz")
+async def readyz():
+    """
+    Проверка готовности: 503, пока недоступны метаданные или ClickHouse или не запущен опросчик.
+    """
+    health = readiness.health()
+    return JSONResponse(status_code=200 if health["ready"] else 503, content=health)
+
 @app.get("/api/databases", response_model=List[str])
 async def list_databases():
     """
-    Получить список баз данных ClickHouse.
+    Получить список баз данных ClickHouse (из кэша каталога).
     """
-    return chb.list_databases()
+    # Холодный кэш загружается из ClickHouse - не в цикле событий
+    return await run_in_threadpool(schema_cache.list_databases)
+
+@app.get("/api/databases/summary", response_model=List[DatabaseInfo])
+async def database_summary():
+    """
+    Получить базы данных с числом таблиц, строк и размером на диске (из кэша каталога).
+    """
+    # Холодный кэш загружается из ClickHouse - не в цикле событий
+    return await run_in_threadpool(schema_cache.database_summary)
+
+@app.get("/api/databases/{database}/tables", response_model=List[TableInfo])
+async def list_tables(database: str):
+    """
+    Получить таблицы базы с движком, числом строк, размером и числом кусков (из кэша каталога).
+    """
+    validate_identifier(database)
+    # Холодный кэш загружается из ClickHouse - не в цикле событий
+    return await run_in_threadpool(schema_cache.get_tables, database)
 
 @app.get("/api/backups", response_model=List[BackupInfo])
-async def list_backups(database: Optional[str] = Query(None, description="Фильтр по базе")):
+async def list_backups(
+    database: Optional[str] = Query(None, description="Фильтр по базе"),
+    limit: Optional[int] = Query(None, ge=1, le=10000, description="Размер страницы"),
+    offset: int = Query(0, ge=0, description="Смещение страницы"),
+    order: str = Query("asc", pattern="^(asc|desc)$", description="desc - сначала новые")
+):
     """
-    Получить список бэкапов, опционально отфильтрованных по базе.
+    Получить список бэкапов в порядке создания, опционально отфильтрованных по базе и постранично.
     """
     validate_identifier(database)
     
-    backups = chb.meta.list_backups(database)
+    backups = chb.meta.list_backups(database, limit, offset, newest_first=order == "desc")
     return backups
 
+@app.get("/api/backups/{backup_id}", response_model=BackupInfo)
+async def get_backup(backup_id: str):
+    """
+    Получить бэкап по ID (для обновления отдельной строки списка).
+    """
+    validate_backup_identifier(backup_id)
+
+    backup = chb.meta.get_backup(backup_id)
+    if not backup:
+        raise HTTPException(status_code=404, detail=f"Бэкап с ID {backup_id} не найден")
+    return backup
+
 @app.post("/api/backups", response_model=BackupInfo)
 async def create_backup(req: BackupCreateRequest):
     """
-    Создать бэкап (full или incremental).
+    Создать бэкап (full, incremental или partitions).
+    При включенной очереди задач бэкап ставится в очередь (ответ 202 с задачей).
     """
     validate_identifier(req.database)
     validate_identifier(req.backup_type)
 
-    if req.backup_type not in ("full", "incremental"):
-        raise HTTPException(status_code=400, detail="backup_type должен быть 'full' или 'incremental'")
+    if req.backup_type not in ("full", "incremental", "partitions"):
+        raise HTTPException(status_code=400, detail="backup_type должен быть 'full', 'incremental' или 'partitions'")
+    if req.backup_type == "incremental" and not req.base_backup_id:
+        raise HTTPException(status_code=400, detail="base_backup_id обязателен для incremental бэкапа")
+    if req.backup_type == "partitions":
+        if not (req.tables or req.partitions or req.changed_only):
+            raise HTTPException(status_code=400, detail="Для partitions бэкапа нужны tables, partitions или changed_only")
+        for table in (req.tables or []) + list((req.partitions or {}).keys()):
+            validate_identifier(table)
+        for partition_ids in (req.partitions or {}).values():
+            for partition_id in partition_ids or []:
+                validate_partition_id(partition_id)
+    if req.on_cluster:
+        if sharded is None:
+            raise HTTPException(status_code=400, detail="Кластер не настроен (CLICKHOUSE_CLUSTER)")
+        if req.backup_type == "partitions":
+            raise HTTPException(status_code=400, detail="Бэкап кластера поддерживает только full и incremental")
     
     # Автоматически генерируем путь для бэкапа
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     backup_path = os.path.join(BACKUP_DIR, req.database, req.backup_type, f"backup_{timestamp}")
     destination = f"File('{backup_path}')"
 
-    if req.backup_type == "full":
-        chb.backup_full(
+    if JOB_QUEUE_ENABLED:
+        if req.backup_type == "incremental" and not chb.meta.get_backup(req.base_backup_id):
+            raise HTTPException(status_code=404, detail=f"Базовый бэкап {req.base_backup_id} не найден")
+        job = job_queue.enqueue("backup", {
+            "backup_type": req.backup_type,
+            "database": req.database,
+            "destination": destination,
+            "base_backup_id": req.base_backup_id,
+            "description": req.description,
+            "tables": req.tables,
+            "partitions": req.partitions,
+            "changed_only": req.changed_only,
+            "on_cluster": req.on_cluster,
+        })
+        return JSONResponse(status_code=202, content=job)
+
+    if req.on_cluster:
+        try:
+            backup_id = await run_in_threadpool(
+                sharded.backup,
+                database=req.database,
+                destination=destination,
+                base_backup_id=req.base_backup_id,
+                async_mode=req.async_mode,
+                description=req.description
+            )
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        except RuntimeError as e:
+            raise HTTPException(status_code=500, detail=str(e))
+        return chb.meta.get_backup(backup_id)
+    elif req.backup_type == "full":
+        await run_in_threadpool(
+            _on_own_client, "backup_full",
             database=req.database,
             destination=destination,
             async_mode=req.async_mode,
             description=req.description
         )
+    elif req.backup_type == "partitions":
+        try:
+            await run_in_threadpool(
+                _on_own_client, "backup_partitions",
+                database=req.database,
+                destination=destination,
+                partitions=req.partitions,
+                tables=req.tables,
+                changed_only=req.changed_only,
+                async_mode=req.async_mode,
+                description=req.description
+            )
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
     else:
-        if not req.base_backup_id:
-            raise HTTPException(status_code=400, detail="base_backup_id обязателен для incremental бэкапа")
-
-        chb.backup_incremental(
+        await run_in_threadpool(
+            _on_own_client, "backup_incremental",
             database=req.database,
             destination=destination,
             base_backup_id=req.base_backup_id,
@@ -129,12 +331,31 @@ async def restore_backup(req: BackupRestoreRequest):
     
     # Извлекаем путь из destination
     source = backup_info["destination"]
+    if backup_info.get("cluster") and sharded is None:
+        raise HTTPException(status_code=400, detail="Бэкап кластера, а кластер не настроен (CLICKHOUSE_CLUSTER)")
+
+    if JOB_QUEUE_ENABLED:
+        job = job_queue.enqueue("restore", {
+            "database": req.database,
+            "source": source,
+            "partitions": backup_info.get("partitions"),
+            "backup_id": req.backup_id,
+            "cluster_backup_id": req.backup_id if backup_info.get("cluster") else None,
+        })
+        return JSONResponse(status_code=202, content={"status": "restoration_queued", "job_id": job["id"]})
 
     try:
-        chb.restore(
+        if backup_info.get("cluster"):
+            # Восстановление параллельно на всех шардах
+            await run_in_threadpool(sharded.restore, req.database, req.backup_id, req.async_mode)
+            return {"status": "restoration_started"}
+        await run_in_threadpool(
+            _on_own_client, "restore",
             database=req.database,
             source=source,
-            async_mode=req.async_mode
+            async_mode=req.async_mode,
+            partitions=backup_info.get("partitions"),
+            backup_id=req.backup_id
         )
         return {"status": "restoration_started"}
     except Exception as e:
@@ -143,6 +364,17 @@ async def restore_backup(req: BackupRestoreRequest):
             detail=f"Ошибка восстановления: {str(e)}"
         )
 
+@app.get("/api/backups/{backup_id}/shards", response_model=List[ShardInfo])
+async def list_backup_shards(backup_id: str):
+    """
+    Получить операции шардов бэкапа кластера.
+    """
+    validate_backup_identifier(backup_id)
+
+    if not chb.meta.get_backup(backup_id):
+        raise HTTPException(status_code=404, detail=f"Бэкап с ID {backup_id} не найден")
+    return chb.meta.list_shards(backup_id)
+
 @app.delete("/api/backups/{backup_id}")
 async def delete_backup(backup_id: str):
     """
@@ -150,6 +382,14 @@ async def delete_backup(backup_id: str):
     """
     validate_backup_identifier(backup_id)
 
+    backup = chb.meta.get_backup(backup_id)
+    if backup and backup.get("cluster"):
+        # Каталоги shard_N лежат на узлах кластера, с хоста API их не удалить
+        raise HTTPException(
+            status_code=400,
+            detail="Удаление бэкапа кластера не поддерживается: каталоги shard_N находятся на узлах кластера"
+        )
+
     # Удаляем из метаданных и получаем информацию о бекапе
     backup_info = chb.meta.remove_backup(backup_id)
     
@@ -161,7 +401,10 @@ async def delete_backup(backup_id: str):
     
     # Извлекаем путь из destination (формат: "File('/path/to/backup')")
     destination = backup_info["destination"]
-    if destination.startswith("File('") and destination.endswith("')"):
+    if chb.meta.list_by_destination(destination):
+        # Каталог записан и другим бэкапом (например, повтором задачи) - его не трогаем
+        result = {"status": "deleted_meta", "detail": f"Каталог {destination} используется другим бэкапом"}
+    elif destination.startswith("File('") and destination.endswith("')"):
         backup_path = destination[6:-2]  # Убираем "File('" и "')"
         
         try:
@@ -169,10 +412,203 @@ async def delete_backup(backup_id: str):
             if os.path.exists(backup_path):
                 # Рекурсивно удаляем директорию
                 shutil.rmtree(backup_path)
-                return {"status": "deleted", "path": backup_path}
+                result = {"status": "deleted", "path": backup_path}
             else:
-                return {"status": "deleted_meta", "detail": f"Физический бэкап не найден: {backup_path}"}
+                result = {"status": "deleted_meta", "detail": f"Физический бэкап не найден: {backup_path}"}
         except Exception as e:
-            return {"status": "deleted_meta", "detail": f"Ошибка удаления физического бэкапа: {str(e)}"}
-    
-    return {"status": "deleted_meta", "detail": "Физическое удаление не поддерживается для этого типа бекапа"}
+            result = {"status": "deleted_meta", "detail": f"Ошибка удаления физического бэкапа: {str(e)}"}
+    else:
+        result = {"status": "deleted_meta", "detail": "Физическое удаление не поддерживается для этого типа бекапа"}
+
+    # Объекты хранилища дедупликации удаляются вместе с последним ссылающимся бэкапом
+    content_store.release(backup_id)
+    if replicator is not None:
+        replicator.remove(backup_id)
+    return result
+
+@app.get("/api/backups/{backup_id}/locations")
+async def list_backup_locations(backup_id: str):
+    """
+    Получить расположение бэкапа на уровнях хранения (fast, replica) и статус копирования.
+    """
+    validate_backup_identifier(backup_id)
+
+    if not chb.meta.get_backup(backup_id):
+        raise HTTPException(status_code=404, detail=f"Бэкап с ID {backup_id} не найден")
+    if replicator is None:
+        return {}
+    return replicator.get_locations(backup_id)
+
+@app.get("/api/analytics/{database}")
+async def operation_analytics(
+    database: str,
+    kind: str = Query("backup", description="backup или restore"),
+    window: int = Query(5, ge=1, le=100, description="Размер окна скользящих средних"),
+    limit: int = Query(100, ge=1, le=10000)
+):
+    """
+    Получить тренды длительности и пропускной способности операций базы и прогноз длительности следующего запуска.
+    """
+    validate_identifier(database)
+    if kind not in OPERATION_KINDS:
+        raise HTTPException(status_code=400, detail="kind должен быть 'backup' или 'restore'")
+
+    return database_analytics(chb.meta, database, kind, window, limit)
+
+@app.get("/api/dedup/stats")
+async def dedup_stats():
+    """
+    Получить объем хранилища дедупликации и объем ссылающихся на него файлов.
+    """
+    return content_store.stats()
+
+@app.get("/api/catalog/export")
+async def export_backup_catalog(database: Optional[str] = Query(None, description="Фильтр по базе")):
+    """
+    Выгрузить каталог бэкапов в формате NDJSON (потоково).
+    """
+    if database is not None:
+        validate_identifier(database)
+
+    return StreamingResponse(export_catalog(chb.meta, database), media_type="application/x-ndjson")
+
+@app.post("/api/catalog/import")
+async def import_backup_catalog(request: Request):
+    """
+    Загрузить каталог бэкапов из NDJSON. Уже известные ID пропускаются.
+    """
+    added = 0
+    lines = []
+    tail = b""
+    try:
+        async for chunk in request.stream():
+            *complete, tail = (tail + chunk).split(b"\n")
+            lines.extend(line.decode() for line in complete)
+            if len(lines) >= 1000:
+                added += await run_in_threadpool(import_catalog, chb.meta, lines)
+                lines = []
+        lines.append(tail.decode())
+        added += await run_in_threadpool(import_catalog, chb.meta, lines)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Ошибка импорта каталога (добавлено {added}): {str(e)}"
+        )
+    return {"status": "imported", "added": added}
+
+@app.post("/api/catalog/rebuild")
+async def rebuild_backup_catalog():
+    """
+    Восстановить каталог сканированием хранилища бэкапов.
+    """
+    return await run_in_threadpool(rebuild_catalog, chb.meta)
+
+@app.get("/api/backups/{backup_id}/download")
+async def download_backup(backup_id: str, request: Request):
+    """
+    Скачать бэкап tar-архивом (потоково, с поддержкой Range для докачки).
+    """
+    validate_backup_identifier(backup_id)
+
+    backup_info = chb.meta.get_backup(backup_id)
+    if not backup_info:
+        raise HTTPException(status_code=404, detail=f"Бэкап с ID {backup_id} не найден")
+    # Бэкап, удаленный с быстрого уровня, возвращается из реплики
+    await run_in_threadpool(chb._prepare_read, backup_id)
+    backup_path = parse_file_destination(backup_info["destination"])
+    if not backup_path or not os.path.isdir(backup_path):
+        raise HTTPException(status_code=404, detail="Физический бэкап не найден")
+
+    arcname = f"{backup_info['database']}/{backup_info['type']}/{os.path.basename(backup_path)}"
+    archive = await run_in_threadpool(BackupArchive, backup_path, arcname)
+    headers = {
+        "Accept-Ranges": "bytes",
+        "ETag": archive.etag,
+        "Content-Disposition": f'attachment; filename="{backup_id}.tar"',
+    }
+
+    byte_range = None
+    if request.headers.get("if-range") in (None, archive.etag):
+        try:
+            byte_range = parse_range(request.headers.get("range"), archive.size)
+        except ValueError:
+            return Response(status_code=416, headers={"Content-Range": f"bytes */{archive.size}"})
+
+    if byte_range is None:
+        headers["Content-Length"] = str(archive.size)
+        return StreamingResponse(archive.iter_range(), media_type="application/x-tar", headers=headers)
+
+    start, end = byte_range
+    headers["Content-Length"] = str(end - start + 1)
+    headers["Content-Range"] = f"bytes {start}-{end}/{archive.size}"
+    return StreamingResponse(archive.iter_range(start, end), status_code=206,
+                             media_type="application/x-tar", headers=headers)
+
+@app.get("/api/uploads/{upload_id}")
+async def get_upload(upload_id: str):
+    """
+    Получить число принятых байт загрузки (для докачки).
+    """
+    validate_backup_identifier(upload_id)
+    return {"upload_id": upload_id, "received": uploads.received(upload_id)}
+
+@app.put("/api/uploads/{upload_id}")
+async def upload_backup_chunk(upload_id: str, request: Request,
+                              offset: int = Query(0, ge=0, description="Смещение части в архиве")):
+    """
+    Загрузить часть tar-архива бэкапа. Части дописываются последовательно,
+    offset должен совпадать с уже принятым размером.
+    """
+    validate_backup_identifier(upload_id)
+    try:
+        received = await uploads.append(upload_id, offset, request.stream())
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return {"upload_id": upload_id, "received": received}
+
+@app.post("/api/uploads/{upload_id}/complete", response_model=BackupInfo)
+async def complete_upload(upload_id: str):
+    """
+    Распаковать загруженный архив в хранилище и зарегистрировать бэкап.
+    """
+    validate_backup_identifier(upload_id)
+    try:
+        backup_path = await run_in_threadpool(uploads.extract, upload_id)
+        return await run_in_threadpool(register_uploaded_backup, chb.meta, backup_path)
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except FileExistsError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except ValueError as e:
+        uploads.discard(upload_id)
+        raise HTTPException(status_code=400, detail=f"Ошибка загрузки бэкапа: {str(e)}")
+
+@app.delete("/api/uploads/{upload_id}")
+async def discard_upload(upload_id: str):
+    """
+    Отменить загрузку и удалить принятые данные.
+    """
+    validate_backup_identifier(upload_id)
+    uploads.discard(upload_id)
+    return {"status": "discarded"}
+
+@app.get("/api/jobs")
+async def list_jobs(status: Optional[str] = Query(None, description="Фильтр по статусу"),
+                    limit: int = Query(100, ge=1, le=1000)):
+    """
+    Получить последние задачи очереди.
+    """
+    if status is not None and status not in JOB_STATUSES:
+        raise HTTPException(status_code=400, detail=f"status должен быть одним из: {', '.join(JOB_STATUSES)}")
+    return job_queue.list_jobs(status, limit)
+
+@app.get("/api/jobs/{job_id}")
+async def get_job(job_id: str):
+    """
+    Получить состояние задачи очереди.
+    """
+    validate_backup_identifier(job_id)
+    job = job_queue.get_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail=f"Задача {job_id} не найдена")
+    return job
@@ -0,0 +1,166 @@
+"""
+Прогрев и готовность backend.
+
+Процесс начинает обслуживать запросы, не дожидаясь ClickHouse: фоновый
+поток проверяет метаданные (SQLite) и ClickHouse с экспоненциальной
+задержкой между попытками, после первого успешного подключения прогревает
+кэш каталога и возобновляет отслеживание операций, не завершенных до
+перезапуска (опросчик). Затем состояние проверяется каждые check_sec.
+
+/healthz отражает то, что процесс жив, /readyz - что он готов принимать
+трафик: метаданные и ClickHouse доступны, опросчик запущен.
+"""
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+from environments import CLICKHOUSE_RETRY_MAX_SEC, HEALTH_CHECK_SEC
+from logger import logger
+from worker import ClickHouseBackup
+
+
+class Readiness:
+    def __init__(self, chb: ClickHouseBackup, started_at: float, schema_cache: Optional[Any] = None,
+                 sharded: Optional[Any] = None, resume_operations: bool = True,
+                 client_factory: Optional[Callable[[], Any]] = None,
+                 check_sec: float = HEALTH_CHECK_SEC, retry_max_sec: float = CLICKHOUSE_RETRY_MAX_SEC):
+        self.chb = chb
+        # time.monotonic() начала импорта приложения - от него считается холодный старт
+        self.started_at = started_at
+        self.schema_cache = schema_cache
+        self.sharded = sharded
+        # При очереди задач незавершенные операции возобновляет job_runner
+        self.resume_operations = resume_operations
+        self.client_factory = client_factory or chb.make_client
+        self.check_sec = check_sec
+        self.retry_max_sec = retry_max_sec
+        self.stop_event = threading.Event()
+        self._client = None
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self.state: Dict[str, Any] = {
+            "metadata": {"ok": False, "error": None},
+            "clickhouse": {"ok": False, "error": None, "attempts": 0},
+            "poller": {"started": False, "resumed": 0, "active": 0},
+            "startup": {"serving_sec": None, "ready_sec": None},
+        }
+
+    def _set(self, section: str, **values: Any) -> None:
+        with self._lock:
+            self.state[section].update(values)
+
+    def check_metadata(self) -> bool:
+        pool = self.chb.meta.pool
+        try:
+            conn = pool.get_connection()
+            try:
+                conn.execute("SELECT 1 FROM backups LIMIT 1").fetchall()
+            finally:
+                pool.return_connection(conn)
+        except Exception as e:
+            self._set("metadata", ok=False, error=str(e))
+            return False
+        self._set("metadata", ok=True, error=None)
+        return True
+
+    def check_clickhouse(self) -> bool:
+        with self._lock:
+            attempts = self.state["clickhouse"]["attempts"] + 1
+            self.state["clickhouse"]["attempts"] = attempts
+        try:
+            if self._client is None:
+                self._client = self.client_factory()
+            self._client.execute("SELECT 1")
+        except Exception as e:
+            if self._client is not None:
+                self._client.disconnect()
+                self._client = None
+            self._set("clickhouse", ok=False, error=str(e))
+            return False
+        self._set("clickhouse", ok=True, error=None)
+        return True
+
+    def _track(self, operation: Dict[str, Any]) -> None:
+        try:
+            backup = self.chb.meta.get_backup(operation["id"])
+            if backup and backup.get("cluster"):
+                if self.sharded is None:
+                    logger.warning(f"Операция кластера {operation['id']} не возобновлена: кластер не настроен")
+                    return
+                self.sharded.resume(operation["id"])
+            else:
+                # Каждая операция отслеживается на своем соединении: Client не потокобезопасен
+                tracker = self.chb.own_client()
+                try:
+                    tracker.resume_operation(operation["id"])
+                finally:
+                    tracker.client.disconnect()
+        except Exception as e:
+            logger.error(f"Ошибка отслеживания операции {operation['id']}: {str(e)}")
+        finally:
+            with self._lock:
+                self.state["poller"]["active"] -= 1
+
+    def resume_in_flight(self) -> int:
+        """Возобновляет отслеживание операций, не завершенных до перезапуска"""
+        operations = self.chb.meta.list_unfinished_operations() if self.resume_operations else []
+        with self._lock:
+            self.state["poller"].update(
+                started=True,
+                resumed=len(operations),
+                active=self.state["poller"]["active"] + len(operations),
+            )
+        for operation in operations:
+            logger.info(f"Возобновлено отслеживание операции {operation['id']} ({operation['kind']})")
+            threading.Thread(target=self._track, args=(operation,), daemon=True).start()
+        return len(operations)
+
+    def _warm_up(self) -> None:
+        if self.schema_cache is not None:
+            try:
+                self.schema_cache.refresh()
+            except Exception as e:
+                logger.error(f"Ошибка прогрева кэша схемы: {str(e)}")
+        self.resume_in_flight()
+        ready_sec = time.monotonic() - self.started_at
+        self._set("startup", ready_sec=ready_sec)
+        logger.info(f"Backend готов за {ready_sec:.2f} с")
+
+    def _run(self) -> None:
+        delay = 1.0
+        warmed = False
+        while not self.stop_event.is_set():
+            self.check_metadata()
+            if self.check_clickhouse():
+                delay = 1.0
+                if not warmed:
+                    self._warm_up()
+                    warmed = True
+                self.stop_event.wait(self.check_sec)
+            else:
+                logger.warning(
+                    f"ClickHouse недоступен ({self.state['clickhouse']['error']}), повтор через {delay:.0f} с"
+                )
+                self.stop_event.wait(delay)
+                delay = min(delay * 2, self.retry_max_sec)
+
+    def start(self) -> None:
+        """Фиксирует время до начала обслуживания запросов и запускает прогрев"""
+        serving_sec = time.monotonic() - self.started_at
+        self._set("startup", serving_sec=serving_sec)
+        logger.info(f"Backend принимает запросы через {serving_sec:.2f} с после запуска")
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        self.stop_event.set()
+
+    def health(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "ready": bool(self.state["metadata"]["ok"] and self.state["clickhouse"]["ok"]
+                              and self.state["poller"]["started"]),
+                "uptime_sec": time.monotonic() - self.started_at,
+                **{section: dict(values) for section, values in self.state.items()},
+            }
@@ -0,0 +1,452 @@
+"""
+Репликация бэкапов на второй уровень хранения.
+
+После того как бэкап достиг BACKUP_CREATED, его каталог копируется
+в фоне в REPLICA_DIR (другой том или локальная замена объектного
+хранилища) с сохранением относительного пути. Файлы копируются
+параллельно через copy_file_range (без копирования через память
+процесса), при его недоступности - через sendfile или pread/pwrite.
+Каждый файл пишется во временный <имя>.part и переименовывается после
+fsync, поэтому прерванная копия продолжается с последнего байта
+недокопированных файлов. Общая скорость ограничивается
+REPLICATION_BANDWIDTH, а прочитанные страницы вытесняются из кэша,
+чтобы копирование не мешало ClickHouse.
+
+По политике хранения на быстром уровне остаются только FAST_TIER_KEEP
+новейших реплицированных бэкапов каждой базы; остальные удаляются
+с /backups и при необходимости (восстановление или базовый бэкап
+для инкрементального) возвращаются из реплики по тому же пути,
+поэтому пути в манифестах ClickHouse остаются верными. Бэкап, который
+читают (восстановление, базовый бэкап, скачивание), получает аренду на
+READ_LEASE_SEC и до ее окончания с быстрого уровня не удаляется.
+Удаление и возврат захватываются атомарным UPDATE в backup_locations,
+поэтому согласованы между API и исполнителями очереди задач.
+Расположение бэкапа на каждом уровне хранится в backup_locations.
+"""
+import errno
+import os
+import queue
+import shutil
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+from environments import (BACKUP_DIR, FAST_TIER_KEEP, READ_LEASE_SEC, REPLICA_DIR, REPLICATION_BANDWIDTH,
+                          REPLICATION_WORKERS)
+from logger import logger
+from transfer import parse_file_destination
+from worker import BackupManager
+
+TIERS = ("fast", "replica")
+COPY_CHUNK = 8 * 1024 * 1024
+# Копирование без обновления прогресса дольше этого считается прерванным
+STALE_SEC = 300
+PROGRESS_INTERVAL_SEC = 5
+# Период проверки бэкапа, который удаляет или возвращает другой процесс
+PROMOTE_POLL_SEC = 1
+
+
+class BandwidthLimiter:
+    """Общий для всех потоков копирования лимит байт в секунду (0 - без ограничения)"""
+    def __init__(self, rate: int):
+        self.rate = rate
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, size: int) -> None:
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + size / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+
+_copy_method = "copy_file_range" if hasattr(os, "copy_file_range") else "sendfile"
+
+
+def _copy_range(src_fd: int, dst_fd: int, offset: int, count: int) -> int:
+    """Копирует count байт со смещения offset в то же смещение назначения"""
+    global _copy_method
+    if _copy_method == "copy_file_range":
+        try:
+            return os.copy_file_range(src_fd, dst_fd, count, offset, offset)
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EPERM):
+                raise
+            logger.debug(f"copy_file_range недоступен ({e.strerror}), используется sendfile")
+            _copy_method = "sendfile"
+    if _copy_method == "sendfile":
+        try:
+            os.lseek(dst_fd, offset, os.SEEK_SET)
+            return os.sendfile(dst_fd, src_fd, offset, count)
+        except OSError as e:
+            if e.errno not in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                raise
+            logger.debug(f"sendfile недоступен ({e.strerror}), используется pread/pwrite")
+            _copy_method = "pread"
+    data = os.pread(src_fd, count, offset)
+    return os.pwrite(dst_fd, data, offset) if data else 0
+
+
+def copy_file(src: str, dst: str, limiter: Optional[BandwidthLimiter] = None) -> int:
+    """
+    Копирует файл с продолжением прерванной копии. Возвращает число
+    скопированных в этом вызове байт (0 - файл уже был скопирован).
+    """
+    size = os.path.getsize(src)
+    if os.path.exists(dst) and os.path.getsize(dst) == size:
+        return 0
+    part = f"{dst}.part"
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+    if offset > size:
+        offset = 0
+
+    copied = 0
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        dst_fd = os.open(part, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(dst_fd, offset)
+            while offset < size:
+                count = min(COPY_CHUNK, size - offset)
+                if limiter:
+                    limiter.consume(count)
+                sent = _copy_range(src_fd, dst_fd, offset, count)
+                if sent == 0:
+                    raise OSError(f"Файл {src} укоротился во время копирования")
+                offset += sent
+                copied += sent
+            os.fsync(dst_fd)
+        finally:
+            os.close(dst_fd)
+        if hasattr(os, "posix_fadvise"):
+            # Прочитанные данные бэкапа не нужны в кэше страниц ClickHouse
+            os.posix_fadvise(src_fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(src_fd)
+    os.replace(part, dst)
+    return copied
+
+
+def list_files(path: str) -> List[str]:
+    """Относительные пути файлов каталога, кроме недокопированных .part"""
+    files = []
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            if not name.endswith(".part"):
+                files.append(os.path.relpath(os.path.join(dirpath, name), path))
+    return files
+
+
+class Replicator:
+    def __init__(self, manager: BackupManager, backup_dir: str = BACKUP_DIR, replica_dir: str = REPLICA_DIR,
+                 workers: int = REPLICATION_WORKERS, bandwidth: int = REPLICATION_BANDWIDTH,
+                 keep_fast: int = FAST_TIER_KEEP, content_store: Optional[Any] = None,
+                 read_lease_sec: float = READ_LEASE_SEC):
+        self.meta = manager
+        self.pool = manager.pool
+        self.backup_dir = backup_dir
+        self.replica_dir = replica_dir
+        self.workers = workers
+        self.keep_fast = keep_fast
+        self.read_lease_sec = read_lease_sec
+        # Хранилище дедупликации: ссылки демотированного бэкапа снимаются
+        self.content_store = content_store
+        self.limiter = BandwidthLimiter(bandwidth)
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.queue: "queue.Queue[str]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._init_db()
+
+    def _init_db(self):
+        conn = self.pool.get_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS backup_locations (
+                    backup_id TEXT NOT NULL,
+                    tier TEXT NOT NULL,
+                    path TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    bytes INTEGER NOT NULL DEFAULT 0,
+                    owner TEXT,
+                    pinned_until REAL NOT NULL DEFAULT 0,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (backup_id, tier)
+                )
+            ''')
+            conn.commit()
+        finally:
+            self.pool.return_connection(conn)
+
+    def _set_location(self, backup_id: str, tier: str, path: str, status: str, bytes_total: int = 0) -> None:
+        conn = self.pool.get_connection()
+        try:
+            conn.execute('''
+                INSERT OR REPLACE INTO backup_locations (backup_id, tier, path, status, bytes, owner, updated_at)
+                VALUES (?, ?, ?, ?, ?, NULL, ?)
+            ''', (backup_id, tier, path, status, bytes_total, time.time()))
+            conn.commit()
+        finally:
+            self.pool.return_connection(conn)
+
+    def _update_location(self, backup_id: str, tier: str, updates: Dict[str, Any]) -> None:
+        updates = {**updates, "updated_at": time.time()}
+        conn = self.pool.get_connection()
+        try:
+            conn.execute(
+                f"UPDATE backup_locations SET {', '.join(f'{key} = ?' for key in updates)} "
+                f"WHERE backup_id = ? AND tier = ?",
+                list(updates.values()) + [backup_id, tier]
+            )
+            conn.commit()
+        finally:
+            self.pool.return_connection(conn)
+
+    def _claim(self, backup_id: str) -> bool:
+        """Захватывает копирование реплики: ожидающей или брошенной другим процессом"""
+        conn = self.pool.get_connection()
+        try:
+            now = time.time()
+            cursor = conn.execute('''
+                UPDATE backup_locations SET status = 'copying', owner = ?, updated_at = ?
+                WHERE backup_id = ? AND tier = 'replica'
+                  AND (status = 'pending' OR (status = 'copying' AND (owner = ? OR updated_at < ?)))
+            ''', (self.owner, now, backup_id, self.owner, now - STALE_SEC))
+            conn.commit()
+            return cursor.rowcount == 1
+        finally:
+            self.pool.return_connection(conn)
+
+    def get_locations(self, backup_id: str) -> Dict[str, Dict[str, Any]]:
+        conn = self.pool.get_connection()
+        try:
+            rows = conn.execute("SELECT * FROM backup_locations WHERE backup_id = ?", (backup_id,)).fetchall()
+            return {row["tier"]: dict(row) for row in rows}
+        finally:
+            self.pool.return_connection(conn)
+
+    def replica_path(self, path: str) -> Optional[str]:
+        """Путь реплики с тем же относительным путем, что и на быстром уровне"""
+        relative = os.path.relpath(path, self.backup_dir)
+        if relative.startswith(".."):
+            return None
+        return os.path.join(self.replica_dir, relative)
+
+    def process_backup(self, backup: Dict[str, Any]) -> None:
+        """Постобработчик ClickHouseBackup: ставит локальный бэкап в очередь репликации"""
+        path = parse_file_destination(backup["destination"])
+        if backup.get("cluster") or not path or not os.path.isdir(path):
+            return
+        replica = self.replica_path(path)
+        if replica is None:
+            logger.warning(f"Бэкап {backup['id']} вне {self.backup_dir}, репликация пропущена")
+            return
+        self._set_location(backup["id"], "fast", path, "ready", backup.get("size") or 0)
+        self._set_location(backup["id"], "replica", replica, "pending")
+        self.queue.put(backup["id"])
+
+    def resume_pending(self) -> int:
+        """Ставит в очередь незавершенные копии (например, после перезапуска)"""
+        conn = self.pool.get_connection()
+        try:
+            rows = conn.execute(
+                "SELECT backup_id FROM backup_locations WHERE tier = 'replica' AND status IN ('pending', 'copying')"
+            ).fetchall()
+        finally:
+            self.pool.return_connection(conn)
+        for row in rows:
+            self.queue.put(row["backup_id"])
+        return len(rows)
+
+    def _copy_tree(self, src: str, dst: str, on_progress=None) -> int:
+        """Параллельно копирует каталог; возвращает общий размер файлов"""
+        files = list_files(src)
+        total = sum(os.path.getsize(os.path.join(src, name)) for name in files)
+        progress = {"bytes": 0, "reported": time.monotonic()}
+        lock = threading.Lock()
+
+        def copy_one(name: str) -> None:
+            copy_file(os.path.join(src, name), os.path.join(dst, name), self.limiter)
+            with lock:
+                progress["bytes"] += os.path.getsize(os.path.join(src, name))
+                if on_progress and time.monotonic() - progress["reported"] >= PROGRESS_INTERVAL_SEC:
+                    progress["reported"] = time.monotonic()
+                    on_progress(progress["bytes"])
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            # Сначала крупные файлы: время копирования меньше зависит от хвоста
+            for future in [executor.submit(copy_one, name) for name in
+                           sorted(files, key=lambda name: -os.path.getsize(os.path.join(src, name)))]:
+                future.result()
+        return total
+
+    def replicate(self, backup_id: str) -> bool:
+        """Копирует бэкап на реплику. False - копия не нужна или уже выполняется другим процессом"""
+        locations = self.get_locations(backup_id)
+        if "replica" not in locations or "fast" not in locations or not self._claim(backup_id):
+            return False
+        src = locations["fast"]["path"]
+        dst = locations["replica"]["path"]
+        started = time.monotonic()
+        try:
+            total = self._copy_tree(
+                src, dst,
+                on_progress=lambda copied: self._update_location(backup_id, "replica", {"bytes": copied})
+            )
+        except Exception as e:
+            logger.error(f"Ошибка репликации бэкапа {backup_id}: {str(e)}")
+            self._update_location(backup_id, "replica", {"status": "failed", "owner": None})
+            return False
+        self._update_location(backup_id, "replica", {"status": "ready", "bytes": total, "owner": None})
+        elapsed = time.monotonic() - started
+        logger.debug(f"Бэкап {backup_id} реплицирован в {dst}: {total} байт за {elapsed:.1f} с")
+        return True
+
+    def apply_retention(self, database: str) -> List[str]:
+        """Удаляет с быстрого уровня реплицированные бэкапы базы сверх FAST_TIER_KEEP новейших"""
+        if not self.keep_fast:
+            return []
+        conn = self.pool.get_connection()
+        try:
+            rows = conn.execute('''
+                SELECT b.id
+                FROM backups b
+                JOIN backup_locations fast ON fast.backup_id = b.id AND fast.tier = 'fast'
+                JOIN backup_locations replica ON replica.backup_id = b.id AND replica.tier = 'replica'
+                WHERE b.database = ? AND fast.status = 'ready' AND replica.status = 'ready'
+                ORDER BY b.timestamp DESC, b.rowid DESC
+                LIMIT -1 OFFSET ?
+            ''', (database, self.keep_fast)).fetchall()
+        finally:
+            self.pool.return_connection(conn)
+        return [row["id"] for row in rows if self.demote(row["id"])]
+
+    def _claim_fast(self, backup_id: str, status: str, condition: str, params: tuple) -> bool:
+        """
+        Атомарно переводит запись быстрого уровня в status при выполнении condition.
+        Переходы захватываются в SQLite: API и исполнители очереди - разные процессы.
+        """
+        conn = self.pool.get_connection()
+        try:
+            cursor = conn.execute(
+                f"UPDATE backup_locations SET status = ?, owner = ?, updated_at = ? "
+                f"WHERE backup_id = ? AND tier = 'fast' AND ({condition})",
+                (status, self.owner, time.time(), backup_id) + params
+            )
+            conn.commit()
+            return cursor.rowcount == 1
+        finally:
+            self.pool.return_connection(conn)
+
+    def demote(self, backup_id: str) -> bool:
+        """Удаляет бэкап с быстрого уровня. False - бэкап не на нем или его читают"""
+        if not self._claim_fast(backup_id, "removing", "status = 'ready' AND pinned_until <= ?", (time.time(),)):
+            return False
+        path = self.get_locations(backup_id)["fast"]["path"]
+        # Переименование мгновенно: возврат из реплики не пересечется с долгим rmtree
+        removing = f"{path}.removing-{uuid.uuid4().hex[:8]}"
+        try:
+            os.rename(path, removing)
+        except FileNotFoundError:
+            removing = None
+        self._update_location(backup_id, "fast", {"status": "removed", "owner": None})
+        if removing:
+            shutil.rmtree(removing, ignore_errors=True)
+        if self.content_store is not None:
+            self.content_store.release(backup_id)
+        logger.debug(f"Бэкап {backup_id} удален с быстрого уровня, остается в реплике")
+        return True
+
+    def _pin(self, backup_id: str) -> None:
+        """Аренда на время чтения: пока она действует, demote бэкап не захватит"""
+        conn = self.pool.get_connection()
+        try:
+            conn.execute(
+                "UPDATE backup_locations SET pinned_until = MAX(pinned_until, ?) WHERE backup_id = ? AND tier = 'fast'",
+                (time.time() + self.read_lease_sec, backup_id)
+            )
+            conn.commit()
+        finally:
+            self.pool.return_connection(conn)
+
+    def ensure_local(self, backup_id: str) -> None:
+        """
+        Возвращает на быстрый уровень бэкап и всю цепочку его базовых бэкапов,
+        если они были удалены политикой хранения, и продлевает их аренду
+        на время чтения.
+        """
+        current = backup_id
+        while current:
+            self._pin(current)
+            self._wait_local(current)
+            backup = self.meta.get_backup(current)
+            current = backup["base_backup"] if backup else None
+
+    def _wait_local(self, backup_id: str) -> None:
+        """Ждет, пока бэкап окажется на быстром уровне, и при необходимости возвращает его сам"""
+        while True:
+            locations = self.get_locations(backup_id)
+            fast = locations.get("fast")
+            if not fast or fast["status"] == "ready":
+                return
+            # Возврат, брошенный упавшим процессом, продолжается после STALE_SEC
+            if self._claim_fast(
+                backup_id, "promoting",
+                "status = 'removed' OR (status IN ('removing', 'promoting') AND updated_at < ?)",
+                (time.time() - STALE_SEC,)
+            ):
+                self._promote(backup_id, fast["path"], locations["replica"]["path"])
+                return
+            # Бэкап удаляет или возвращает другой поток или процесс
+            time.sleep(PROMOTE_POLL_SEC)
+
+    def _promote(self, backup_id: str, fast_path: str, replica_path: str) -> None:
+        logger.debug(f"Возврат бэкапа {backup_id} из реплики на быстрый уровень")
+        try:
+            total = self._copy_tree(
+                replica_path, fast_path,
+                on_progress=lambda copied: self._update_location(backup_id, "fast", {"bytes": copied})
+            )
+        except Exception:
+            self._update_location(backup_id, "fast", {"status": "removed", "owner": None})
+            raise
+        self._update_location(backup_id, "fast", {"status": "ready", "bytes": total, "owner": None})
+
+    def remove(self, backup_id: str) -> None:
+        """Удаляет реплику и записи о расположении удаляемого бэкапа"""
+        replica = self.get_locations(backup_id).get("replica")
+        if replica:
+            shutil.rmtree(replica["path"], ignore_errors=True)
+        conn = self.pool.get_connection()
+        try:
+            conn.execute("DELETE FROM backup_locations WHERE backup_id = ?", (backup_id,))
+            conn.commit()
+        finally:
+            self.pool.return_connection(conn)
+
+    def _run(self) -> None:
+        while True:
+            backup_id = self.queue.get()
+            try:
+                if self.replicate(backup_id):
+                    backup = self.meta.get_backup(backup_id)
+                    if backup:
+                        self.apply_retention(backup["database"])
+            except Exception as e:
+                logger.error(f"Ошибка обработки реплики {backup_id}: {str(e)}")
+            finally:
+                self.queue.task_done()
+
+    def start(self) -> None:
+        """Запускает фоновый поток репликации (один бэкап за раз, файлы - параллельно)"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
@@ -0,0 +1,119 @@
+"""
+Кэш каталога баз и таблиц ClickHouse.
+
+Снимок (базы, таблицы, движки, число строк, размер и число активных
+кусков из system.tables и system.parts) хранится в памяти процесса.
+Чтение не ждет ClickHouse, кроме самого первого: устаревший снимок
+(старше ttl или инвалидированный после бэкапа, восстановления или
+удаления таблиц) отдается сразу, а обновляется в фоне одним потоком.
+Изменения, сделанные другими процессами (исполнителями очереди задач),
+обнаруживаются по счетчику schema_generation в метаданных. Ошибка
+фонового обновления оставляет прежний снимок.
+"""
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from environments import SCHEMA_CACHE_TTL_SEC
+from logger import logger
+
+
+class SchemaCache:
+    def __init__(self, client_factory: Callable[[], Any], ttl: float = SCHEMA_CACHE_TTL_SEC,
+                 generation: Optional[Callable[[], int]] = None):
+        self.client_factory = client_factory
+        self.ttl = ttl
+        # Счетчик изменений схемы, общий для процессов (BackupManager.get_schema_generation)
+        self.generation = generation
+        self._generation: Optional[int] = None
+        self._client = None
+        self._snapshot: Optional[Dict[str, Any]] = None
+        self._expires_at = 0.0
+        self._lock = threading.Lock()
+        # Одновременно выполняется не больше одного обновления
+        self._refresh_lock = threading.Lock()
+        self._refreshing = False
+
+    def _query(self, query: str) -> List[tuple]:
+        if self._client is None:
+            self._client = self.client_factory()
+        try:
+            return self._client.execute(query)
+        except Exception:
+            self._client.disconnect()
+            self._client = None
+            raise
+
+    def _load(self) -> Dict[str, Any]:
+        databases = {row[0]: [] for row in self._query("SHOW DATABASES")}
+        parts = {
+            (database, table): (size, count)
+            for database, table, size, count in self._query(
+                "SELECT database, table, sum(bytes_on_disk), count() FROM system.parts WHERE active GROUP BY database, table"
+            )
+        }
+        for database, name, engine, rows in self._query("SELECT database, name, engine, total_rows FROM system.tables"):
+            size, count = parts.get((database, name), (0, 0))
+            databases.setdefault(database, []).append({
+                "name": name, "engine": engine, "rows": rows or 0, "size": size, "parts": count,
+            })
+        return {
+            "databases": [
+                {
+                    "name": name,
+                    "tables": len(tables),
+                    "rows": sum(table["rows"] for table in tables),
+                    "size": sum(table["size"] for table in tables),
+                }
+                for name, tables in databases.items()
+            ],
+            "tables": {name: sorted(tables, key=lambda table: table["name"]) for name, tables in databases.items()},
+            "refreshed_at": time.time(),
+        }
+
+    def refresh(self) -> Dict[str, Any]:
+        """Загружает снимок из ClickHouse в текущем потоке"""
+        with self._refresh_lock:
+            # Счетчик читается до загрузки: изменение во время нее вызовет следующее обновление
+            generation = self.generation() if self.generation is not None else None
+            snapshot = self._load()
+            with self._lock:
+                self._snapshot = snapshot
+                self._generation = generation
+                self._expires_at = time.monotonic() + self.ttl
+        return snapshot
+
+    def _refresh_in_background(self) -> None:
+        try:
+            self.refresh()
+        except Exception as e:
+            logger.error(f"Ошибка обновления кэша схемы: {str(e)}")
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Текущий снимок; устаревший отдается сразу и обновляется в фоне"""
+        if self.generation is not None and self._snapshot is not None and self.generation() != self._generation:
+            self.invalidate()
+        with self._lock:
+            snapshot = self._snapshot
+            if snapshot is not None and time.monotonic() >= self._expires_at and not self._refreshing:
+                self._refreshing = True
+                threading.Thread(target=self._refresh_in_background, daemon=True).start()
+        return snapshot if snapshot is not None else self.refresh()
+
+    def invalidate(self, database: Optional[str] = None) -> None:
+        """Помечает снимок устаревшим (после изменений, сделанных этим процессом)"""
+        with self._lock:
+            self._expires_at = 0.0
+        logger.debug(f"Кэш схемы инвалидирован ({database or 'все базы'})")
+
+    def list_databases(self) -> List[str]:
+        return [database["name"] for database in self.snapshot()["databases"]]
+
+    def database_summary(self) -> List[Dict[str, Any]]:
+        return self.snapshot()["databases"]
+
+    def get_tables(self, database: str) -> List[Dict[str, Any]]:
+        return self.snapshot()["tables"].get(database, [])
@@ -5,6 +5,9 @@ import os
 from datetime import datetime
 import asyncio
 
+from tests.fake_clickhouse import FakeClickHouseClient, make_chb
+from worker import BackupManager
+
 # Общие настройки
 API_URL = "http://backend:8000/api"
 CLICKHOUSE_HOST = "clickhouse"
@@ -55,3 +58,25 @@ async def api_client():
     """Клиент для работы с API"""
     async with httpx.AsyncClient(base_url=API_URL, timeout=30.0) as client:
         yield client
+
+
+# Модульные тесты без Docker: ClickHouse заменен заглушкой, метаданные - во временном каталоге
+
+@pytest.fixture
+def client():
+    """Заглушка ClickHouse; модули с особыми данными переопределяют этот fixture"""
+    return FakeClickHouseClient(databases={"sales": []})
+
+
+@pytest.fixture
+def chb(client, tmp_path):
+    chb = make_chb(str(tmp_path / "backups.db"), client)
+    yield chb
+    chb.meta.pool.close_all()
+
+
+@pytest.fixture
+def manager(tmp_path):
+    manager = BackupManager(str(tmp_path / "backups.db"))
+    yield manager
+    manager.pool.close_all()
@@ -0,0 +1,179 @@
+import hashlib
+import os
+import re
+import threading
+import uuid
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+from xml.sax.saxutils import escape
+
+from worker import ClickHouseBackup
+
+
+def make_backup_tree(path: str, files: int = 100, file_size: int = 1024, files_per_dir: int = 50,
+                     backup_uuid: Optional[str] = None, base_backup: Optional[str] = None,
+                     base_backup_uuid: Optional[str] = None) -> int:
+    """
+    Создает синтетическое дерево бэкапа с манифестом .backup в формате
+    ClickHouse и возвращает размер файлов данных в байтах.
+    Содержимое файла зависит только от его номера, поэтому деревья разных
+    бэкапов с одинаковым числом файлов совпадают побайтно.
+    """
+    contents = []
+    for i in range(files):
+        name = os.path.join("data", f"part_{i // files_per_dir}", f"column_{i}.bin")
+        payload = (str(i).encode() + b"\0" * file_size)[:file_size]
+        os.makedirs(os.path.join(path, os.path.dirname(name)), exist_ok=True)
+        with open(os.path.join(path, name), "wb") as f:
+            f.write(payload)
+        contents.append(
+            f"<file><name>{name}</name><size>{file_size}</size>"
+            f"<checksum>{hashlib.md5(payload).hexdigest()}</checksum><use_base>false</use_base></file>"
+        )
+
+    base = ""
+    if base_backup:
+        base = f"<base_backup>{escape(base_backup)}</base_backup><base_backup_uuid>{base_backup_uuid}</base_backup_uuid>"
+    with open(os.path.join(path, ".backup"), "w") as f:
+        f.write(
+            f"<config><version>1</version><deduplicate_files>true</deduplicate_files>"
+            f"<timestamp>{datetime.now():%Y-%m-%d %H:%M:%S}</timestamp>"
+            f"<uuid>{backup_uuid or uuid.uuid4()}</uuid>{base}"
+            f"<contents>{''.join(contents)}</contents></config>"
+        )
+    return files * file_size
+
+
+class FakeClickHouseClient:
+    """
+    Заглушка clickhouse_driver.Client для тестов и бенчмарков без Docker.
+
+    Понимает запросы, которые выполняет ClickHouseBackup: BACKUP/RESTORE,
+    опрос system.backups, список баз, таблиц и кусков, метрики нагрузки.
+    Асинхронная операция завершается после polls_to_complete опросов
+    system.backups. Если задан tree_files, BACKUP создает в destination
+    синтетическое дерево файлов с манифестом. Несколько экземпляров
+    изображают узлы кластера: clusters задает строки system.clusters,
+    available=False - недоступную реплику.
+    """
+    def __init__(self, databases: Optional[Dict[str, List[str]]] = None,
+                 polls_to_complete: int = 0, tree_files: int = 0, tree_file_size: int = 1024,
+                 parts: Optional[List[tuple]] = None,
+                 clusters: Optional[Dict[str, List[tuple]]] = None, available: bool = True,
+                 backup_size: int = 0, part_size: int = 1024):
+        self.databases = databases if databases is not None else {"default": [], "system": []}
+        self.polls_to_complete = polls_to_complete
+        self.tree_files = tree_files
+        self.tree_file_size = tree_file_size
+        # Активные куски: (database, table, partition_id, modification_time)
+        self.parts: List[tuple] = parts or []
+        # Имя кластера -> [(shard_num, replica_num, host_name, port)]
+        self.clusters = clusters or {}
+        self.available = available
+        self.disconnects = 0
+        self.backup_size = backup_size
+        self.part_size = part_size
+        self.now = datetime(2024, 1, 1)
+        self.operations: Dict[str, Dict[str, Any]] = {}
+        self.backup_ids: Dict[str, str] = {}
+        self.queries: List[str] = []
+        self._lock = threading.Lock()
+
+    def _start_operation(self, query: str, kind: str) -> List[tuple]:
+        op_id = str(uuid.uuid4())
+        is_async = query.rstrip().endswith("ASYNC")
+        done_status = "BACKUP_CREATED" if kind == "BACKUP" else "RESTORED"
+        running_status = "CREATING_BACKUP" if kind == "BACKUP" else "RESTORING"
+
+        if kind == "BACKUP" and self.tree_files:
+            match = re.search(r"TO (File\('([^']+)'\))", query)
+            base = re.search(r"base_backup = (File\('[^']+'\))", query)
+            if match:
+                base_backup = base.group(1) if base else None
+                make_backup_tree(match.group(2), self.tree_files, self.tree_file_size, backup_uuid=op_id,
+                                 base_backup=base_backup,
+                                 base_backup_uuid=self.backup_ids.get(base_backup))
+                self.backup_ids[match.group(1)] = op_id
+
+        with self._lock:
+            self.operations[op_id] = {
+                "status": running_status if is_async else done_status,
+                "done_status": done_status,
+                "polls_left": self.polls_to_complete,
+                "error": "",
+            }
+            return [(op_id, self.operations[op_id]["status"])]
+
+    def _poll_operation(self, op_id: str) -> List[tuple]:
+        with self._lock:
+            op = self.operations.get(op_id)
+            if op is None:
+                return []
+            if op["polls_left"] > 0:
+                op["polls_left"] -= 1
+            else:
+                op["status"] = op["done_status"]
+            return [(op["status"], op["error"])]
+
+    def execute(self, query: str, params: Optional[Dict[str, Any]] = None,
+                settings: Optional[Dict[str, Any]] = None, **kwargs) -> List[tuple]:
+        if not self.available:
+            raise ConnectionError("Узел недоступен")
+        query = " ".join(query.split())
+        self.queries.append(query)
+        params = params or {}
+
+        if query.startswith("BACKUP "):
+            return self._start_operation(query, "BACKUP")
+        if query.startswith("RESTORE "):
+            return self._start_operation(query, "RESTORE")
+        if query.startswith("SELECT total_size FROM system.backups"):
+            return [(self.backup_size,)] if params["id"] in self.operations else []
+        if "FROM system.backups" in query:
+            return self._poll_operation(params["id"])
+        if query == "SHOW DATABASES":
+            return [(name,) for name in self.databases]
+        if query.startswith("SELECT database, name, engine, total_rows FROM system.tables"):
+            return [(database, name, "MergeTree", 0) for database, tables in self.databases.items() for name in tables]
+        if "FROM system.tables" in query:
+            return [(name,) for name in self.databases.get(params.get("database"), [])]
+        if query == "SELECT 1":
+            return [(1,)]
+        if "FROM system.clusters" in query:
+            rows = sorted(self.clusters.get(params["cluster"], []))
+            return [(shard_num, host, port) for shard_num, _, host, port in rows]
+        if query == "SELECT now()":
+            return [(self.now,)]
+        if query.startswith("SELECT database, table, sum(bytes_on_disk), count() FROM system.parts"):
+            counts: Dict[tuple, int] = {}
+            for database, table, _, _ in self.parts:
+                counts[(database, table)] = counts.get((database, table), 0) + 1
+            return [(database, table, count * self.part_size, count) for (database, table), count in counts.items()]
+        if "FROM system.parts" in query:
+            latest: Dict[tuple, datetime] = {}
+            for database, table, partition_id, modified in self.parts:
+                if database != params["database"] or ("tables" in params and table not in params["tables"]):
+                    continue
+                key = (table, partition_id)
+                latest[key] = max(modified, latest.get(key, modified))
+            return [(table, partition_id, modified) for (table, partition_id), modified in latest.items()]
+        if query.startswith("DROP TABLE") or query.startswith("ALTER TABLE"):
+            return []
+        if "FROM system.metrics" in query:
+            return [(1,)]
+        if "FROM system.processes" in query:
+            return [(0.0,)]
+        if "FROM system.asynchronous_metrics" in query:
+            return []
+        raise NotImplementedError(f"FakeClickHouseClient не поддерживает запрос: {query}")
+
+    def disconnect(self):
+        self.disconnects += 1
+
+
+def make_chb(meta_path: str, client: FakeClickHouseClient) -> ClickHouseBackup:
+    """ClickHouseBackup поверх заглушки, с отключенным ограничением нагрузки"""
+    chb = ClickHouseBackup(meta_path=meta_path)
+    chb.client = client
+    chb.throttle.enabled = False
+    return chb
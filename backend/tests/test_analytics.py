@@ -0,0 +1,108 @@
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+from analytics import database_analytics, operation_trends, predict_duration
+from tests.fake_clickhouse import FakeClickHouseClient
+
+
+def add_run(manager, index, duration, size, op_type="full", status="BACKUP_CREATED", settings=None):
+    started = datetime(2024, 1, 1) + timedelta(days=index)
+    manager.start_operation({
+        "id": f"op-{op_type}-{index}", "kind": "backup", "database": "sales", "type": op_type,
+        "started_at": started.isoformat(), "status": "CREATING_BACKUP", "settings": settings,
+    })
+    conn = manager.pool.get_connection()
+    try:
+        conn.execute(
+            "UPDATE operations SET finished_at = ?, duration_sec = ?, bytes = ?, status = ? WHERE id = ?",
+            ((started + timedelta(seconds=duration)).isoformat(), duration, size, status, f"op-{op_type}-{index}")
+        )
+        conn.commit()
+    finally:
+        manager.pool.return_connection(conn)
+
+
+def test_trends_use_window_per_type(manager):
+    for i in range(6):
+        add_run(manager, i, duration=100, size=1000)
+    add_run(manager, 6, duration=400, size=1000)
+    add_run(manager, 7, duration=10, size=10, op_type="incremental")
+
+    trends = operation_trends(manager, "sales", window=3)
+    assert [trend["id"] for trend in trends[:2]] == ["op-incremental-7", "op-full-6"]
+
+    slow = trends[1]
+    assert slow["throughput"] == 2.5
+    assert slow["prev_throughput"] == 10
+    assert slow["avg_duration"] == pytest.approx(200)
+    assert slow["slow"]
+    assert not any(trend["slow"] for trend in trends[2:])
+    # Окно incremental не смешивается с full
+    assert trends[0]["prev_throughput"] is None
+
+
+def test_prediction_follows_growth(manager):
+    for i, size in enumerate([1000, 1100, 1200, 1300]):
+        add_run(manager, i, duration=size / 10, size=size)
+    add_run(manager, 4, duration=5, size=0, status="BACKUP_FAILED")
+
+    prediction = predict_duration(manager, "sales", operation_type="full", window=4)
+    assert prediction["samples"] == 4
+    assert prediction["expected_bytes"] == 1400
+    assert prediction["predicted_duration_sec"] == pytest.approx(140)
+
+
+    summary = database_analytics(manager, "sales")["summary"]
+    assert summary == [{
+        "type": "full", "runs": 5, "failed": 1, "avg_duration": 115.0,
+        "avg_throughput": 10.0, "last_started_at": "2024-01-05T00:00:00",
+    }]
+
+
+
+def test_throttled_runs_are_excluded_from_prediction(manager):
+    for i in range(3):
+        add_run(manager, i, duration=100, size=1000)
+    # Запуск с ограничением скорости троттлингом медленнее не из-за объема
+    add_run(manager, 3, duration=1000, size=1000, settings={"max_backup_bandwidth": 1})
+
+    assert predict_duration(manager, "sales", operation_type="full")["predicted_duration_sec"] == pytest.approx(100)
+    assert operation_trends(manager, "sales")[0]["settings"] == {"max_backup_bandwidth": 1}
+
+def test_backup_and_restore_are_recorded(chb, tmp_path):
+    chb.client = FakeClickHouseClient(databases={"sales": []}, tree_files=4, tree_file_size=100)
+    destination = f"File('{tmp_path / 'sales' / 'full' / 'backup_1'}')"
+
+    chb.backup_full("sales", destination)
+    backup = chb.meta.list_backups("sales")[-1]
+    operation = chb.meta.get_operation(backup["id"])
+    assert operation["kind"] == "backup" and operation["status"] == "BACKUP_CREATED"
+    assert operation["files"] == 5  # 4 файла данных и манифест
+    assert operation["bytes"] == backup["size"]
+    assert operation["duration_sec"] >= 0 and operation["finished_at"] >= operation["started_at"]
+
+    chb.restore("sales", destination)
+    restore = [op for op in chb.client.operations if op != backup["id"]][0]
+    operation = chb.meta.get_operation(restore)
+    assert operation["kind"] == "restore" and operation["status"] == "RESTORED"
+    assert operation["target"] == destination and operation["bytes"] == backup["size"]
+
+
+def test_async_restore_is_tracked_on_own_client(chb, tmp_path):
+    tracker_client = FakeClickHouseClient()
+    # Второе соединение видит те же операции сервера
+    tracker_client.operations, tracker_client._lock = chb.client.operations, chb.client._lock
+    chb.client_factory = lambda: tracker_client
+
+    chb.restore("sales", f"File('{tmp_path / 'backup'}')", async_mode=True)
+    op_id = next(iter(chb.client.operations))
+    for _ in range(100):
+        if chb.meta.get_operation(op_id)["status"] == "RESTORED":
+            break
+        time.sleep(0.05)
+
+    assert chb.meta.get_operation(op_id)["status"] == "RESTORED"
+    assert not any("system.backups" in query for query in chb.client.queries)
+    assert any("system.backups" in query for query in tracker_client.queries)
@@ -0,0 +1,104 @@
+import json
+import os
+
+import pytest
+
+import backup_catalog
+from backup_catalog import export_catalog, import_catalog, rebuild_catalog
+from tests.fake_clickhouse import make_backup_tree
+from worker import BackupManager
+
+
+@pytest.fixture
+def backup_dir(tmp_path):
+    """Хранилище с цепочкой full -> incremental и одним незавершенным бэкапом"""
+    root = tmp_path / "backups"
+    full_path = root / "sales" / "full" / "backup_20240101_000000"
+    inc_path = root / "sales" / "incremental" / "backup_20240102_000000"
+    make_backup_tree(str(full_path), files=10, file_size=100, backup_uuid="full-1")
+    make_backup_tree(str(inc_path), files=2, file_size=100, backup_uuid="inc-1",
+                     base_backup=f"File('{full_path}')", base_backup_uuid="full-1")
+    os.makedirs(root / "sales" / "full" / "backup_20240103_000000")
+    return root
+
+
+def test_rebuild_recovers_chain(manager, backup_dir):
+    """Каталог восстанавливается по манифестам вместе со ссылками на базовые бэкапы"""
+    result = rebuild_catalog(manager, str(backup_dir))
+    assert result == {"scanned": 3, "found": 2, "added": 2, "skipped": 1}
+
+    full = manager.get_backup("full-1")
+    inc = manager.get_backup("inc-1")
+    assert full["type"] == "full" and full["database"] == "sales"
+    assert full["status"] == "BACKUP_CREATED"
+    assert full["size"] >= 10 * 100
+    assert inc["type"] == "incremental"
+    assert inc["base_backup"] == "full-1"
+    assert inc["destination"] == f"File('{backup_dir}/sales/incremental/backup_20240102_000000')"
+
+    # Зависимости снова защищают базовый бэкап от удаления
+    assert manager.remove_backup("full-1") is None
+
+
+def test_rebuild_is_idempotent(manager, backup_dir):
+    manager.add_backup({
+        "id": "full-1", "database": "sales", "type": "full", "destination": "File('x')",
+        "timestamp": "2024-01-01T00:00:00", "status": "BACKUP_CREATED", "description": "ручной",
+    })
+    assert rebuild_catalog(manager, str(backup_dir))["added"] == 1
+    assert rebuild_catalog(manager, str(backup_dir))["added"] == 0
+    assert manager.get_backup("full-1")["description"] == "ручной"
+
+
+def test_parallel_rebuild(manager, backup_dir, monkeypatch):
+    monkeypatch.setattr(backup_catalog, "PARALLEL_SCAN_THRESHOLD", 1)
+    result = rebuild_catalog(manager, str(backup_dir), workers=2)
+    assert result["added"] == 2
+
+
+def test_export_import_roundtrip(manager, backup_dir, tmp_path):
+    rebuild_catalog(manager, str(backup_dir))
+    lines = list(export_catalog(manager))
+    assert len(lines) == 2
+    assert json.loads(lines[0])["id"] == "full-1"
+
+    target = BackupManager(str(tmp_path / "restored.db"))
+    try:
+        assert import_catalog(target, lines, str(backup_dir)) == 2
+        assert import_catalog(target, lines, str(backup_dir)) == 0
+        assert target.list_backups("sales") == manager.list_backups("sales")
+    finally:
+        target.pool.close_all()
+
+
+def test_import_rejects_incomplete_rows(manager):
+    with pytest.raises(ValueError):
+        import_catalog(manager, ['{"id": "x", "database": "sales"}'])
+    with pytest.raises(ValueError):
+        import_catalog(manager, ["not json"])
+
+
+@pytest.mark.parametrize("changes", [
+    {"destination": "File('/etc')"},
+    {"destination": "File('{root}/sales/full/backup_1') SETTINGS x = 1 --')"},
+    {"destination": "File('{root}/sales/full/../../../etc/backup_1')"},
+    {"destination": "S3('http://host/backup_1')"},
+    {"id": "x'; DROP"},
+    {"base_backup": "../full-1"},
+    {"partitions": {"orders": ["2024' OR 1"]}},
+    {"partitions": {"orders; DROP": None}},
+])
+def test_import_rejects_unsafe_values(manager, tmp_path, changes):
+    root = tmp_path / "backups"
+    backup = {
+        "id": "full-1", "database": "sales", "type": "full", "base_backup": None,
+        "destination": f"File('{root}/sales/full/backup_20240101_000000')",
+        "timestamp": "2024-01-01T00:00:00", "status": "BACKUP_CREATED",
+    }
+    assert import_catalog(manager, [json.dumps(backup)], str(root)) == 1
+
+    unsafe = {**backup, "id": "full-2", **changes}
+    if "destination" in changes:
+        unsafe["destination"] = changes["destination"].format(root=root)
+    with pytest.raises(ValueError):
+        import_catalog(manager, [json.dumps(unsafe)], str(root))
@@ -0,0 +1,120 @@
+import threading
+
+import pytest
+
+from cluster import ShardedBackup
+from tests.fake_clickhouse import FakeClickHouseClient
+
+CLUSTER = {"analytics": [
+    (1, 1, "ch-1a", 9000), (1, 2, "ch-1b", 9000),
+    (2, 1, "ch-2a", 9000), (2, 2, "ch-2b", 9000),
+    (3, 1, "ch-3a", 9000),
+]}
+
+
+class BarrierClient(FakeClickHouseClient):
+    """Узел, который запускает BACKUP/RESTORE, только когда его запустили все шарды"""
+    def __init__(self, barrier: threading.Barrier, **kwargs):
+        super().__init__(**kwargs)
+        self.barrier = barrier
+
+    def execute(self, query, params=None, settings=None, **kwargs):
+        if query.startswith("BACKUP ") or query.startswith("RESTORE "):
+            self.barrier.wait(timeout=5)
+        return super().execute(query, params, settings, **kwargs)
+
+
+@pytest.fixture
+def nodes():
+    barrier = threading.Barrier(3)
+    nodes = {
+        host: BarrierClient(barrier, databases={"sales": ["orders"]}, backup_size=100 * shard_num)
+        for shard_num, _, host, _ in CLUSTER["analytics"]
+    }
+    nodes["ch-2a"].available = False
+    return nodes
+
+
+@pytest.fixture
+def client():
+    return FakeClickHouseClient(databases={"sales": []}, clusters=CLUSTER)
+
+
+@pytest.fixture
+def sharded(chb, nodes):
+    def shard_factory(host, port):
+        node = chb.for_host(host, port)
+        node.client = nodes[host]
+        node.throttle.enabled = False
+        return node
+
+    return ShardedBackup(chb, "analytics", shard_factory=shard_factory)
+
+
+def test_discover_skips_unavailable_replica(sharded):
+    shards = sharded.discover_shards()
+    assert [(shard["shard_num"], shard["host"]) for shard in shards] == [(1, "ch-1a"), (2, "ch-2b"), (3, "ch-3a")]
+
+
+def test_backup_runs_on_all_shards_in_parallel(sharded, nodes):
+    """Барьер пропускает BACKUP только если все шарды запущены одновременно"""
+    backup_id = sharded.backup("sales", "File('/backups/sales/full/backup_1')")
+
+    backup = sharded.meta.get_backup(backup_id)
+    assert backup["status"] == "BACKUP_CREATED"
+    assert backup["cluster"] == "analytics"
+    assert backup["size"] == 100 + 200 + 300
+
+    shards = sharded.meta.list_shards(backup_id)
+    assert [shard["host"] for shard in shards] == ["ch-1a", "ch-2b", "ch-3a"]
+    assert all(shard["op_id"] in nodes[shard["host"]].operations for shard in shards)
+    assert nodes["ch-3a"].queries[1] == "BACKUP DATABASE sales TO File('/backups/sales/full/backup_1/shard_3') ASYNC"
+    assert not any(query.startswith("BACKUP ") for query in nodes["ch-1b"].queries)
+
+
+def test_incremental_uses_base_of_same_shard(sharded, nodes):
+    base_id = sharded.backup("sales", "File('/backups/sales/full/backup_1')")
+    backup_id = sharded.backup("sales", "File('/backups/sales/incremental/backup_2')", base_backup_id=base_id)
+
+    assert sharded.meta.get_backup(backup_id)["base_backup"] == base_id
+    backups = [query for query in nodes["ch-2b"].queries if query.startswith("BACKUP ")]
+    assert backups[-1].endswith(
+        "SETTINGS base_backup = File('/backups/sales/full/backup_1/shard_2') ASYNC"
+    )
+
+
+def test_failed_shard_fails_logical_backup(sharded, nodes):
+    original = nodes["ch-1a"]._poll_operation
+
+    def poll(op_id):
+        nodes["ch-1a"].operations[op_id]["done_status"] = "BACKUP_FAILED"
+        nodes["ch-1a"].operations[op_id]["error"] = "диск заполнен"
+        return original(op_id)
+
+    nodes["ch-1a"]._poll_operation = poll
+    with pytest.raises(RuntimeError):
+        sharded.backup("sales", "File('/backups/sales/full/backup_1')")
+
+    backup = sharded.meta.list_backups("sales")[-1]
+    assert backup["status"] == "BACKUP_FAILED"
+    statuses = {shard["shard_num"]: shard["status"] for shard in sharded.meta.list_shards(backup["id"])}
+    assert statuses == {1: "BACKUP_FAILED", 2: "BACKUP_CREATED", 3: "BACKUP_CREATED"}
+
+
+def test_restore_fans_out_to_shards(sharded, nodes):
+    backup_id = sharded.backup("sales", "File('/backups/sales/full/backup_1')")
+    sharded.restore("sales", backup_id)
+
+    for host, shard_num in (("ch-1a", 1), ("ch-2b", 2), ("ch-3a", 3)):
+        assert f"RESTORE DATABASE sales FROM File('/backups/sales/full/backup_1/shard_{shard_num}')" in nodes[host].queries
+
+
+def test_shard_connections_are_closed(sharded, nodes):
+    backup_id = sharded.backup("sales", "File('/backups/sales/full/backup_1')")
+    sharded.restore("sales", backup_id)
+
+    # Соединения, открытые при обнаружении шардов для бэкапа и восстановления, закрыты;
+    # к ch-1b не подключались - первая реплика шарда 1 доступна
+    assert {host: node.disconnects for host, node in nodes.items()} == {
+        "ch-1a": 2, "ch-1b": 0, "ch-2a": 2, "ch-2b": 2, "ch-3a": 2,
+    }
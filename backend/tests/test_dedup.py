@@ -0,0 +1,87 @@
+import os
+
+import pytest
+
+from dedup import ContentStore
+from tests.fake_clickhouse import FakeClickHouseClient, make_backup_tree
+
+
+def disk_usage(*paths):
+    """Объем уникальных inode: жесткие ссылки учитываются один раз"""
+    inodes = {}
+    for path in paths:
+        for dirpath, _, filenames in os.walk(path):
+            for name in filenames:
+                stat = os.stat(os.path.join(dirpath, name))
+                inodes[(stat.st_dev, stat.st_ino)] = stat.st_size
+    return sum(inodes.values())
+
+
+@pytest.fixture
+def store(manager, tmp_path):
+    return ContentStore(manager, str(tmp_path / "backups" / ".store"))
+
+
+def make_full(tmp_path, name, files=30):
+    path = tmp_path / "backups" / "sales" / "full" / name
+    make_backup_tree(str(path), files=files, file_size=1000, files_per_dir=10)
+    return str(path)
+
+
+def test_identical_fulls_share_storage(store, tmp_path):
+    first = make_full(tmp_path, "backup_1")
+    second = make_full(tmp_path, "backup_2")
+    backups_dir = str(tmp_path / "backups")
+    before = disk_usage(backups_dir)
+
+    assert store.deduplicate("b1", first)["stored"] == 30
+    stats = store.deduplicate("b2", second)
+    assert stats == {"files": 30, "stored": 0, "linked": 30, "saved_bytes": 30 * 1000}
+
+    assert before - disk_usage(backups_dir) == 30 * 1000
+    assert os.stat(os.path.join(second, "data", "part_0", "column_3.bin")).st_nlink == 3
+    assert store.stats()["stored_bytes"] == 30 * 1000
+    assert store.stats()["referenced_bytes"] == 2 * 30 * 1000
+
+
+def test_only_known_content_is_linked(store, tmp_path):
+    """Файлы связываются по контрольной сумме и размеру из манифеста"""
+    first = make_full(tmp_path, "backup_1", files=20)
+    second = make_full(tmp_path, "backup_2", files=30)
+    other = tmp_path / "backups" / "sales" / "full" / "backup_3"
+    make_backup_tree(str(other), files=20, file_size=999, files_per_dir=10)
+
+    store.deduplicate("b1", first)
+    assert store.deduplicate("b2", second) == {"files": 30, "stored": 10, "linked": 20, "saved_bytes": 20 * 1000}
+    assert store.deduplicate("b3", str(other))["linked"] == 0
+    assert not os.path.samefile(
+        os.path.join(first, "data", "part_0", "column_0.bin"),
+        os.path.join(str(other), "data", "part_0", "column_0.bin"),
+    )
+
+
+def test_space_is_freed_with_last_reference(store, tmp_path):
+    first = make_full(tmp_path, "backup_1")
+    second = make_full(tmp_path, "backup_2")
+    store.deduplicate("b1", first)
+    store.deduplicate("b2", second)
+
+    os.remove(os.path.join(first, "data", "part_0", "column_0.bin"))
+    assert store.release("b1") == 0
+    with open(os.path.join(second, "data", "part_0", "column_0.bin"), "rb") as f:
+        assert f.read(1) == b"0"
+
+    assert store.release("b2") == 30 * 1000
+    assert store.stats()["objects"] == 0
+    assert disk_usage(store.store_dir) == 0
+
+
+def test_post_processor_runs_after_full_backup(chb, tmp_path):
+    chb.client = FakeClickHouseClient(databases={"sales": []}, tree_files=10, tree_file_size=500)
+    store = ContentStore(chb.meta, str(tmp_path / "backups" / ".store"))
+    chb.post_processors.append(store.process_backup)
+
+    for name in ("backup_1", "backup_2"):
+        chb.backup_full("sales", f"File('{tmp_path / 'backups' / 'sales' / 'full' / name}')")
+
+    assert store.stats() == {"objects": 10, "refs": 20, "stored_bytes": 5000, "referenced_bytes": 10000}
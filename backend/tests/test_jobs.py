@@ -0,0 +1,118 @@
+import time
+
+import pytest
+
+from job_runner import JobRunner
+from jobs import JobQueue
+from tests.fake_clickhouse import FakeClickHouseClient
+
+
+@pytest.fixture
+def queue(chb):
+    return JobQueue(chb.meta, lease_sec=60, max_attempts=2)
+
+
+def backup_job_params(destination="File('/backups/sales/full/backup_1')"):
+    return {"backup_type": "full", "database": "sales", "destination": destination}
+
+
+def test_claim_is_exclusive(queue):
+    job = queue.enqueue("backup", backup_job_params())
+    assert job["status"] == "queued"
+
+    claimed = queue.claim("runner-a")
+    assert claimed["id"] == job["id"]
+    assert claimed["status"] == "running" and claimed["attempts"] == 1
+    assert queue.claim("runner-b") is None
+
+
+def test_expired_lease_is_reclaimed(chb):
+    queue = JobQueue(chb.meta, lease_sec=0.05)
+    job = queue.enqueue("backup", backup_job_params())
+    queue.claim("runner-a")
+    time.sleep(0.1)
+
+    assert queue.claim("runner-b")["id"] == job["id"]
+    # Прежний исполнитель больше не может менять задачу
+    assert not queue.heartbeat(job["id"], "runner-a")
+    assert not queue.complete(job["id"], "runner-a", {})
+    assert queue.complete(job["id"], "runner-b", {"status": "ok"})
+    assert queue.get_job(job["id"])["status"] == "done"
+
+
+def test_runner_executes_backup(chb, queue):
+    job = queue.enqueue("backup", backup_job_params())
+    runner = JobRunner(chb, queue, owner="runner-a")
+
+    assert runner.run_once()
+    assert not runner.run_once()
+
+    job = queue.get_job(job["id"])
+    assert job["status"] == "done"
+    assert job["op_id"]
+    assert job["result"] == {"op_id": job["op_id"], "status": "BACKUP_CREATED"}
+    assert chb.meta.get_backup(job["op_id"])["status"] == "BACKUP_CREATED"
+    assert any(query.endswith("ASYNC") for query in chb.client.queries if query.startswith("BACKUP "))
+
+
+def test_runner_resumes_started_operation(chb):
+    """Новый исполнитель дожидается уже запущенной операции, а не запускает BACKUP повторно"""
+    queue = JobQueue(chb.meta, lease_sec=0.05)
+    job = queue.enqueue("backup", backup_job_params())
+    queue.claim("crashed")
+
+    op_id, status = chb.client.execute("BACKUP DATABASE sales TO File('/backups/sales/full/backup_1') ASYNC")[0]
+    chb.meta.add_backup({
+        "id": op_id, "database": "sales", "type": "full",
+        "destination": "File('/backups/sales/full/backup_1')",
+        "timestamp": "2024-01-01T00:00:00", "status": status,
+    })
+    queue.set_op_id(job["id"], "crashed", op_id)
+    time.sleep(0.1)
+
+    backups_started = len([q for q in chb.client.queries if q.startswith("BACKUP ")])
+    assert JobRunner(chb, queue, owner="runner-b").run_once()
+
+    assert len([q for q in chb.client.queries if q.startswith("BACKUP ")]) == backups_started
+    assert queue.get_job(job["id"])["status"] == "done"
+    assert chb.meta.get_backup(op_id)["status"] == "BACKUP_CREATED"
+
+
+def test_failed_job_is_retried_then_failed(chb, queue):
+    job = queue.enqueue("backup", {"backup_type": "incremental", "database": "sales",
+                                   "destination": "File('/b/1')", "base_backup_id": "missing"})
+    runner = JobRunner(chb, queue, owner="runner-a")
+
+    runner.run_once()
+    job = queue.get_job(job["id"])
+    assert job["status"] == "queued" and "missing" in job["error"]
+
+    runner.run_once()
+    assert queue.get_job(job["id"])["status"] == "failed"
+
+
+class FailingOnceClient(FakeClickHouseClient):
+    """Первый BACKUP запускается, но проваливается в ClickHouse"""
+    def _start_operation(self, query, kind):
+        result = super()._start_operation(query, kind)
+        if kind == "BACKUP" and not getattr(self, "failed_once", False):
+            self.failed_once = True
+            self.operations[result[0][0]].update(done_status="BACKUP_FAILED", error="нет места на диске")
+        return result
+
+
+def test_retry_after_launch_uses_new_destination(chb, queue):
+    chb.client = FailingOnceClient(databases={"sales": []})
+    job = queue.enqueue("backup", backup_job_params())
+    runner = JobRunner(chb, queue, owner="runner-a")
+
+    runner.run_once()
+    assert queue.get_job(job["id"])["status"] == "queued"
+    runner.run_once()
+    job = queue.get_job(job["id"])
+    assert job["status"] == "done"
+
+    backups = {backup["status"]: backup for backup in chb.meta.list_backups("sales")}
+    assert backups["BACKUP_FAILED"]["destination"] == "File('/backups/sales/full/backup_1')"
+    assert backups["BACKUP_CREATED"]["destination"] == "File('/backups/sales/full/backup_1_attempt2')"
+    assert chb.meta.list_by_destination(backups["BACKUP_FAILED"]["destination"]) == [backups["BACKUP_FAILED"]]
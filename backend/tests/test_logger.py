@@ -0,0 +1,65 @@
+import json
+import logging
+import queue
+
+from logger import ContextFilter, DroppingQueueHandler, JsonFormatter, Sampler, TextFormatter, log_context
+
+
+def make_logger(name, maxsize):
+    log_queue = queue.Queue(maxsize=maxsize)
+    handler = DroppingQueueHandler(log_queue)
+    handler.addFilter(ContextFilter())
+    test_logger = logging.getLogger(name)
+    test_logger.setLevel(logging.DEBUG)
+    test_logger.propagate = False
+    test_logger.handlers = [handler]
+    return test_logger, log_queue
+
+
+def test_json_record_carries_context():
+    test_logger, log_queue = make_logger("test.context", 10)
+    with log_context(op_id="op-1", database="sales"):
+        test_logger.debug("Статус %s", "CREATING_BACKUP")
+    test_logger.debug("вне операции", extra={"op_id": "op-2"})
+
+    first = json.loads(JsonFormatter().format(log_queue.get_nowait()))
+    assert first["message"] == "Статус CREATING_BACKUP"
+    assert first["op_id"] == "op-1" and first["database"] == "sales"
+    second = json.loads(JsonFormatter().format(log_queue.get_nowait()))
+    assert second["op_id"] == "op-2" and "database" not in second
+
+
+def test_exception_is_kept_apart_from_message():
+    test_logger, log_queue = make_logger("test.exception", 10)
+    try:
+        raise ValueError("сбой")
+    except ValueError:
+        test_logger.exception("Ошибка бэкапа %s", "op-1")
+
+    record = log_queue.get_nowait()
+    entry = json.loads(JsonFormatter().format(record))
+    assert entry["message"] == "Ошибка бэкапа op-1"
+    assert "Traceback" in entry["exc_info"] and "ValueError: сбой" in entry["exc_info"]
+    assert TextFormatter("%(message)s").format(record).endswith("ValueError: сбой")
+
+
+def test_full_queue_drops_instead_of_blocking():
+    test_logger, log_queue = make_logger("test.dropping", 2)
+    for i in range(5):
+        test_logger.info(f"запись {i}")
+    assert log_queue.qsize() == 2
+
+    log_queue.get_nowait()
+    test_logger.info("после переполнения")
+    log_queue.get_nowait()
+    record = log_queue.get_nowait()
+    assert record.getMessage() == "после переполнения" and record.dropped == 3
+
+
+def test_sampler_passes_changes_and_interval():
+    sampler = Sampler(interval=60)
+    assert sampler.should_log("op", "CREATING_BACKUP")
+    assert not sampler.should_log("op", "CREATING_BACKUP")
+    assert sampler.should_log("op", "BACKUP_CREATED")
+    assert sampler.should_log("other", "CREATING_BACKUP")
+    assert Sampler(interval=0).should_log("op") and Sampler(interval=0).should_log("op")
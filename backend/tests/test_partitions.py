@@ -0,0 +1,125 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from backup_catalog import manifest_partitions
+from tests.fake_clickhouse import FakeClickHouseClient
+from worker import add_missing_columns
+
+JAN = datetime(2024, 1, 10)
+FEB = datetime(2024, 2, 10)
+
+
+@pytest.fixture
+def client():
+    return FakeClickHouseClient(
+        databases={"sales": ["events", "orders"]},
+        parts=[
+            ("sales", "events", "202401", JAN),
+            ("sales", "events", "202402", FEB),
+            ("sales", "orders", "202401", JAN),
+        ],
+    )
+
+
+def backup_queries(client):
+    return [query for query in client.queries if query.startswith("BACKUP ")]
+
+
+def test_first_changed_only_run_takes_all_partitions(chb, client):
+    client.now = FEB + timedelta(days=1)
+    chb.backup_partitions("sales", "File('/backups/sales/partitions/backup_1')", changed_only=True)
+
+    assert backup_queries(client)[-1] == (
+        "BACKUP TABLE sales.events PARTITIONS ID '202401', ID '202402', "
+        "TABLE sales.orders PARTITIONS ID '202401' TO File('/backups/sales/partitions/backup_1')"
+    )
+    backup = chb.meta.list_backups("sales")[-1]
+    assert backup["type"] == "partitions"
+    assert backup["status"] == "BACKUP_CREATED"
+    assert backup["partitions"] == {"events": ["202401", "202402"], "orders": ["202401"]}
+    assert backup["snapshot_time"] == "2024-02-11 00:00:00"
+
+
+def test_changed_only_takes_partitions_modified_after_snapshot(chb, client):
+    client.now = FEB + timedelta(days=1)
+    chb.backup_partitions("sales", "File('/b/1')", changed_only=True)
+
+    client.parts.append(("sales", "events", "202402", FEB + timedelta(days=2)))
+    client.now = FEB + timedelta(days=3)
+    chb.backup_partitions("sales", "File('/b/2')", changed_only=True)
+
+    assert backup_queries(client)[-1] == "BACKUP TABLE sales.events PARTITIONS ID '202402' TO File('/b/2')"
+    # Таблица без изменений записывается пустым списком: она проверена этим бэкапом
+    assert chb.meta.list_backups("sales")[-1]["partitions"] == {"events": ["202402"], "orders": []}
+
+    with pytest.raises(ValueError):
+        chb.backup_partitions("sales", "File('/b/3')", changed_only=True)
+
+
+def test_database_backup_covers_all_tables(chb, client):
+    client.now = FEB + timedelta(days=1)
+    chb.backup_full("sales", "File('/b/full')")
+
+    client.parts.append(("sales", "orders", "202402", FEB + timedelta(days=2)))
+    chb.backup_partitions("sales", "File('/b/1')", tables=["orders"], changed_only=True)
+    assert backup_queries(client)[-1] == "BACKUP TABLE sales.orders PARTITIONS ID '202402' TO File('/b/1')"
+
+
+def test_whole_tables_and_explicit_partitions(chb, client):
+    chb.backup_partitions("sales", "File('/b/1')", tables=["orders"])
+    assert backup_queries(client)[-1] == "BACKUP TABLE sales.orders TO File('/b/1')"
+
+    chb.backup_partitions("sales", "File('/b/2')", partitions={"events": ["202401"], "orders": None})
+    assert backup_queries(client)[-1] == (
+        "BACKUP TABLE sales.events PARTITIONS ID '202401', TABLE sales.orders TO File('/b/2')"
+    )
+
+
+def test_restore_replaces_only_backed_up_partitions(chb, client):
+    chb.restore("sales", "File('/b/1')", partitions={"events": ["202402"], "orders": [], "new_table": None})
+
+    assert "ALTER TABLE sales.events DROP PARTITION ID '202402'" in client.queries
+    assert not any(query.startswith("DROP TABLE") for query in client.queries)
+    assert client.queries[-2] == (
+        "RESTORE TABLE sales.events PARTITIONS ID '202402', TABLE sales.new_table "
+        "FROM File('/b/1') SETTINGS allow_non_empty_tables = true"
+    )
+    # Восстановленные партиции сохраняются в истории операций для аналитики
+    restore_id = next(iter(client.operations))
+    assert chb.meta.get_operation(restore_id)["settings"] == {
+        "allow_non_empty_tables": True, "partitions": {"events": ["202402"], "orders": [], "new_table": None},
+    }
+
+
+def test_manifest_partitions():
+    names = [
+        "metadata/sales/events.sql",
+        "data/sales/events/202401_1_5_1/data.bin",
+        "data/sales/events/202401_6_6_0/data.bin",
+        "data/sales/events/202402_7_7_0_9/data.bin",
+        "shards/1/replicas/1/data/sales/orders/202401_1_1_0/data.bin",
+    ]
+    assert manifest_partitions("sales", names) == {"events": ["202401", "202402"], "orders": ["202401"]}
+
+
+def test_part_written_in_snapshot_second_is_taken_again(chb, client):
+    client.now = FEB + timedelta(days=1)
+    chb.backup_partitions("sales", "File('/b/1')", changed_only=True)
+
+    # Секундная точность: кусок мог появиться после BACKUP в ту же секунду, что и снимок
+    client.parts.append(("sales", "orders", "202402", FEB + timedelta(days=1)))
+    client.now = FEB + timedelta(days=2)
+    chb.backup_partitions("sales", "File('/b/2')", changed_only=True)
+    assert backup_queries(client)[-1] == "BACKUP TABLE sales.orders PARTITIONS ID '202402' TO File('/b/2')"
+
+
+def test_migration_tolerates_concurrent_column_add(chb):
+    conn = chb.meta.pool.get_connection()
+    try:
+        # Колонки уже добавил другой процесс между PRAGMA table_info и ALTER TABLE
+        add_missing_columns(conn.cursor(), existing=set())
+        columns = {row["name"] for row in conn.execute("PRAGMA table_info(backups)")}
+    finally:
+        chb.meta.pool.return_connection(conn)
+    assert "cluster" in columns
@@ -0,0 +1,62 @@
+import time
+
+from readiness import Readiness
+from schema_cache import SchemaCache
+from tests.fake_clickhouse import FakeClickHouseClient, make_chb
+
+
+def test_ready_after_clickhouse_comes_up(chb):
+    cache = SchemaCache(lambda: chb.client, ttl=60)
+    readiness = Readiness(chb, time.monotonic(), schema_cache=cache, client_factory=lambda: chb.client)
+
+    chb.client.available = False
+    assert readiness.check_metadata()
+    assert not readiness.check_clickhouse()
+    health = readiness.health()
+    assert not health["ready"] and health["clickhouse"]["error"] == "Узел недоступен"
+
+    chb.client.available = True
+    assert readiness.check_clickhouse()
+    readiness._warm_up()
+    health = readiness.health()
+    assert health["ready"] and health["clickhouse"]["attempts"] == 2
+    assert health["startup"]["ready_sec"] >= 0
+    assert cache._snapshot is not None
+
+
+def test_in_flight_operations_are_resumed(chb, tmp_path):
+    destination = f"File('{tmp_path / 'backup_1'}')"
+    op_id, status = chb.client.execute(f"BACKUP DATABASE sales TO {destination} ASYNC")[0]
+    chb.meta.start_operation({
+        "id": op_id, "kind": "backup", "database": "sales", "type": "full",
+        "target": destination, "started_at": "2024-01-01T00:00:00", "status": status,
+    })
+    chb.meta.add_backup({
+        "id": op_id, "database": "sales", "type": "full", "destination": destination, "base_backup": None,
+        "timestamp": "2024-01-01T00:00:00", "status": status, "size": 0,
+    })
+
+    # Новый процесс после перезапуска: отслеживание продолжает опросчик
+    restarted = make_chb(str(tmp_path / "backups.db"), FakeClickHouseClient(databases={"sales": []}))
+    trackers = []
+
+    def tracker_client():
+        # Отдельное соединение к тому же серверу
+        client = FakeClickHouseClient()
+        client.operations, client._lock = chb.client.operations, chb.client._lock
+        trackers.append(client)
+        return client
+
+    restarted.client_factory = tracker_client
+    readiness = Readiness(restarted, time.monotonic(), client_factory=lambda: chb.client)
+    assert readiness.resume_in_flight() == 1
+    for _ in range(200):
+        if readiness.health()["poller"]["active"] == 0:
+            break
+        time.sleep(0.01)
+
+    assert restarted.meta.get_backup(op_id)["status"] == "BACKUP_CREATED"
+    assert len(trackers) == 1 and any("system.backups" in query for query in trackers[0].queries)
+    assert not any("system.backups" in query for query in restarted.client.queries)
+    assert restarted.meta.list_unfinished_operations() == []
+    assert Readiness(restarted, time.monotonic(), resume_operations=False).resume_in_flight() == 0
@@ -0,0 +1,143 @@
+import filecmp
+import os
+
+import pytest
+
+import replication
+from replication import Replicator, copy_file
+from tests.fake_clickhouse import FakeClickHouseClient
+
+
+def same_tree(left, right):
+    comparison = filecmp.dircmp(left, right)
+    if comparison.left_only or comparison.right_only or comparison.diff_files:
+        return False
+    return all(same_tree(os.path.join(left, d), os.path.join(right, d)) for d in comparison.common_dirs)
+
+
+@pytest.fixture
+def client():
+    return FakeClickHouseClient(databases={"sales": []}, tree_files=12, tree_file_size=3000)
+
+
+def make_replicator(chb, tmp_path, **kwargs):
+    replicator = Replicator(chb.meta, backup_dir=str(tmp_path / "backups"),
+                            replica_dir=str(tmp_path / "replica"), **kwargs)
+    chb.post_processors.append(replicator.process_backup)
+    chb.before_read.append(replicator.ensure_local)
+    return replicator
+
+
+def full_backup(chb, tmp_path, name):
+    chb.backup_full("sales", f"File('{tmp_path / 'backups' / 'sales' / 'full' / name}')")
+    return chb.meta.list_backups("sales")[-1]["id"]
+
+
+def test_copy_resumes_partial_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(replication, "COPY_CHUNK", 1000)
+    src = tmp_path / "src.bin"
+    src.write_bytes(os.urandom(10_000))
+    dst = tmp_path / "dst" / "src.bin"
+    dst.parent.mkdir()
+    (tmp_path / "dst" / "src.bin.part").write_bytes(src.read_bytes()[:4000])
+
+    assert copy_file(str(src), str(dst)) == 6000
+    assert dst.read_bytes() == src.read_bytes()
+    assert not os.path.exists(f"{dst}.part")
+    # Уже скопированный файл не копируется повторно
+    assert copy_file(str(src), str(dst)) == 0
+
+
+def test_backup_is_replicated_after_creation(chb, tmp_path):
+    replicator = make_replicator(chb, tmp_path, workers=3)
+    backup_id = full_backup(chb, tmp_path, "backup_1")
+
+    locations = replicator.get_locations(backup_id)
+    assert locations["replica"]["status"] == "pending"
+    assert replicator.replicate(backup_id)
+
+    locations = replicator.get_locations(backup_id)
+    assert locations["replica"]["status"] == "ready"
+    assert locations["replica"]["path"] == str(tmp_path / "replica" / "sales" / "full" / "backup_1")
+    assert locations["replica"]["bytes"] == chb.meta.get_backup(backup_id)["size"]
+    assert same_tree(locations["fast"]["path"], locations["replica"]["path"])
+    # Повторный вызов (например, вторым процессом) ничего не копирует
+    assert not replicator.replicate(backup_id)
+
+
+def test_interrupted_replication_is_resumed(chb, tmp_path):
+    replicator = make_replicator(chb, tmp_path)
+    backup_id = full_backup(chb, tmp_path, "backup_1")
+    replicator._update_location(backup_id, "replica", {"status": "copying", "owner": "crashed"})
+
+    # Копия, брошенная упавшим процессом, продолжается после STALE_SEC
+    restarted = Replicator(chb.meta, backup_dir=str(tmp_path / "backups"), replica_dir=str(tmp_path / "replica"))
+    assert restarted.resume_pending() == 1
+    assert not restarted.replicate(backup_id)
+    conn = chb.meta.pool.get_connection()
+    try:
+        conn.execute("UPDATE backup_locations SET updated_at = 0 WHERE backup_id = ?", (backup_id,))
+        conn.commit()
+    finally:
+        chb.meta.pool.return_connection(conn)
+    assert restarted.replicate(backup_id)
+    assert restarted.get_locations(backup_id)["replica"]["status"] == "ready"
+
+
+def test_retention_demotes_and_restore_promotes(chb, tmp_path):
+    replicator = make_replicator(chb, tmp_path, keep_fast=1)
+    first = full_backup(chb, tmp_path, "backup_1")
+    second = full_backup(chb, tmp_path, "backup_2")
+    for backup_id in (first, second):
+        replicator.replicate(backup_id)
+
+    assert replicator.apply_retention("sales") == [first]
+    fast_path = replicator.get_locations(first)["fast"]["path"]
+    assert not os.path.exists(fast_path)
+    assert replicator.get_locations(first)["fast"]["status"] == "removed"
+
+    chb.restore("sales", chb.meta.get_backup(first)["destination"], backup_id=first)
+    assert replicator.get_locations(first)["fast"]["status"] == "ready"
+    assert same_tree(fast_path, replicator.get_locations(first)["replica"]["path"])
+
+    replicator.remove(first)
+    assert replicator.get_locations(first) == {}
+    assert not os.path.exists(tmp_path / "replica" / "sales" / "full" / "backup_1")
+
+
+def test_backup_being_read_is_not_demoted(chb, tmp_path):
+    replicator = make_replicator(chb, tmp_path, keep_fast=1)
+    first = full_backup(chb, tmp_path, "backup_1")
+    second = full_backup(chb, tmp_path, "backup_2")
+    for backup_id in (first, second):
+        replicator.replicate(backup_id)
+
+    # Чтение (восстановление, скачивание) в процессе API началось до применения
+    # политики хранения в исполнителе очереди задач
+    runner = Replicator(chb.meta, backup_dir=str(tmp_path / "backups"), replica_dir=str(tmp_path / "replica"),
+                        keep_fast=1)
+    replicator.ensure_local(first)
+    assert runner.apply_retention("sales") == []
+    assert os.path.isdir(replicator.get_locations(first)["fast"]["path"])
+
+    replicator._update_location(first, "fast", {"pinned_until": 0})
+    assert runner.apply_retention("sales") == [first]
+    # Переименованный перед удалением каталог не остается
+    assert os.listdir(tmp_path / "backups" / "sales" / "full") == ["backup_2"]
+
+
+def test_abandoned_promotion_is_taken_over(chb, tmp_path, monkeypatch):
+    replicator = make_replicator(chb, tmp_path, keep_fast=1)
+    first = full_backup(chb, tmp_path, "backup_1")
+    second = full_backup(chb, tmp_path, "backup_2")
+    for backup_id in (first, second):
+        replicator.replicate(backup_id)
+    assert replicator.apply_retention("sales") == [first]
+
+    # Возврат начал и не закончил упавший процесс
+    replicator._update_location(first, "fast", {"status": "promoting", "owner": "crashed"})
+    monkeypatch.setattr(replication, "STALE_SEC", 0)
+    replicator.ensure_local(first)
+    locations = replicator.get_locations(first)
+    assert locations["fast"]["status"] == "ready" and locations["fast"]["owner"] is None
+    assert same_tree(locations["fast"]["path"], locations["replica"]["path"])
@@ -0,0 +1,73 @@
+import threading
+from datetime import datetime
+
+from schema_cache import SchemaCache
+from tests.fake_clickhouse import FakeClickHouseClient, make_chb
+from worker import ClickHouseBackup
+
+
+def test_summary_from_tables_and_parts():
+    client = FakeClickHouseClient(
+        databases={"sales": ["orders", "items"], "empty": []},
+        parts=[("sales", "orders", "2024", datetime(2024, 1, 1))] * 3 + [("sales", "items", "2024", datetime(2024, 1, 1))],
+        part_size=100,
+    )
+    cache = SchemaCache(lambda: client, ttl=60)
+
+    assert cache.list_databases() == ["sales", "empty"]
+    assert cache.database_summary() == [
+        {"name": "sales", "tables": 2, "rows": 0, "size": 400},
+        {"name": "empty", "tables": 0, "rows": 0, "size": 0},
+    ]
+    assert cache.get_tables("sales")[1] == {"name": "orders", "engine": "MergeTree", "rows": 0, "size": 300, "parts": 3}
+    # Повторные чтения не обращаются к ClickHouse
+    queries = len(client.queries)
+    cache.list_databases()
+    assert len(client.queries) == queries
+
+
+def test_stale_snapshot_is_served_while_refreshing():
+    client = FakeClickHouseClient(databases={"sales": []})
+    cache = SchemaCache(lambda: client, ttl=60)
+    assert cache.list_databases() == ["sales"]
+
+    release = threading.Event()
+    original_refresh = cache.refresh
+
+    def slow_refresh():
+        release.wait(5)
+        return original_refresh()
+
+    cache.refresh = slow_refresh
+    client.databases["new_db"] = []
+    cache.invalidate("new_db")
+    # Обновление идет в фоне, чтение получает прежний снимок сразу
+    assert cache.list_databases() == ["sales"]
+    release.set()
+    for _ in range(100):
+        if not cache._refreshing:
+            break
+        threading.Event().wait(0.01)
+    assert cache.list_databases() == ["sales", "new_db"]
+
+
+def test_restore_invalidates_cache(chb, tmp_path):
+    cache = SchemaCache(lambda: chb.client, ttl=60)
+    chb.schema_listeners.append(cache.invalidate)
+    cache.snapshot()
+
+    chb.restore("sales", f"File('{tmp_path / 'backup'}')")
+    assert cache._expires_at == 0.0
+
+
+def test_restore_in_other_process_invalidates_cache(tmp_path):
+    # API и исполнитель очереди задач - разные процессы с общими метаданными
+    api = ClickHouseBackup(meta_path=str(tmp_path / "backups.db"))
+    runner = make_chb(str(tmp_path / "backups.db"), FakeClickHouseClient(databases={"sales": ["orders"]}))
+    cache = SchemaCache(lambda: runner.client, ttl=60, generation=api.meta.get_schema_generation)
+    cache.snapshot()
+
+    runner.restore("sales", f"File('{tmp_path / 'backup'}')")
+    cache.refresh = lambda: None
+    cache.snapshot()
+    assert cache._expires_at == 0.0
@@ -0,0 +1,85 @@
+from throttle import LoadThrottle
+
+
+class FakeLoadClient:
+    """Имитирует ответы system-таблиц ClickHouse для троттлинга"""
+    def __init__(self, running=1, elapsed=0.1, io_wait=0.0, cpu=0.1):
+        self.running = running
+        self.elapsed = elapsed
+        self.io_wait = io_wait
+        self.cpu = cpu
+        self.queries = 0
+
+    def execute(self, query, params=None, settings=None):
+        self.queries += 1
+        if "system.metrics" in query:
+            return [(self.running,)]
+        if "system.processes" in query:
+            return [(self.elapsed,)]
+        if "system.asynchronous_metrics" in query:
+            return [
+                ("OSIOWaitTimeNormalized", self.io_wait),
+                ("OSUserTimeNormalized", self.cpu),
+                ("OSSystemTimeNormalized", 0.0),
+            ]
+        raise AssertionError(f"Неожиданный запрос: {query}")
+
+
+def make_throttle(client, **kwargs):
+    params = dict(
+        enabled=True,
+        sample_sec=0.01,
+        max_query_elapsed_sec=5,
+        max_running_queries=10,
+        max_io_wait=0.3,
+        max_cpu=0.8,
+        max_delay_sec=0.05,
+        backup_bandwidth=1024,
+    )
+    params.update(kwargs)
+    return LoadThrottle(lambda: client, **params)
+
+
+def test_idle_cluster_starts_immediately():
+    """При нормальной нагрузке бэкап запускается без ограничений"""
+    throttle = make_throttle(FakeLoadClient())
+    assert throttle.acquire() == {}
+
+
+def test_overload_delays_then_limits_bandwidth():
+    """При перегрузке запуск откладывается, а после таймаута ограничивается полоса"""
+    client = FakeLoadClient(elapsed=30.0)
+    throttle = make_throttle(client)
+    assert throttle.acquire() == {"max_backup_bandwidth": 1024}
+    assert client.queries > 3  # замеров было больше одного
+
+
+def test_recovery_releases_backup():
+    """Бэкап запускается без ограничений, как только нагрузка спала"""
+    class RecoveringClient(FakeLoadClient):
+        def execute(self, query, params=None, settings=None):
+            result = super().execute(query, params, settings)
+            if self.queries >= 6:
+                self.io_wait = 0.0
+            return result
+
+    client = RecoveringClient(io_wait=0.9)
+    throttle = make_throttle(client, max_delay_sec=5)
+    assert throttle.acquire() == {}
+    assert client.queries >= 6
+
+
+def test_sampling_errors_do_not_block():
+    """Ошибка получения метрик не блокирует бэкап"""
+    class BrokenClient:
+        def execute(self, *args, **kwargs):
+            raise RuntimeError("connection refused")
+
+    throttle = make_throttle(BrokenClient())
+    assert throttle.sample() is None
+    assert throttle.acquire() == {}
+
+
+def test_disabled_throttle():
+    throttle = make_throttle(FakeLoadClient(cpu=1.0), enabled=False)
+    assert throttle.acquire() == {}
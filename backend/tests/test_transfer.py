@@ -0,0 +1,130 @@
+import io
+import os
+import tarfile
+
+import pytest
+
+from tests.fake_clickhouse import make_backup_tree
+from transfer import BackupArchive, UploadStore, parse_range, register_uploaded_backup
+
+
+async def read_all(iterator):
+    return b"".join([chunk async for chunk in iterator])
+
+
+async def stream_of(data, chunk=1000):
+    for i in range(0, len(data), chunk):
+        yield data[i:i + chunk]
+
+
+@pytest.fixture
+def backup_path(tmp_path):
+    path = tmp_path / "src" / "sales" / "full" / "backup_20240101_000000"
+    make_backup_tree(str(path), files=20, file_size=700, files_per_dir=7, backup_uuid="full-1")
+    return str(path)
+
+
+@pytest.fixture
+def archive(backup_path):
+    return BackupArchive(backup_path, "sales/full/backup_20240101_000000")
+
+
+@pytest.mark.asyncio
+async def test_archive_is_valid_tar(archive, backup_path):
+    """Архив на лету совпадает по размеру с заявленным и читается tarfile"""
+    data = await read_all(archive.iter_range())
+    assert len(data) == archive.size
+
+    with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+        member = tar.getmember("sales/full/backup_20240101_000000/data/part_1/column_7.bin")
+        with open(os.path.join(backup_path, "data", "part_1", "column_7.bin"), "rb") as f:
+            assert tar.extractfile(member).read() == f.read()
+        assert "sales/full/backup_20240101_000000/.backup" in tar.getnames()
+
+
+@pytest.mark.asyncio
+async def test_ranges_resume_download(archive):
+    """Докачка по диапазонам дает те же байты, что и полная выгрузка"""
+    full = await read_all(archive.iter_range())
+    for start, end in [(0, 0), (1, 511), (512, 1300), (archive.size - 1030, archive.size - 1), (5000, 5000)]:
+        assert await read_all(archive.iter_range(start, end)) == full[start:end + 1]
+
+    resumed = b""
+    step = 777
+    for start in range(0, archive.size, step):
+        resumed += await read_all(archive.iter_range(start, min(start + step, archive.size) - 1))
+    assert resumed == full
+
+
+def test_parse_range():
+    assert parse_range(None, 100) is None
+    assert parse_range("bytes=10-", 100) == (10, 99)
+    assert parse_range("bytes=10-19", 100) == (10, 19)
+    assert parse_range("bytes=-10", 100) == (90, 99)
+    assert parse_range("bytes=90-500", 100) == (90, 99)
+    with pytest.raises(ValueError):
+        parse_range("bytes=100-", 100)
+
+
+@pytest.mark.asyncio
+async def test_upload_resume_and_register(archive, manager, tmp_path):
+    """Архив загружается частями, распаковывается и регистрируется по манифесту"""
+    data = await read_all(archive.iter_range())
+    backup_dir = tmp_path / "dst"
+    store = UploadStore(str(backup_dir / ".uploads"), str(backup_dir))
+
+    half = len(data) // 2
+    assert await store.append("up-1", 0, stream_of(data[:half])) == half
+    with pytest.raises(ValueError):
+        await store.append("up-1", 0, stream_of(data[half:]))
+    assert await store.append("up-1", half, stream_of(data[half:])) == len(data)
+
+    path = store.extract("up-1")
+    assert path == str(backup_dir / "sales" / "full" / "backup_20240101_000000")
+    assert store.received("up-1") == 0
+
+    backup = register_uploaded_backup(manager, path)
+    assert backup["id"] == "full-1"
+    assert backup["destination"] == f"File('{path}')"
+    with pytest.raises(FileExistsError):
+        register_uploaded_backup(manager, path)
+
+
+@pytest.mark.asyncio
+async def test_upload_rejects_path_traversal(tmp_path):
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w") as tar:
+        info = tarfile.TarInfo("sales/full/backup_1/../../../../etc/passwd")
+        info.size = 1
+        tar.addfile(info, io.BytesIO(b"x"))
+
+    store = UploadStore(str(tmp_path / ".uploads"), str(tmp_path))
+    await store.append("bad", 0, stream_of(buffer.getvalue()))
+    with pytest.raises(ValueError):
+        store.extract("bad")
+    assert not os.path.exists(tmp_path / "etc")
+
+
+@pytest.mark.asyncio
+async def test_upload_rejects_quoted_backup_name(tmp_path):
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w") as tar:
+        info = tarfile.TarInfo("sales/full/backup_1') SETTINGS x = 1 --/.backup")
+        info.size = 1
+        tar.addfile(info, io.BytesIO(b"x"))
+
+    store = UploadStore(str(tmp_path / ".uploads"), str(tmp_path))
+    await store.append("bad", 0, stream_of(buffer.getvalue()))
+    with pytest.raises(ValueError):
+        store.extract("bad")
+    assert not os.path.exists(tmp_path / "sales")
+
+
+def test_register_rejects_invalid_manifest_uuid(manager, tmp_path):
+    path = tmp_path / "sales" / "full" / "backup_20240101_000000"
+    make_backup_tree(str(path), files=1, file_size=10, backup_uuid="full-1'; DROP")
+
+    with pytest.raises(ValueError):
+        register_uploaded_backup(manager, str(path))
+    assert not os.path.exists(path)
+    assert manager.list_backups("sales") == []
@@ -0,0 +1,145 @@
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+from environments import (
+    THROTTLE_BACKUP_BANDWIDTH,
+    THROTTLE_ENABLED,
+    THROTTLE_MAX_CPU,
+    THROTTLE_MAX_DELAY_SEC,
+    THROTTLE_MAX_IO_WAIT,
+    THROTTLE_MAX_QUERY_ELAPSED_SEC,
+    THROTTLE_MAX_RUNNING_QUERIES,
+    THROTTLE_SAMPLE_SEC,
+)
+from logger import Sampler, logger
+
+
+class LoadThrottle:
+    """
+    Придерживает запуск бэкапов, пока ClickHouse перегружен.
+
+    Нагрузка снимается из system.metrics, system.asynchronous_metrics и
+    system.processes через отдельное соединение (clickhouse_driver.Client
+    не потокобезопасен). Пока есть ожидающие бэкапы, замер повторяется
+    каждые sample_sec секунд. По истечении max_delay_sec бэкап всё равно
+    запускается, но с ограничением max_backup_bandwidth, чтобы уложиться
+    в окно и не просадить латентность пользовательских запросов.
+    """
+    def __init__(self, client_factory: Callable[[], Any],
+                 enabled: bool = THROTTLE_ENABLED,
+                 sample_sec: float = THROTTLE_SAMPLE_SEC,
+                 max_query_elapsed_sec: float = THROTTLE_MAX_QUERY_ELAPSED_SEC,
+                 max_running_queries: int = THROTTLE_MAX_RUNNING_QUERIES,
+                 max_io_wait: float = THROTTLE_MAX_IO_WAIT,
+                 max_cpu: float = THROTTLE_MAX_CPU,
+                 max_delay_sec: float = THROTTLE_MAX_DELAY_SEC,
+                 backup_bandwidth: int = THROTTLE_BACKUP_BANDWIDTH):
+        self.enabled = enabled
+        self.sample_sec = sample_sec
+        self.max_query_elapsed_sec = max_query_elapsed_sec
+        self.max_running_queries = max_running_queries
+        self.max_io_wait = max_io_wait
+        self.max_cpu = max_cpu
+        self.max_delay_sec = max_delay_sec
+        self.backup_bandwidth = backup_bandwidth
+        self._client_factory = client_factory
+        self._client = None
+        self._lock = threading.Lock()
+        self._last_sample: Optional[Dict[str, float]] = None
+        self._last_sample_at = 0.0
+
+    def _get_client(self):
+        if self._client is None:
+            self._client = self._client_factory()
+        return self._client
+
+    def close(self) -> None:
+        """Закрывает соединение, через которое собираются метрики"""
+        with self._lock:
+            if self._client is not None:
+                self._client.disconnect()
+                self._client = None
+
+    def _collect(self) -> Dict[str, float]:
+        client = self._get_client()
+        sample = {
+            "running_queries": 0.0,
+            "max_query_elapsed": 0.0,
+            "io_wait": 0.0,
+            "cpu": 0.0,
+        }
+
+        rows = client.execute("SELECT value FROM system.metrics WHERE metric = 'Query'")
+        if rows:
+            sample["running_queries"] = float(rows[0][0])
+
+        rows = client.execute("""
+            SELECT max(elapsed) FROM system.processes
+            WHERE is_initial_query
+              AND query NOT ILIKE 'BACKUP %'
+              AND query NOT ILIKE 'RESTORE %'
+        """)
+        if rows and rows[0][0] is not None:
+            sample["max_query_elapsed"] = float(rows[0][0])
+
+        rows = client.execute("""
+            SELECT metric, value FROM system.asynchronous_metrics
+            WHERE metric IN ('OSIOWaitTimeNormalized', 'OSUserTimeNormalized', 'OSSystemTimeNormalized')
+        """)
+        for metric, value in rows:
+            if metric == "OSIOWaitTimeNormalized":
+                sample["io_wait"] = float(value)
+            else:
+                sample["cpu"] += float(value)
+        return sample
+
+    def sample(self) -> Optional[Dict[str, float]]:
+        """Возвращает замер нагрузки, не чаще одного запроса в sample_sec"""
+        with self._lock:
+            now = time.monotonic()
+            if self._last_sample is not None and now - self._last_sample_at < self.sample_sec:
+                return self._last_sample
+            try:
+                self._last_sample = self._collect()
+            except Exception as e:
+                # Без метрик троттлинг не должен блокировать бэкапы
+                logger.warning(f"Не удалось получить метрики нагрузки ClickHouse: {str(e)}")
+                self._client = None
+                self._last_sample = None
+            self._last_sample_at = now
+            return self._last_sample
+
+    def is_overloaded(self, sample: Optional[Dict[str, float]]) -> bool:
+        if not sample:
+            return False
+        return (
+            sample["max_query_elapsed"] > self.max_query_elapsed_sec
+            or sample["running_queries"] > self.max_running_queries
+            or sample["io_wait"] > self.max_io_wait
+            or sample["cpu"] > self.max_cpu
+        )
+
+    def acquire(self) -> Dict[str, Any]:
+        """
+        Блокирует поток, пока нагрузка выше порогов (не дольше max_delay_sec).
+        Возвращает настройки запроса для запуска бэкапа.
+        """
+        if not self.enabled:
+            return {}
+
+        deadline = time.monotonic() + self.max_delay_sec
+        sample = self.sample()
+        sampler = Sampler()
+        while self.is_overloaded(sample):
+            if time.monotonic() >= deadline:
+                logger.warning(
+                    f"ClickHouse перегружен дольше {self.max_delay_sec} сек, "
+                    f"бэкап запускается с ограничением {self.backup_bandwidth} байт/сек"
+                )
+                return {"max_backup_bandwidth": self.backup_bandwidth}
+            if sampler.should_log("overloaded"):
+                logger.debug(f"ClickHouse перегружен ({sample}), запуск бэкапа отложен")
+            time.sleep(self.sample_sec)
+            sample = self.sample()
+        return {}
@@ -0,0 +1,255 @@
+"""
+Потоковая выгрузка и загрузка бэкапов через API.
+
+Бэкап отдается как несжатый tar, который собирается на лету: заголовки
+и смещения всех файлов вычисляются заранее, поэтому размер архива известен
+до начала передачи, а Range-запросы (докачка) обслуживаются без чтения
+предшествующих данных. Загрузка идет по частям во временный файл на томе
+бэкапов с возможностью продолжить с последнего принятого байта.
+Память процесса ограничена размером одного блока (CHUNK_SIZE).
+"""
+import bisect
+import hashlib
+import os
+import re
+import shutil
+import tarfile
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+import aiofiles
+
+from backup_catalog import BACKUP_TYPES, has_valid_ids, scan_backup
+from environments import BACKUP_DIR, UPLOAD_DIR
+from validation import is_valid_backup_dir_name, is_valid_identifier
+from worker import BackupManager
+
+CHUNK_SIZE = 1024 * 1024
+BLOCK_SIZE = tarfile.BLOCKSIZE
+
+
+def parse_file_destination(destination: str) -> Optional[str]:
+    """Извлекает путь из destination формата File('/path/to/backup')"""
+    if destination.startswith("File('") and destination.endswith("')"):
+        return destination[6:-2]
+    return None
+
+
+class BackupArchive:
+    """Tar-архив каталога бэкапа с заранее вычисленной раскладкой"""
+    def __init__(self, path: str, arcname: str):
+        self.path = path
+        self.arcname = arcname
+        # (смещение, заголовок, путь к файлу или None, размер данных)
+        self._entries: List[Tuple[int, bytes, Optional[str], int]] = []
+        self._offsets: List[int] = []
+        self.size = 0
+        self._build()
+
+    def _add(self, info: tarfile.TarInfo, file_path: Optional[str]) -> None:
+        header = info.tobuf(tarfile.PAX_FORMAT, encoding="utf-8", errors="surrogateescape")
+        self._offsets.append(self.size)
+        self._entries.append((self.size, header, file_path, info.size))
+        self.size += len(header) + info.size + (-info.size % BLOCK_SIZE)
+
+    def _build(self) -> None:
+        latest_mtime = 0
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            dirnames.sort()
+            rel_dir = os.path.relpath(dirpath, self.path)
+            arc_dir = self.arcname if rel_dir == "." else f"{self.arcname}/{rel_dir}"
+            stat = os.stat(dirpath)
+            info = tarfile.TarInfo(arc_dir)
+            info.type = tarfile.DIRTYPE
+            info.mode = 0o755
+            info.mtime = int(stat.st_mtime)
+            self._add(info, None)
+
+            for name in sorted(filenames):
+                file_path = os.path.join(dirpath, name)
+                stat = os.stat(file_path)
+                info = tarfile.TarInfo(f"{arc_dir}/{name}")
+                info.size = stat.st_size
+                info.mode = 0o644
+                info.mtime = int(stat.st_mtime)
+                latest_mtime = max(latest_mtime, info.mtime)
+                self._add(info, file_path)
+
+        # Конец архива - два нулевых блока
+        self.size += 2 * BLOCK_SIZE
+        self.etag = '"' + hashlib.md5(
+            f"{self.arcname}:{self.size}:{latest_mtime}:{len(self._entries)}".encode()
+        ).hexdigest() + '"'
+
+    async def iter_range(self, start: int = 0, end: Optional[int] = None) -> AsyncIterator[bytes]:
+        """Отдает байты архива в диапазоне [start, end] включительно"""
+        end = self.size - 1 if end is None else end
+        position = start
+        index = max(0, bisect.bisect_right(self._offsets, start) - 1)
+
+        while position <= end and index < len(self._entries):
+            offset, header, file_path, size = self._entries[index]
+            index += 1
+            padding = -size % BLOCK_SIZE
+            segments = (
+                (offset, header, None),
+                (offset + len(header), None, file_path),
+                (offset + len(header) + size, b"\0" * padding, None),
+            )
+            lengths = (len(header), size, padding)
+            for (segment_start, data, segment_file), length in zip(segments, lengths):
+                segment_end = segment_start + length  # не включительно
+                if length == 0 or segment_end <= position or segment_start > end:
+                    continue
+                skip = position - segment_start
+                take = min(segment_end, end + 1) - position
+                if data is not None:
+                    yield data[skip:skip + take]
+                else:
+                    async for chunk in self._read_file(segment_file, skip, take):
+                        yield chunk
+                position += take
+
+        if position <= end:
+            # Хвост архива из нулевых блоков
+            yield b"\0" * (end + 1 - position)
+
+    @staticmethod
+    async def _read_file(file_path: str, offset: int, length: int) -> AsyncIterator[bytes]:
+        async with aiofiles.open(file_path, "rb") as f:
+            await f.seek(offset)
+            while length > 0:
+                chunk = await f.read(min(CHUNK_SIZE, length))
+                if not chunk:
+                    # Файл укоротился после построения раскладки: добиваем нулями,
+                    # чтобы не сместить последующие записи архива
+                    chunk = b"\0" * min(CHUNK_SIZE, length)
+                length -= len(chunk)
+                yield chunk
+
+
+def parse_range(range_header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """
+    Разбирает заголовок Range (поддерживается один диапазон).
+    Возвращает None, если нужно отдать архив целиком; ValueError - диапазон невыполним.
+    """
+    if not range_header:
+        return None
+    match = re.fullmatch(r"bytes=(\d*)-(\d*)", range_header.strip())
+    if not match or match.group(1) == match.group(2) == "":
+        return None
+    if match.group(1) == "":
+        # Суффиксный диапазон: последние N байт
+        length = int(match.group(2))
+        if length == 0:
+            raise ValueError("Пустой диапазон")
+        return max(0, size - length), size - 1
+    start = int(match.group(1))
+    end = int(match.group(2)) if match.group(2) else size - 1
+    if start >= size or end < start:
+        raise ValueError("Диапазон вне архива")
+    return start, min(end, size - 1)
+
+
+class UploadStore:
+    """Временные файлы загружаемых архивов с поддержкой докачки"""
+    def __init__(self, upload_dir: str = UPLOAD_DIR, backup_dir: str = BACKUP_DIR):
+        self.upload_dir = upload_dir
+        self.backup_dir = backup_dir
+
+    def _path(self, upload_id: str) -> str:
+        return os.path.join(self.upload_dir, f"{upload_id}.tar")
+
+    def received(self, upload_id: str) -> int:
+        path = self._path(upload_id)
+        return os.path.getsize(path) if os.path.exists(path) else 0
+
+    async def append(self, upload_id: str, offset: int, stream: AsyncIterator[bytes]) -> int:
+        """Дописывает тело запроса с позиции offset, которая должна совпадать с принятым размером"""
+        received = self.received(upload_id)
+        if offset != received:
+            raise ValueError(f"Ожидалось смещение {received}, получено {offset}")
+        os.makedirs(self.upload_dir, exist_ok=True)
+        async with aiofiles.open(self._path(upload_id), "ab") as f:
+            async for chunk in stream:
+                if chunk:
+                    await f.write(chunk)
+        return self.received(upload_id)
+
+    def discard(self, upload_id: str) -> None:
+        path = self._path(upload_id)
+        if os.path.exists(path):
+            os.remove(path)
+        shutil.rmtree(os.path.join(self.upload_dir, upload_id), ignore_errors=True)
+
+    @staticmethod
+    def _check_member(member: tarfile.TarInfo, root: Optional[str]) -> str:
+        """Проверяет запись архива и возвращает корень бэкапа <db>/<type>/backup_*"""
+        parts = member.name.split("/")
+        if member.name.startswith("/") or ".." in parts or len(parts) < 3:
+            raise ValueError(f"Недопустимый путь в архиве: {member.name}")
+        if not (member.isfile() or member.isdir()):
+            raise ValueError(f"Недопустимый тип записи в архиве: {member.name}")
+        member_root = "/".join(parts[:3])
+        database, backup_type, name = parts[:3]
+        # Имя каталога попадает в File('...') запросов RESTORE
+        if not is_valid_identifier(database) or backup_type not in BACKUP_TYPES or not is_valid_backup_dir_name(name):
+            raise ValueError(f"Архив должен содержать каталог <база>/<тип>/backup_*: {member.name}")
+        if root is not None and member_root != root:
+            raise ValueError("Архив должен содержать ровно один бэкап")
+        return member_root
+
+    def extract(self, upload_id: str) -> str:
+        """
+        Распаковывает принятый архив и переносит бэкап в BACKUP_DIR.
+        Возвращает путь к каталогу бэкапа.
+        """
+        archive_path = self._path(upload_id)
+        if not os.path.exists(archive_path):
+            raise FileNotFoundError(f"Загрузка {upload_id} не найдена")
+        staging = os.path.join(self.upload_dir, upload_id)
+        shutil.rmtree(staging, ignore_errors=True)
+
+        root = None
+        try:
+            with tarfile.open(archive_path, mode="r|") as tar:
+                for member in tar:
+                    root = self._check_member(member, root)
+                    target = os.path.join(staging, member.name)
+                    if member.isdir():
+                        os.makedirs(target, exist_ok=True)
+                        continue
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    source = tar.extractfile(member)
+                    with open(target, "wb") as f:
+                        shutil.copyfileobj(source, f, CHUNK_SIZE)
+            if root is None:
+                raise ValueError("Архив пуст")
+
+            destination = os.path.join(self.backup_dir, root)
+            if os.path.exists(destination):
+                raise FileExistsError(f"Бэкап уже существует: {destination}")
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            os.rename(os.path.join(staging, root), destination)
+        except tarfile.TarError as e:
+            raise ValueError(f"Поврежденный архив: {str(e)}")
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+
+        os.remove(archive_path)
+        return destination
+
+
+def register_uploaded_backup(manager: BackupManager, path: str) -> Dict[str, Any]:
+    """Регистрирует распакованный бэкап в метаданных по его манифесту"""
+    backup = scan_backup(path)
+    if backup is None:
+        shutil.rmtree(path, ignore_errors=True)
+        raise ValueError("В архиве нет манифеста .backup")
+    if not is_valid_backup_dir_name(os.path.basename(path)) or not has_valid_ids(backup):
+        shutil.rmtree(path, ignore_errors=True)
+        raise ValueError("Некорректное имя каталога или UUID бэкапа в манифесте")
+    if manager.get_backup(backup["id"]):
+        shutil.rmtree(path, ignore_errors=True)
+        raise FileExistsError(f"Бэкап {backup['id']} уже зарегистрирован")
+    manager.add_backup(backup)
+    return manager.get_backup(backup["id"])
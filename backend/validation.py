@@ -10,6 +10,14 @@ def is_valid_backup_identifier(backup_identifier: str) -> bool:
     """Проверяет валидность идентификатора для бекапа ClickHouse"""
     return bool(re.match(r'^[a-z0-9\-]*$', backup_identifier))
 
+def is_valid_partition_id(partition_id: str) -> bool:
+    """Проверяет валидность ID партиции ClickHouse (system.parts.partition_id)"""
+    return bool(re.match(r'^[a-zA-Z0-9_\-]+$', partition_id))
+
+def is_valid_backup_dir_name(name: str) -> bool:
+    """Проверяет имя каталога бэкапа (backup_<дата>[_attemptN]): оно попадает в File('...')"""
+    return bool(re.match(r'^backup_[a-zA-Z0-9_\-]+$', name))
+
 def validate_identifier(identifier: str):
     """Выбрасывает исключение при невалидном идентификаторе"""
     if not is_valid_identifier(identifier):
@@ -19,3 +27,8 @@ def validate_backup_identifier(backup_identifier: str):
     """Выбрасывает исключение при невалидном идентификаторе для бекапа"""
     if not is_valid_backup_identifier(backup_identifier):
         raise HTTPException(status_code=400, detail="base_backup_id имеет не верный формат")
+
+def validate_partition_id(partition_id: str):
+    """Выбрасывает исключение при невалидном ID партиции"""
+    if not is_valid_partition_id(partition_id):
+        raise HTTPException(status_code=400, detail=f"ID партиции '{partition_id}' имеет не верный формат")
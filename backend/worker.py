@@ -1,14 +1,29 @@
+import copy
 import os
 import json
 import sqlite3
-from datetime import datetime, time
-from typing import Any, Dict, List, Optional
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 from clickhouse_driver import Client, errors as clickhouse_errors
 from environments import BACKUP_META_DB
-from logger import logger
+from logger import Sampler, log_context, logger
+from throttle import LoadThrottle
 import threading
 from queue import Queue
 
+def add_missing_columns(cursor: sqlite3.Cursor, existing: Iterable[str]) -> None:
+    """Добавляет в backups колонки MIGRATED_COLUMNS, которых нет среди existing"""
+    for column, column_type in MIGRATED_COLUMNS.items():
+        if column in existing:
+            continue
+        try:
+            cursor.execute(f"ALTER TABLE backups ADD COLUMN {column} {column_type}")
+        except sqlite3.OperationalError as e:
+            # Колонку уже добавил другой процесс, запущенный одновременно
+            if "duplicate column name" not in str(e):
+                raise
+
 class SQLiteConnectionPool:
     """Пул соединений для SQLite с thread-safe управлением"""
     def __init__(self, db_path: str, pool_size: int = 5):
@@ -40,6 +55,41 @@ class SQLiteConnectionPool:
             conn = self._connections.get()
             conn.close()
 
+# Колонки, добавленные после первой версии схемы: создаются миграцией в _init_db
+MIGRATED_COLUMNS = {
+    "partitions": "TEXT",
+    "snapshot_time": "TEXT",
+    "cluster": "TEXT",
+}
+
+BACKUP_COLUMNS = (
+    "id", "database", "type", "destination", "base_backup",
+    "timestamp", "status", "size", "description",
+) + tuple(MIGRATED_COLUMNS)
+
+# Колонки, хранящиеся в SQLite как JSON
+JSON_COLUMNS = ("partitions",)
+
+def _encode_value(key: str, value: Any) -> Any:
+    if key in JSON_COLUMNS and value is not None:
+        return json.dumps(value)
+    return value
+
+def _row_to_dict(row: sqlite3.Row) -> Dict[str, Any]:
+    backup = dict(row)
+    for key in JSON_COLUMNS:
+        if backup.get(key) is not None:
+            backup[key] = json.loads(backup[key])
+    return backup
+
+def _backup_values(backup_info: Dict[str, Any]) -> tuple:
+    return tuple(_encode_value(key, backup_info.get(key)) for key in BACKUP_COLUMNS)
+
+INSERT_BACKUP_SQL = (
+    f"INSERT INTO backups ({', '.join(BACKUP_COLUMNS)}) "
+    f"VALUES ({', '.join('?' for _ in BACKUP_COLUMNS)})"
+)
+
 class BackupManager:
     def __init__(self, db_path: str = BACKUP_META_DB):
         self.db_path = db_path
@@ -63,6 +113,52 @@ class BackupManager:
                     description TEXT
                 )
             ''')
+            # Операции по шардам для бэкапов кластера (см. cluster.py)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS backup_shards (
+                    backup_id TEXT NOT NULL,
+                    shard_num INTEGER NOT NULL,
+                    host TEXT NOT NULL,
+                    port INTEGER NOT NULL,
+                    destination TEXT NOT NULL,
+                    op_id TEXT,
+                    status TEXT NOT NULL,
+                    size INTEGER,
+                    error TEXT,
+                    PRIMARY KEY (backup_id, shard_num)
+                )
+            ''')
+            # История операций бэкапа и восстановления для аналитики (см. analytics.py)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS operations (
+                    id TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    database TEXT NOT NULL,
+                    type TEXT,
+                    target TEXT,
+                    started_at TEXT NOT NULL,
+                    finished_at TEXT,
+                    duration_sec REAL,
+                    status TEXT NOT NULL,
+                    bytes INTEGER,
+                    files INTEGER,
+                    settings TEXT,
+                    error TEXT
+                )
+            ''')
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS operations_db_kind_started ON operations (database, kind, started_at)"
+            )
+            # Счетчик изменений схемы: кэш каталога других процессов сверяется с ним (см. schema_cache.py)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS schema_generation (
+                    id INTEGER PRIMARY KEY CHECK (id = 1),
+                    generation INTEGER NOT NULL
+                )
+            ''')
+            cursor.execute("INSERT OR IGNORE INTO schema_generation (id, generation) VALUES (1, 0)")
+            # Миграция баз, созданных до появления новых колонок
+            add_missing_columns(cursor, {row["name"] for row in cursor.execute("PRAGMA table_info(backups)")})
             conn.commit()
         finally:
             self.pool.return_connection(conn)
@@ -71,23 +167,38 @@ class BackupManager:
         conn = self.pool.get_connection()
         try:
             cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO backups (
-                    id, database, type, destination, 
-                    base_backup, timestamp, status, size, description
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                backup_info['id'],
-                backup_info['database'],
-                backup_info['type'],
-                backup_info['destination'],
-                backup_info.get('base_backup'),
-                backup_info['timestamp'],
-                backup_info['status'],
-                backup_info.get('size'),
-                backup_info.get('description')
-            ))
+            cursor.execute(INSERT_BACKUP_SQL, _backup_values(backup_info))
+            conn.commit()
+        finally:
+            self.pool.return_connection(conn)
+
+    def add_backups(self, backups: Iterable[Dict[str, Any]], batch_size: int = 1000) -> int:
+        """
+        Пакетно добавляет бэкапы, пропуская уже существующие ID.
+        Каждая пачка пишется одной транзакцией. Возвращает число добавленных записей.
+        """
+        conn = self.pool.get_connection()
+        added = 0
+
+        def flush(batch):
+            before = conn.total_changes
+            conn.executemany(INSERT_BACKUP_SQL.replace("INSERT", "INSERT OR IGNORE", 1), batch)
             conn.commit()
+            return conn.total_changes - before
+
+        try:
+            batch = []
+            for backup_info in backups:
+                batch.append(_backup_values(backup_info))
+                if len(batch) >= batch_size:
+                    added += flush(batch)
+                    batch = []
+            if batch:
+                added += flush(batch)
+            return added
+        except Exception:
+            conn.rollback()
+            raise
         finally:
             self.pool.return_connection(conn)
 
@@ -97,7 +208,7 @@ class BackupManager:
         try:
             cursor = conn.cursor()
             set_clause = ", ".join([f"{key} = ?" for key in updates.keys()])
-            values = list(updates.values())
+            values = [_encode_value(key, value) for key, value in updates.items()]
             values.append(backup_id)
             cursor.execute(f"""
                 UPDATE backups 
@@ -128,10 +239,20 @@ class BackupManager:
                 
             # Удаление бэкапа
             cursor.execute("DELETE FROM backups WHERE id = ?", (backup_id,))
+            cursor.execute("DELETE FROM backup_shards WHERE backup_id = ?", (backup_id,))
             conn.commit()
             logger.debug(f"Backup {backup_id} metadata removed")
             
-            return dict(backup)
+            return _row_to_dict(backup)
+        finally:
+            self.pool.return_connection(conn)
+
+    def list_by_destination(self, destination: str) -> List[Dict[str, Any]]:
+        """Бэкапы, записанные в destination (каталог может быть общим, например, у повторов задачи)"""
+        conn = self.pool.get_connection()
+        try:
+            rows = conn.execute("SELECT * FROM backups WHERE destination = ?", (destination,)).fetchall()
+            return [_row_to_dict(row) for row in rows]
         finally:
             self.pool.return_connection(conn)
 
@@ -141,197 +262,597 @@ class BackupManager:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM backups WHERE id = ?", (backup_id,))
             row = cursor.fetchone()
-            return dict(row) if row else None
+            return _row_to_dict(row) if row else None
         finally:
             self.pool.return_connection(conn)
 
-    def list_backups(self, database: Optional[str] = None) -> List[Dict[str, Any]]:
+    def list_backups(self, database: Optional[str] = None, limit: Optional[int] = None,
+                     offset: int = 0, newest_first: bool = False) -> List[Dict[str, Any]]:
+        """Бэкапы в порядке добавления (или обратном); limit/offset - постраничная выборка"""
         conn = self.pool.get_connection()
         try:
             cursor = conn.cursor()
+            query = "SELECT * FROM backups"
+            params: List[Any] = []
             if database:
-                cursor.execute("SELECT * FROM backups WHERE database = ?", (database,))
+                query += " WHERE database = ?"
+                params.append(database)
+            query += " ORDER BY rowid DESC" if newest_first else " ORDER BY rowid"
+            if limit is not None:
+                query += " LIMIT ? OFFSET ?"
+                params += [limit, offset]
+            cursor.execute(query, params)
+            return [_row_to_dict(row) for row in cursor.fetchall()]
+        finally:
+            self.pool.return_connection(conn)
+
+    def iter_backups(self, database: Optional[str] = None, batch_size: int = 1000) -> Iterator[Dict[str, Any]]:
+        """Построчно отдает бэкапы, не загружая весь список в память"""
+        conn = self.pool.get_connection()
+        try:
+            cursor = conn.cursor()
+            if database:
+                cursor.execute("SELECT * FROM backups WHERE database = ? ORDER BY timestamp", (database,))
             else:
-                cursor.execute("SELECT * FROM backups")
-            return [dict(row) for row in cursor.fetchall()]
+                cursor.execute("SELECT * FROM backups ORDER BY timestamp")
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield _row_to_dict(row)
+        finally:
+            self.pool.return_connection(conn)
+
+    def add_shards(self, backup_id: str, shards: List[Dict[str, Any]]) -> None:
+        conn = self.pool.get_connection()
+        try:
+            conn.executemany('''
+                INSERT INTO backup_shards (backup_id, shard_num, host, port, destination, status)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', [
+                (backup_id, shard['shard_num'], shard['host'], shard['port'], shard['destination'], shard['status'])
+                for shard in shards
+            ])
+            conn.commit()
+        finally:
+            self.pool.return_connection(conn)
+
+    def update_shard(self, backup_id: str, shard_num: int, updates: Dict[str, Any]) -> None:
+        conn = self.pool.get_connection()
+        try:
+            set_clause = ", ".join([f"{key} = ?" for key in updates.keys()])
+            conn.execute(
+                f"UPDATE backup_shards SET {set_clause} WHERE backup_id = ? AND shard_num = ?",
+                list(updates.values()) + [backup_id, shard_num]
+            )
+            conn.commit()
+        finally:
+            self.pool.return_connection(conn)
+
+    def list_shards(self, backup_id: str) -> List[Dict[str, Any]]:
+        conn = self.pool.get_connection()
+        try:
+            rows = conn.execute(
+                "SELECT * FROM backup_shards WHERE backup_id = ? ORDER BY shard_num", (backup_id,)
+            ).fetchall()
+            return [dict(row) for row in rows]
+        finally:
+            self.pool.return_connection(conn)
+
+    def start_operation(self, operation: Dict[str, Any]) -> None:
+        """Регистрирует запущенную операцию (kind: backup или restore) в истории"""
+        conn = self.pool.get_connection()
+        try:
+            conn.execute('''
+                INSERT OR REPLACE INTO operations (id, kind, database, type, target, started_at, status, settings)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (
+                operation["id"], operation["kind"], operation["database"], operation.get("type"),
+                operation.get("target"), operation.get("started_at") or datetime.now().isoformat(),
+                operation["status"], json.dumps(operation.get("settings") or {})
+            ))
+            conn.commit()
+        finally:
+            self.pool.return_connection(conn)
+
+    def finish_operation(self, op_id: str, status: str, bytes_total: Optional[int] = None,
+                         files: Optional[int] = None, error: Optional[str] = None) -> None:
+        """Фиксирует завершение операции; длительность считается от started_at"""
+        finished_at = datetime.now().isoformat()
+        conn = self.pool.get_connection()
+        try:
+            conn.execute('''
+                UPDATE operations
+                SET finished_at = ?, duration_sec = (julianday(?) - julianday(started_at)) * 86400,
+                    status = ?, bytes = ?, files = ?, error = ?
+                WHERE id = ?
+            ''', (finished_at, finished_at, status, bytes_total, files, error, op_id))
+            conn.commit()
+        finally:
+            self.pool.return_connection(conn)
+
+    def bump_schema_generation(self) -> None:
+        """Отмечает изменение схемы (восстановление, удаление таблиц) для всех процессов"""
+        conn = self.pool.get_connection()
+        try:
+            conn.execute("UPDATE schema_generation SET generation = generation + 1 WHERE id = 1")
+            conn.commit()
+        finally:
+            self.pool.return_connection(conn)
+
+    def get_schema_generation(self) -> int:
+        conn = self.pool.get_connection()
+        try:
+            return conn.execute("SELECT generation FROM schema_generation WHERE id = 1").fetchone()["generation"]
+        finally:
+            self.pool.return_connection(conn)
+
+    def list_unfinished_operations(self) -> List[Dict[str, Any]]:
+        """Операции без времени завершения (например, прерванные перезапуском процесса)"""
+        conn = self.pool.get_connection()
+        try:
+            rows = conn.execute(
+                "SELECT id, kind, database, started_at FROM operations WHERE finished_at IS NULL ORDER BY started_at"
+            ).fetchall()
+            return [dict(row) for row in rows]
+        finally:
+            self.pool.return_connection(conn)
+
+    def get_operation(self, op_id: str) -> Optional[Dict[str, Any]]:
+        conn = self.pool.get_connection()
+        try:
+            row = conn.execute("SELECT * FROM operations WHERE id = ?", (op_id,)).fetchone()
+            if row is None:
+                return None
+            operation = dict(row)
+            operation["settings"] = json.loads(operation["settings"]) if operation["settings"] else {}
+            return operation
+        finally:
+            self.pool.return_connection(conn)
+
+    def get_snapshot_times(self, database: str, tables: Iterable[str]) -> Dict[str, Optional[str]]:
+        """
+        Для каждой таблицы возвращает snapshot_time последнего успешного бэкапа,
+        который ее покрывает: бэкапа всей базы или бэкапа партиций с этой таблицей.
+        """
+        result: Dict[str, Optional[str]] = {table: None for table in tables}
+        conn = self.pool.get_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT snapshot_time, partitions FROM backups
+                WHERE database = ? AND status = 'BACKUP_CREATED' AND snapshot_time IS NOT NULL
+                ORDER BY snapshot_time DESC
+            """, (database,))
+            pending = set(result)
+            for row in cursor:
+                if not pending:
+                    break
+                covered = pending if row["partitions"] is None else pending & set(json.loads(row["partitions"]))
+                for table in covered:
+                    result[table] = row["snapshot_time"]
+                pending -= covered
+            return result
         finally:
             self.pool.return_connection(conn)
 
 class ClickHouseBackup:
-    def __init__(self, host="localhost", port=9000, user="default", password="", database="default"):
-        self.client = Client(host=host, port=port, user=user, password=password, database=database)
-        self.meta = BackupManager()
+    def __init__(self, host="localhost", port=9000, user="default", password="", database="default",
+                 meta_path: str = BACKUP_META_DB):
+        self._client_kwargs = dict(host=host, port=port, user=user, password=password, database=database)
+        self.client = Client(**self._client_kwargs)
+        self.meta = BackupManager(meta_path)
+        self.throttle = LoadThrottle(lambda: Client(**self._client_kwargs))
+        # Постобработка бэкапа, достигшего BACKUP_CREATED (дедупликация и т.п.)
+        self.post_processors: List[Callable[[Dict[str, Any]], None]] = []
+        # Подготовка бэкапа перед чтением ClickHouse (возврат из реплики и т.п.)
+        self.before_read: List[Callable[[str], None]] = []
+        # Уведомления об изменении схемы базы этим процессом (восстановление, удаление таблиц);
+        # другие процессы узнают о нем по счетчику schema_generation в метаданных
+        self.schema_listeners: List[Callable[[str], None]] = []
+        # Фабрика отдельных соединений (None - Client с параметрами конструктора)
+        self.client_factory: Optional[Callable[[], Any]] = None
 
-    def _get_backup_size(self, backup_destination: str) -> int:
-        """Вычисляет размер бэкапа в байтах"""
+    def for_host(self, host: str, port: int) -> "ClickHouseBackup":
+        """Копия для другого узла кластера с собственным соединением и общими метаданными"""
+        clone = copy.copy(self)
+        clone._client_kwargs = {**self._client_kwargs, "host": host, "port": port}
+        clone.client = Client(**clone._client_kwargs)
+        clone.throttle = LoadThrottle(lambda: Client(**clone._client_kwargs))
+        clone.post_processors = []
+        clone.client_factory = None
+        return clone
+
+    def own_client(self) -> "ClickHouseBackup":
+        """Копия с собственным соединением для фонового потока: Client не потокобезопасен"""
+        clone = copy.copy(self)
+        clone.client = clone.make_client()
+        return clone
+
+    def _track_in_background(self, method: str, *args: Any) -> None:
+        """Запускает отслеживание операции в фоновом потоке на отдельном соединении"""
+        tracker = self.own_client()
+
+        def run() -> None:
+            try:
+                getattr(tracker, method)(*args)
+            finally:
+                tracker.client.disconnect()
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def make_client(self) -> Client:
+        """Отдельное соединение с теми же параметрами (для фоновых потоков)"""
+        if self.client_factory is not None:
+            return self.client_factory()
+        return Client(**self._client_kwargs)
+
+    def _schema_changed(self, database: str) -> None:
+        self.meta.bump_schema_generation()
+        for listener in self.schema_listeners:
+            listener(database)
+
+    def _prepare_read(self, backup_id: str) -> None:
+        for hook in self.before_read:
+            hook(backup_id)
+
+    def _on_backup_created(self, backup_id: str) -> None:
+        """Запускает постобработку; ее ошибки не влияют на статус бэкапа"""
+        for processor in self.post_processors:
+            try:
+                processor(self.meta.get_backup(backup_id))
+            except Exception as e:
+                logger.error(f"Ошибка постобработки бэкапа {backup_id}: {str(e)}")
+
+    def _get_backup_stats(self, backup_destination: str) -> Tuple[int, int]:
+        """Вычисляет размер бэкапа в байтах и число файлов"""
         try:
             # Извлекаем путь из формата "File('/path/to/backup')"
             if backup_destination.startswith("File('") and backup_destination.endswith("')"):
                 path = backup_destination[6:-2]
                 if os.path.exists(path):
                     total_size = 0
+                    files = 0
                     for dirpath, _, filenames in os.walk(path):
                         for f in filenames:
                             fp = os.path.join(dirpath, f)
                             if os.path.isfile(fp):
                                 total_size += os.path.getsize(fp)
-                    return total_size
-            return 0
+                                files += 1
+                    return total_size, files
+            return 0, 0
         except Exception as e:
             logger.error(f"Ошибка вычисления размера бэкапа: {str(e)}")
-            return 0
-        
+            return 0, 0
+
+    def _get_backup_size(self, backup_destination: str) -> int:
+        """Вычисляет размер бэкапа в байтах"""
+        return self._get_backup_stats(backup_destination)[0]
+
+    def _finish_backup(self, op_id: str, destination: str, final_status: str) -> None:
+        """Записывает итог бэкапа в метаданные и историю операций"""
+        size, files = self._get_backup_stats(destination)
+        self.meta.update_backup(op_id, {
+            "status": final_status,
+            "size": size
+        })
+        self.meta.finish_operation(op_id, final_status, size, files)
+        if final_status == "BACKUP_CREATED":
+            self._on_backup_created(op_id)
+
+    def _fail_backup(self, op_id: str, error: str) -> None:
+        self.meta.update_backup(op_id, {"status": "BACKUP_FAILED"})
+        self.meta.finish_operation(op_id, "BACKUP_FAILED", error=error)
+
     def _complete_backup_metadata(self, op_id: str, destination: str, backup_id: str):
         """
         Фоновая задача для завершения метаданных бэкапа
         """
         try:
             final_status = self.wait_for_operation(op_id)
-            size = self._get_backup_size(destination)
-            self.meta.update_backup(backup_id, {
-                "status": final_status,
-                "size": size
-            })
+            self._finish_backup(backup_id, destination, final_status)
         except RuntimeError as e:
             logger.error(f"Ошибка при выполнении бэкапа {op_id}: {str(e)}")
-            self.meta.update_backup(backup_id, {"status": "BACKUP_FAILED"})
+            self._fail_backup(backup_id, str(e))
         except Exception as e:
             logger.error(f"Неизвестная ошибка при выполнении бэкапа {op_id}: {str(e)}")
-            self.meta.update_backup(backup_id, {"status": "BACKUP_FAILED"})
+            self._fail_backup(backup_id, str(e))
 
     def wait_for_operation(self, op_id: str, poll_sec: int = 2) -> str:
-        """Ожидает завершения операции и возвращает финальный статус"""
-        while True:
-            rows = self.client.execute("SELECT status, error FROM system.backups WHERE id = %(id)s", {"id": op_id})
-            if not rows:
-                logger.debug(f"Операция {op_id} не найдена в system.backups")
-                return "NOT_FOUND"
-            status, error = rows[0]
-            if status in ("BACKUP_CREATED", "RESTORED"):
-                logger.debug(f"Операция {op_id} завершена со статусом {status}")
-                return status
-            if status in ("BACKUP_FAILED", "RESTORE_FAILED"):
-                raise RuntimeError(f"Операция {op_id} провалена: {error}")
-            logger.debug(f"Статус {status}...")
-            time.sleep(poll_sec)
-
-    def backup_full(self, database: str, destination: str, async_mode: bool = False, description: Optional[str] = None) -> None:
-        query = f"BACKUP DATABASE {database} TO {destination}"
+        """
+        Ожидает завершения операции и возвращает финальный статус.
+        Неизменившийся статус логируется не чаще раза в LOG_POLL_SAMPLE_SEC.
+        """
+        operation = self.meta.get_operation(op_id)
+        sampler = Sampler()
+        with log_context(op_id=op_id, database=operation["database"] if operation else None):
+            while True:
+                rows = self.client.execute("SELECT status, error FROM system.backups WHERE id = %(id)s", {"id": op_id})
+                if not rows:
+                    logger.debug(f"Операция {op_id} не найдена в system.backups")
+                    return "NOT_FOUND"
+                status, error = rows[0]
+                if status in ("BACKUP_CREATED", "RESTORED"):
+                    logger.debug(f"Операция {op_id} завершена со статусом {status}")
+                    return status
+                if status in ("BACKUP_FAILED", "RESTORE_FAILED"):
+                    raise RuntimeError(f"Операция {op_id} провалена: {error}")
+                if sampler.should_log(op_id, status):
+                    logger.debug(f"Статус {status}...")
+                time.sleep(poll_sec)
+
+    def _start_backup(self, query: str, backup_info: Dict[str, Any], async_mode: bool,
+                      on_started: Optional[Callable[[str], None]] = None) -> None:
+        """
+        Запускает BACKUP, регистрирует его в метаданных и дожидается завершения
+        (в синхронном режиме) или передает отслеживание фоновому потоку.
+        Если задан on_started, он получает ID операции сразу после запуска,
+        а завершение отслеживается в текущем потоке (так работает job_runner).
+        """
         if async_mode:
             query += " ASYNC"
-        logger.debug(f"Выполняется: {query}")
-        op_id, initial_status = self.client.execute(query)[0]
-        logger.debug(f"ID операции: {op_id}, статус: {initial_status}")
+        settings = self.throttle.acquire()
+        snapshot_time = self.client.execute("SELECT now()")[0][0]
+        logger.debug(f"Выполняется: {query}, настройки: {settings}")
+        started_at = datetime.now().isoformat()
+        op_id, initial_status = self.client.execute(query, settings=settings)[0]
+        logger.debug(f"ID операции: {op_id}, статус: {initial_status}",
+                     extra={"op_id": op_id, "database": backup_info["database"]})
+        self.meta.start_operation({
+            "id": op_id,
+            "kind": "backup",
+            "database": backup_info["database"],
+            "type": backup_info["type"],
+            "target": backup_info["destination"],
+            "started_at": started_at,
+            "status": initial_status,
+            "settings": settings,
+        })
 
         # Добавляем запись сразу после запуска операции
         self.meta.add_backup({
+            **backup_info,
             "id": op_id,
-            "database": database,
-            "type": "full",
-            "destination": destination,
-            "base_backup": None,
             "timestamp": datetime.now().isoformat(),
             "status": initial_status,
             "size": 0,  # Временно 0
-            "description": description
+            "snapshot_time": snapshot_time.strftime("%Y-%m-%d %H:%M:%S"),
         })
 
-        if async_mode:
+        if on_started:
+            on_started(op_id)
+
+        if async_mode and on_started is None:
             # Запускаем фоновый поток для отслеживания завершения
-            threading.Thread(
-                target=self._complete_backup_metadata,
-                args=(op_id, destination, op_id),
-                daemon=True
-            ).start()
+            self._track_in_background("_complete_backup_metadata", op_id, backup_info["destination"], op_id)
         else:
             # Синхронный режим: ждем завершения здесь
             try:
                 final_status = self.wait_for_operation(op_id)
-                size = self._get_backup_size(destination)
-                self.meta.update_backup(op_id, {
-                    "status": final_status,
-                    "size": size
-                })
             except Exception as e:
-                self.meta.update_backup(op_id, {"status": "BACKUP_FAILED"})
-                logger.error(f"Ошибка при создании бэкапа: {str(e)}")
+                self._fail_backup(op_id, str(e))
+                logger.error(f"Ошибка при создании бэкапа ({backup_info['type']}): {str(e)}")
                 raise
+            self._finish_backup(op_id, backup_info["destination"], final_status)
+
+    def resume_operation(self, op_id: str) -> str:
+        """
+        Дожидается операции, запущенной ранее (например, другим процессом),
+        и дописывает метаданные бэкапа, если операция - бэкап.
+        """
+        backup = self.meta.get_backup(op_id)
+        if backup is None:
+            operation = self.meta.get_operation(op_id)
+            if operation is None:
+                return self.wait_for_operation(op_id)
+            return self._track_restore(op_id, operation["target"])
+        try:
+            final_status = self.wait_for_operation(op_id)
+        except RuntimeError as e:
+            self._fail_backup(op_id, str(e))
+            raise
+        self._finish_backup(op_id, backup["destination"], final_status)
+        return final_status
+
+    def backup_full(self, database: str, destination: str, async_mode: bool = False, description: Optional[str] = None,
+                    on_started: Optional[Callable[[str], None]] = None) -> None:
+        query = f"BACKUP DATABASE {database} TO {destination}"
+        self._start_backup(query, {
+            "database": database,
+            "type": "full",
+            "destination": destination,
+            "base_backup": None,
+            "description": description
+        }, async_mode, on_started)
 
-    def backup_incremental(self, database: str, destination: str, base_backup_id: str, async_mode: bool = False, description: Optional[str] = None) -> None:
+    def backup_incremental(self, database: str, destination: str, base_backup_id: str, async_mode: bool = False, description: Optional[str] = None,
+                           on_started: Optional[Callable[[str], None]] = None) -> None:
         base_backup = self.meta.get_backup(base_backup_id)
         if not base_backup:
             raise ValueError(f"Базовый бэкап {base_backup_id} не найден в метаданных")
+        self._prepare_read(base_backup_id)
         base_expr = base_backup["destination"]
         query = f"BACKUP DATABASE {database} TO {destination} SETTINGS base_backup = {base_expr}"
-        if async_mode:
-            query += " ASYNC"
-        logger.debug(f"Выполняется: {query}")
-        op_id, initial_status = self.client.execute(query)[0]
-        logger.debug(f"ID операции: {op_id}, статус: {initial_status}")
-
-        # Добавляем запись сразу после запуска операции
-        self.meta.add_backup({
-            "id": op_id,
+        self._start_backup(query, {
             "database": database,
             "type": "incremental",
             "destination": destination,
             "base_backup": base_backup_id,
-            "timestamp": datetime.now().isoformat(),
-            "status": initial_status,
-            "size": 0,  # Временно 0
             "description": description
-        })
+        }, async_mode, on_started)
 
-        if async_mode:
-            # Запускаем фоновый поток для отслеживания завершения
-            threading.Thread(
-                target=self._complete_backup_metadata,
-                args=(op_id, destination, op_id),
-                daemon=True
-            ).start()
-        else:
-            # Синхронный режим: ждем завершения здесь
-            try:
-                final_status = self.wait_for_operation(op_id)
-                size = self._get_backup_size(destination)
-                self.meta.update_backup(op_id, {
-                    "status": final_status,
-                    "size": size
-                })
-            except Exception as e:
-                self.meta.update_backup(op_id, {"status": "BACKUP_FAILED"})
-                logger.error(f"Ошибка при создании инкрементального бэкапа: {str(e)}")
-                raise
+    def get_changed_partitions(self, database: str, tables: Optional[List[str]] = None) -> Dict[str, List[str]]:
+        """
+        Возвращает партиции, измененные после последнего покрывающего таблицу бэкапа.
+        Изменения определяются по modification_time активных кусков в system.parts.
+        Таблицы без изменений попадают в результат с пустым списком, чтобы бэкап
+        зафиксировал, что они были проверены.
+        """
+        query = """
+            SELECT table, partition_id, max(modification_time)
+            FROM system.parts
+            WHERE database = %(database)s AND active
+        """
+        params: Dict[str, Any] = {"database": database}
+        if tables:
+            query += " AND table IN %(tables)s"
+            params["tables"] = tuple(tables)
+        query += " GROUP BY table, partition_id"
+        rows = self.client.execute(query, params)
 
-    def restore(self, database: str, source: str,
-                async_mode: bool = False) -> None:
-        # Удаление всех таблиц в базе (если база существует)
-        try:
-            tables = self.get_tables(database)
-            for table in tables:
+        checked = set(tables) if tables else {row[0] for row in rows}
+        since = {
+            table: datetime.strptime(snapshot, "%Y-%m-%d %H:%M:%S") if snapshot else None
+            for table, snapshot in self.meta.get_snapshot_times(database, checked).items()
+        }
+        changed: Dict[str, List[str]] = {table: [] for table in checked}
+        for table, partition_id, modified in rows:
+            # >=: кусок, записанный в ту же секунду после снимка, иначе был бы пропущен навсегда
+            if since[table] is None or modified >= since[table]:
+                changed[table].append(partition_id)
+        for partition_ids in changed.values():
+            partition_ids.sort()
+        return changed
+
+    @staticmethod
+    def _partitions_clause(database: str, partitions: Dict[str, Optional[List[str]]]) -> str:
+        """Формирует список TABLE ... [PARTITIONS ID ...] для BACKUP/RESTORE"""
+        elements = []
+        for table, partition_ids in sorted(partitions.items()):
+            if partition_ids is None:
+                elements.append(f"TABLE {database}.{table}")
+            elif partition_ids:
+                ids = ", ".join(f"ID '{partition_id}'" for partition_id in partition_ids)
+                elements.append(f"TABLE {database}.{table} PARTITIONS {ids}")
+        return ", ".join(elements)
+
+    def backup_partitions(self, database: str, destination: str,
+                          partitions: Optional[Dict[str, Optional[List[str]]]] = None,
+                          tables: Optional[List[str]] = None, changed_only: bool = False,
+                          async_mode: bool = False, description: Optional[str] = None,
+                          on_started: Optional[Callable[[str], None]] = None) -> None:
+        """
+        Бэкап отдельных таблиц и партиций.
+        partitions задает партиции явно (None вместо списка - таблица целиком),
+        changed_only вычисляет измененные партиции по system.parts,
+        tables без partitions и changed_only сохраняет таблицы целиком.
+        """
+        if changed_only:
+            partitions = self.get_changed_partitions(database, tables)
+        elif not partitions:
+            partitions = {table: None for table in tables or []}
+
+        clause = self._partitions_clause(database, partitions)
+        if not clause:
+            raise ValueError(f"Нет измененных партиций для бэкапа базы {database}")
+
+        self._start_backup(f"BACKUP {clause} TO {destination}", {
+            "database": database,
+            "type": "partitions",
+            "destination": destination,
+            "base_backup": None,
+            "description": description,
+            "partitions": partitions,
+        }, async_mode, on_started)
+
+    def _clear_partitions(self, database: str, partitions: Dict[str, Optional[List[str]]]) -> None:
+        """Удаляет таблицы и партиции, которые будут восстановлены из бэкапа партиций"""
+        existing = set(self.get_tables(database))
+        for table, partition_ids in partitions.items():
+            if table not in existing:
+                continue
+            if partition_ids is None:
                 logger.debug(f"Удаление таблицы: {database}.{table}")
-                # Для асинхронного режима используем SYNC для гарантии удаления
                 self.client.execute(f"DROP TABLE IF EXISTS {database}.{table} SYNC")
-        except clickhouse_errors.ServerException as e:
-            if "Database doesn't exist" not in str(e):
-                logger.error(f"Ошибка при очистке базы: {str(e)}")
-                raise
-        
+                continue
+            for partition_id in partition_ids:
+                logger.debug(f"Удаление партиции {partition_id}: {database}.{table}")
+                self.client.execute(f"ALTER TABLE {database}.{table} DROP PARTITION ID '{partition_id}'")
+
+    def restore(self, database: str, source: str,
+                async_mode: bool = False,
+                partitions: Optional[Dict[str, Optional[List[str]]]] = None,
+                on_started: Optional[Callable[[str], None]] = None,
+                backup_id: Optional[str] = None) -> None:
+        if backup_id:
+            self._prepare_read(backup_id)
+        # Настройки запуска сохраняются в истории операций, как у бэкапов
+        settings: Dict[str, Any] = {}
+        if partitions is not None:
+            # Бэкап партиций: заменяем только сохраненные в нем таблицы и партиции
+            clause = self._partitions_clause(database, partitions)
+            if not clause:
+                raise ValueError("Бэкап не содержит партиций для восстановления")
+            self._clear_partitions(database, partitions)
+            query = f"RESTORE {clause} FROM {source} SETTINGS allow_non_empty_tables = true"
+            settings = {"allow_non_empty_tables": True, "partitions": partitions}
+        else:
+            # Удаление всех таблиц в базе (если база существует)
+            try:
+                tables = self.get_tables(database)
+                for table in tables:
+                    logger.debug(f"Удаление таблицы: {database}.{table}")
+                    # Для асинхронного режима используем SYNC для гарантии удаления
+                    self.client.execute(f"DROP TABLE IF EXISTS {database}.{table} SYNC")
+            except clickhouse_errors.ServerException as e:
+                if "Database doesn't exist" not in str(e):
+                    logger.error(f"Ошибка при очистке базы: {str(e)}")
+                    raise
+            query = f"RESTORE DATABASE {database} FROM {source}"
+
         # Выполнение восстановления
-        query = f"RESTORE DATABASE {database} FROM {source}"
         if async_mode:
             query += " ASYNC"
 
         logger.debug(f"Выполняется: {query}")
         try:
+            started_at = datetime.now().isoformat()
             op_id, status = self.client.execute(query)[0]
-            logger.debug(f"ID операции: {op_id}, статус: {status}")
+            logger.debug(f"ID операции: {op_id}, статус: {status}", extra={"op_id": op_id, "database": database})
+            self._schema_changed(database)
+            self.meta.start_operation({
+                "id": op_id,
+                "kind": "restore",
+                "database": database,
+                "type": "partitions" if partitions is not None else "database",
+                "target": source,
+                "started_at": started_at,
+                "status": status,
+                "settings": settings,
+            })
+            if on_started:
+                on_started(op_id)
             
-            if not async_mode:
-                self.wait_for_operation(op_id)
+            if not async_mode or on_started:
+                self._track_restore(op_id, source)
+            else:
+                # Отслеживание завершения только для истории операций
+                self._track_in_background("_track_restore", op_id, source, False)
         except Exception as e:
             logger.error(f"Ошибка при восстановлении: {str(e)}")
             raise
+
+    def _track_restore(self, op_id: str, source: str, reraise: bool = True) -> Optional[str]:
+        """Дожидается восстановления и записывает итог в историю операций"""
+        try:
+            final_status = self.wait_for_operation(op_id)
+        except Exception as e:
+            self.meta.finish_operation(op_id, "RESTORE_FAILED", error=str(e))
+            self._restore_finished(op_id)
+            if reraise:
+                raise
+            logger.error(f"Ошибка при восстановлении {op_id}: {str(e)}")
+            return None
+        size, files = self._get_backup_stats(source)
+        self.meta.finish_operation(op_id, final_status, size, files)
+        self._restore_finished(op_id)
+        return final_status
+
+    def _restore_finished(self, op_id: str) -> None:
+        operation = self.meta.get_operation(op_id)
+        if operation:
+            self._schema_changed(operation["database"])
         
     def list_databases(self) -> List[str]:
         rows = self.client.execute("SHOW DATABASES")